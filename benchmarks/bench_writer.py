@@ -0,0 +1,270 @@
+"""
+Throughput benchmark of the writer actions against the local mock api
+
+Every (action, number of rows) case runs in its own process on a synthetic
+input table and reports rows/s, the p50/p99 request latency and the peak RSS.
+
+    python3 -m benchmarks.bench_writer --rows 1000 100000 --max-concurrency 8 --latency 0.02
+"""
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import resource
+import socket
+import queue
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+import ttdwr.writer
+from ttdwr.client import KBCTTDClient
+from benchmarks.mock_ttd import MockTTDServer
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ['create_campaigns', 'create_adgroups', 'create_campaigns_and_adgroups',
+           'clone_campaigns', 'put_adgroups']
+
+# how many adgroups each campaign gets in create_campaigns_and_adgroups
+ADGROUPS_PER_CAMPAIGN = 10
+
+
+def campaign_payload(i):
+    return {
+        "AdvertiserId": "adv1",
+        "CampaignName": "campaign_{}".format(i),
+        "Budget": {"Amount": 1000.0, "CurrencyCode": "USD"},
+        "StartDate": "2019-01-01T00:00:00Z",
+        "PacingMode": "PaceAhead",
+    }
+
+
+def adgroup_payload(i, campaign_id=None):
+    return {
+        "CampaignId": campaign_id,
+        "AdGroupName": "adgroup_{}".format(i),
+        "IsEnabled": False,
+        "RTBAttributes": {
+            "BudgetSettings": {"DailyBudget": {"Amount": 10.0, "CurrencyCode": "USD"}},
+            "BaseBidCPM": {"Amount": 1.5, "CurrencyCode": "USD"},
+            "AudienceTargeting": {"AudienceId": None},
+            "SiteTargeting": {"SiteListIds": ["s{}".format(j) for j in range(50)]},
+            "ROIGoal": {"CPAInAdvertiserCurrency": {"Amount": 2.0, "CurrencyCode": "USD"}},
+        }
+    }
+
+
+def _write_table(path, columns, rows):
+    with open(str(path), 'w') as f:
+        wr = csv.DictWriter(f, fieldnames=columns)
+        wr.writeheader()
+        wr.writerows(rows)
+
+
+def write_inputs(action, rows, intables):
+    """Generate the synthetic input table(s) of `action`"""
+    intables = Path(intables)
+    if action in ('create_campaigns', 'create_campaigns_and_adgroups'):
+        n_campaigns = rows if action == 'create_campaigns' else max(rows // ADGROUPS_PER_CAMPAIGN, 1)
+        _write_table(intables / ttdwr.writer.FNAME_CAMPAIGNS,
+                     ['dummy_campaign_id', 'payload'],
+                     ({'dummy_campaign_id': 'd{}'.format(i),
+                       'payload': json.dumps(campaign_payload(i))}
+                      for i in range(n_campaigns)))
+    if action in ('create_adgroups', 'create_campaigns_and_adgroups'):
+        n_campaigns = max(rows // ADGROUPS_PER_CAMPAIGN, 1)
+        _write_table(intables / ttdwr.writer.FNAME_ADGROUPS,
+                     ['dummy_campaign_id', 'payload'],
+                     ({'dummy_campaign_id': 'd{}'.format(i % n_campaigns),
+                       'payload': json.dumps(adgroup_payload(i, 'c1'))}
+                      for i in range(rows)))
+    if action == 'clone_campaigns':
+        _write_table(intables / ttdwr.writer.FNAME_CLONE_CAMPAIGNS,
+                     ['my_id', 'payload'],
+                     ({'my_id': i,
+                       'payload': json.dumps({"CampaignId": "template",
+                                              "CampaignName": "clone_{}".format(i)})}
+                      for i in range(rows)))
+    if action == 'put_adgroups':
+        _write_table(intables / ttdwr.writer.FNAME_PUT_ADGROUPS,
+                     ['OrderItemNumber', 'AdGroupId', 'payload'],
+                     ({'OrderItemNumber': i, 'AdGroupId': 'a{}'.format(i),
+                       'payload': json.dumps(dict(adgroup_payload(i, 'c1'),
+                                                  AdGroupId='a{}'.format(i)))}
+                      for i in range(rows)))
+
+
+class TimedClient(KBCTTDClient):
+    """Remembers how long every request took"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def _request(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super()._request(method, url, *args, **kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def run_case(action, rows, base_url, params):
+    """Run one action in this process, returns a dict of the results"""
+    with tempfile.TemporaryDirectory() as datadir:
+        intables = Path(datadir) / 'in/tables'
+        intables.mkdir(parents=True)
+        (Path(datadir) / 'out/tables').mkdir(parents=True)
+        write_inputs(action, rows, intables)
+        params = dict(params, login='bench', base_url=base_url)
+        params['#password'] = 'bench'
+        client = TimedClient(
+            login=params['login'], password=params['#password'],
+            path_csv_log=None, base_url=base_url,
+            max_requests_per_second=params.get('max_requests_per_second', 1e6),
+            # as the writer sizes it, the default 10 would cap the concurrency
+            pool_size=params.get('http_pool_size',
+                                 2 * params.get('max_concurrency', 1)),
+            compress_min_bytes=params.get('compress_requests_over_bytes'))
+        final_action = ttdwr.writer.decide_action(datadir, params)
+        start = time.perf_counter()
+        with client:
+            final_action(client=client)
+        elapsed = time.perf_counter() - start
+    return {
+        'action': action,
+        'rows': rows,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(rows / elapsed, 1),
+        'requests': len(client.latencies),
+        'p50_ms': round(percentile(client.latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(client.latencies, 99) * 1000, 2),
+        # kilobytes on linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def _run_case_in_child(results, *args):
+    try:
+        results.put((run_case(*args), None))
+    except BaseException:
+        results.put((None, traceback.format_exc()))
+
+
+def _result_of_child(results, child, poll_seconds=1.0):
+    """What the child put in the `results`, raises if it failed or died"""
+    while True:
+        try:
+            result, error = results.get(timeout=poll_seconds)
+            break
+        except queue.Empty:
+            if not child.is_alive():
+                # it might have put the result just before exiting
+                try:
+                    result, error = results.get(timeout=poll_seconds)
+                    break
+                except queue.Empty:
+                    raise RuntimeError("The benchmark process died with exit "
+                                       "code {}".format(child.exitcode))
+    child.join()
+    if error is not None:
+        raise RuntimeError("The benchmark case failed:\n{}".format(error))
+    return result
+
+
+def _serve(port, latency, error_rate, throttle_rate):
+    MockTTDServer(port=port, latency=latency, error_rate=error_rate,
+                  throttle_rate=throttle_rate).serve_forever()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("The mock api didn't start")
+
+
+def run_benchmarks(actions, sizes, params, latency=0.0, error_rate=0.0,
+                   throttle_rate=0.0):
+    # separate processes so that the server doesn't compete with the writer
+    # for the GIL and every case gets its own peak RSS
+    ctx = multiprocessing.get_context('spawn')
+    port = _free_port()
+    server = ctx.Process(target=_serve, daemon=True,
+                         args=(port, latency, error_rate, throttle_rate))
+    server.start()
+    results = []
+    try:
+        _wait_for_port(port)
+        base_url = 'http://127.0.0.1:{}/v3/'.format(port)
+        for action in actions:
+            for rows in sizes:
+                results_queue = ctx.Queue()
+                child = ctx.Process(target=_run_case_in_child,
+                                    args=(results_queue, action, rows, base_url,
+                                          params))
+                child.start()
+                result = _result_of_child(results_queue, child)
+                logger.info("%s", result)
+                results.append(result)
+    finally:
+        server.terminate()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--actions', nargs='+', default=ACTIONS, choices=ACTIONS)
+    parser.add_argument('--rows', nargs='+', type=int, default=[1000])
+    parser.add_argument('--max-concurrency', type=int, default=1)
+    parser.add_argument('--max-requests-per-second', type=float, default=1e6)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="mean latency of the mock api, seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--output', help="write the results as json here")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    params = {
+        'max_concurrency': args.max_concurrency,
+        'max_requests_per_second': args.max_requests_per_second,
+        # injected errors shouldn't end the benchmark
+        'do_not_fail': args.error_rate > 0,
+    }
+    results = run_benchmarks(args.actions, args.rows, params, args.latency,
+                             args.error_rate, args.throttle_rate)
+    columns = ['action', 'rows', 'seconds', 'rows_per_second', 'requests',
+               'p50_ms', 'p99_ms', 'peak_rss_mb']
+    print(' '.join('{:>30}'.format(col) if i == 0 else '{:>15}'.format(col)
+                   for i, col in enumerate(columns)))
+    for res in results:
+        print(' '.join('{:>30}'.format(res[col]) if i == 0 else '{:>15}'.format(res[col])
+                       for i, col in enumerate(columns)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+A local stand-in for the TTD v3 api
+
+Implements just enough for the writer:
+ - POST /v3/authentication
+ - POST /v3/campaign
+ - POST /v3/adgroup
+ - PUT  /v3/adgroup
+ - GET  /v3/adgroup/{id}
+ - POST /v3/campaign/clone
+ - GET  /v3/campaign/clone/status/{id}
+
+Latency, random errors (HTTP 500) and throttling (HTTP 429 with Retry-After)
+can be injected. Run standalone with
+
+    python3 -m benchmarks.mock_ttd --port 8080 --latency 0.05 --throttle-rate 0.01
+"""
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import random
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, like the real api
+    protocol_version = 'HTTP/1.1'
+    # send headers and body in one go, otherwise delayed ACKs
+    # add ~40ms to every request
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _send(self, status, body, headers=None):
+        raw = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(raw)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            raw = gzip.decompress(raw)
+        return json.loads(raw.decode('utf8') or 'null')
+
+    def _handle(self, method):
+        srv = self.server
+        path = self.path.split('?')[0].rstrip('/')
+        try:
+            payload = self._read_json()
+        except ValueError:
+            return self._send(400, {"Message": "Invalid json"})
+        srv.count(method, path)
+
+        if path.endswith('/authentication') and method == 'POST':
+            token = uuid.uuid4().hex
+            srv.tokens.add(token)
+            return self._send(200, {"Token": token})
+        if self.headers.get('TTD-Auth') not in srv.tokens:
+            return self._send(401, {"Message": "Missing or expired TTD-Auth header"})
+
+        if srv.latency:
+            time.sleep(max(random.gauss(srv.latency, srv.latency / 4), 0))
+        roll = random.random()
+        if roll < srv.throttle_rate:
+            return self._send(429, {"Message": "Too many requests"},
+                              {'Retry-After': str(srv.retry_after)})
+        if roll < srv.throttle_rate + srv.error_rate:
+            return self._send(500, {"Message": "Injected error"})
+
+        route = path.split('/v3', 1)[-1]
+        args = ()
+        handler = srv.routes.get((method, route))
+        if handler is None and route.count('/') >= 2:
+            resource, object_id = route.rsplit('/', 1)
+            handler = srv.routes.get((method, resource + '/{id}'))
+            args = (object_id,)
+        if handler is None:
+            return self._send(404, {"Message": "Unknown endpoint"})
+        body = handler(srv, payload, *args)
+        if body is None:
+            return self._send(404, {"Message": "Not found"})
+        return self._send(200, body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+
+def _create_campaign(srv, payload):
+    return dict(payload, CampaignId='c{}'.format(next(srv.ids)))
+
+
+def _create_adgroup(srv, payload):
+    adgroup = dict(payload, AdGroupId='a{}'.format(next(srv.ids)))
+    srv.adgroups[adgroup['AdGroupId']] = adgroup
+    return adgroup
+
+
+def _merged(current, changes):
+    """The nested objects are updated, not replaced"""
+    merged = dict(current)
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = _merged(merged[key], value)
+        merged[key] = value
+    return merged
+
+
+def _put_adgroup(srv, payload):
+    adgroup = _merged(srv.adgroups.get(payload['AdGroupId'], {}), payload)
+    adgroup['Version'] = adgroup.get('Version', 1) + 1
+    srv.adgroups[adgroup['AdGroupId']] = adgroup
+    return adgroup
+
+
+def _get_adgroup(srv, payload, adgroup_id):
+    return srv.adgroups.get(adgroup_id)
+
+
+def _clone_campaign(srv, payload):
+    reference_id = 'r{}'.format(next(srv.ids))
+    with srv._lock:
+        srv.clones[reference_id] = [srv.clone_polls, 'c{}'.format(next(srv.ids))]
+    return {"ReferenceId": reference_id}
+
+
+def _clone_status(srv, payload, reference_id):
+    with srv._lock:
+        clone = srv.clones.get(reference_id)
+        if clone is None:
+            return None
+        clone[0] -= 1
+        if clone[0] > 0:
+            return {"ReferenceId": reference_id, "Status": "Pending"}
+    return {"ReferenceId": reference_id, "Status": "Completed",
+            "CampaignId": clone[1]}
+
+
+class MockTTDServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    routes = {
+        ('POST', '/campaign'): _create_campaign,
+        ('POST', '/adgroup'): _create_adgroup,
+        ('PUT', '/adgroup'): _put_adgroup,
+        ('GET', '/adgroup/{id}'): _get_adgroup,
+        ('POST', '/campaign/clone'): _clone_campaign,
+        ('GET', '/campaign/clone/status/{id}'): _clone_status,
+    }
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0,
+                 throttle_rate=0.0, retry_after=1, clone_polls=1):
+        """
+        Args:
+            port: 0 picks a free port, see `base_url`
+            latency: mean time to answer a request, seconds
+            error_rate: share of requests answered with HTTP 500
+            throttle_rate: share of requests answered with HTTP 429
+            retry_after: the Retry-After header of the 429s
+            clone_polls: a clone is completed on this status check,
+                pending before
+        """
+        super().__init__((host, port), _Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.ids = itertools.count(1)
+        self.requests = {}
+        # the issued auth tokens, clear to expire them
+        self.tokens = set()
+        # AdGroupId -> the adgroup as created or put
+        self.adgroups = {}
+        # ReferenceId -> [status checks left, CampaignId]
+        self.clones = {}
+        self.clone_polls = clone_polls
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}/v3/'.format(*self.server_address)
+
+    def count(self, method, path):
+        with self._lock:
+            self.requests[(method, path)] = self.requests.get((method, path), 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = MockTTDServer(args.host, args.port, args.latency, args.error_rate,
+                           args.throttle_rate, args.retry_after)
+    logger.info("Serving the mock TTD api at %s", server.base_url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
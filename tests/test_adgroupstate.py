@@ -0,0 +1,124 @@
+import csv
+import json
+from pathlib import Path
+import ttdwr.writer
+from benchmarks.mock_ttd import MockTTDServer
+from ttdwr.adgroupstate import (AdgroupStateCache, changed_fields,
+                                payload_digest)
+
+
+def test_only_differing_fields_are_changed():
+    current = {"AdGroupId": "a1", "AdGroupName": "foo", "Version": 3,
+               "RTBAttributes": {"BaseBidCPM": {"Amount": 1.5, "CurrencyCode": "USD"}}}
+    desired = {"AdGroupId": "a1", "AdGroupName": "bar",
+               "RTBAttributes": {"BaseBidCPM": {"CurrencyCode": "USD", "Amount": 1.5}}}
+    assert changed_fields(desired, current) == {"AdGroupName": "bar"}
+    assert changed_fields(current, current) == {}
+
+
+def test_nested_objects_are_compared_as_subsets():
+    current = {"AdGroupId": "a1", "Version": 3,
+               "RTBAttributes": {"BaseBidCPM": {"Amount": 1.5, "CurrencyCode": "USD"},
+                                 "MaxBidCPM": None, "AudienceTargeting": {}},
+               "Tags": ["x", "y"]}
+    assert changed_fields({"RTBAttributes": {"BaseBidCPM": {"Amount": 1.5}}},
+                          current) == {}
+    assert changed_fields({"RTBAttributes": {"BaseBidCPM": {"Amount": 2},
+                                             "MaxBidCPM": None},
+                           "Tags": ["x"]}, current) == {
+        "RTBAttributes": {"BaseBidCPM": {"Amount": 2}}, "Tags": ["x"]}
+    # an object in place of a scalar and the other way around
+    assert changed_fields({"Version": {"Major": 3}}, current) == {"Version": {"Major": 3}}
+    assert changed_fields({"RTBAttributes": {"BaseBidCPM": None}}, current) == {
+        "RTBAttributes": {"BaseBidCPM": None}}
+    assert changed_fields({"RTBAttributes": {"AudienceTargeting": {}}}, current) == {}
+    # a missing field is a change even if it's null
+    assert changed_fields({"Description": None}, current) == {"Description": None}
+
+
+def test_cache_entries_expire():
+    now = [1000.0]
+    cache = AdgroupStateCache(ttl=60, clock=lambda: now[0])
+    cache.set('a1', {"AdGroupName": "foo"})
+    cache.set('a2', {"AdGroupName": "bar"})
+    state = cache.to_state({})
+
+    now[0] += 30
+    cache.set('a1', {"IsEnabled": True})
+    assert cache.get('a1') == payload_digest({"IsEnabled": True})
+    restored = AdgroupStateCache.from_state(state, ttl=60, clock=lambda: now[0])
+    assert len(restored) == 2
+    assert restored.get('a2') == payload_digest({"AdGroupName": "bar"})
+
+    now[0] += 31
+    assert restored.get('a2') is None
+    # a2 expired, a1 was updated later
+    assert set(cache.to_state({})['adgroup_cache']) == {'a1'}
+
+
+def test_the_state_has_a_digest_per_adgroup():
+    cache = AdgroupStateCache(ttl=60)
+    cache.set('a1', {"AdGroupName": "foo", "RTBAttributes": {
+        "Budget{}".format(i): {"Amount": i} for i in range(100)}})
+    entry = cache.to_state({})['adgroup_cache']['a1']
+    assert len(json.dumps(entry)) < 50
+
+
+def test_without_ttl_nothing_is_kept_between_runs():
+    cache = AdgroupStateCache(ttl=0)
+    cache.set('a1', {"AdGroupName": "foo"})
+    assert cache.get('a1') is not None
+    assert cache.to_state({}) == {'adgroup_cache': {}}
+
+
+def test_putting_only_changed_adgroups(tmpdir):
+    datadir = Path(tmpdir.strpath)
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    tmpdir.mkdir('out').mkdir('tables')
+    with open(str(intables.join(ttdwr.writer.FNAME_PUT_ADGROUPS)), 'w') as f:
+        wr = csv.writer(f)
+        wr.writerow(['OrderItemNumber', 'AdGroupId', 'payload'])
+        for i in range(10):
+            # only a part of the nested object, a9 gets a new bid
+            wr.writerow([i, 'a{}'.format(i), json.dumps({
+                "AdGroupId": 'a{}'.format(i),
+                "AdGroupName": 'name{}'.format(i if i < 7 else 'new'),
+                "RTBAttributes": {"BaseBidCPM": {"Amount": 2 if i == 9 else 1}}})])
+    params = {
+        'login': 'foo',
+        '#password': 'bar',
+        'max_concurrency': 4,
+        'skip_unchanged_adgroups': True,
+        'adgroup_cache_ttl_hours': 1,
+    }
+
+    with MockTTDServer() as server:
+        server.adgroups.update(
+            ('a{}'.format(i), {"AdGroupId": 'a{}'.format(i),
+                               "AdGroupName": 'name{}'.format(i), "Version": 1,
+                               "RTBAttributes": {
+                                   "BaseBidCPM": {"Amount": 1, "CurrencyCode": "USD"},
+                                   "MaxBidCPM": None}})
+            for i in range(10))
+        ttdwr.writer.main(dict(params, base_url=server.base_url), tmpdir.strpath)
+
+        with open(str(datadir / 'out/tables/put_adgroups.csv')) as f:
+            rows = list(csv.DictReader(f))
+        assert [row['update_status'] for row in rows] == ['unchanged'] * 7 + ['updated'] * 3
+        assert server.requests[('PUT', '/v3/adgroup')] == 3
+        assert server.adgroups['a8']['AdGroupName'] == 'namenew'
+        assert server.adgroups['a9']['RTBAttributes'] == {
+            "BaseBidCPM": {"Amount": 2, "CurrencyCode": "USD"}, "MaxBidCPM": None}
+        assert sum(count for (method, _), count in server.requests.items()
+                   if method == 'GET') == 10
+        with open(str(datadir / 'out/tables/metrics.csv')) as f:
+            endpoints = {row['endpoint'] for row in csv.DictReader(f)
+                         if row['phase'] == 'http'}
+        assert endpoints == {'adgroup', 'adgroup/{id}'}
+
+        # the next run within the ttl doesn't fetch the adgroups again
+        (datadir / 'out/state.json').rename(datadir / 'in/state.json')
+        ttdwr.writer.main(dict(params, base_url=server.base_url), tmpdir.strpath)
+        assert sum(count for (method, _), count in server.requests.items()
+                   if method == 'GET') == 10
+        assert server.requests[('PUT', '/v3/adgroup')] == 3
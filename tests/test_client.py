@@ -0,0 +1,82 @@
+import csv
+import json
+from pathlib import Path
+import ttdwr.writer
+from benchmarks.mock_ttd import MockTTDServer
+from ttdwr.requestlog import CsvRequestLog
+
+
+def test_auth_token_is_reused_and_refreshed_once(tmpdir):
+    datadir = Path(tmpdir.strpath)
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    tmpdir.mkdir('out').mkdir('tables')
+    intables.join(ttdwr.writer.FNAME_CLONE_CAMPAIGNS).write(
+        'payload,my_id\n' + ''.join(
+            '"{{""CampaignId"": ""c{0}""}}",my{0}\n'.format(i) for i in range(20)))
+
+    with MockTTDServer(latency=0.01) as server:
+        params = {'login': 'foo', '#password': 'bar',
+                  'base_url': server.base_url, 'max_concurrency': 8,
+                  'max_requests_per_second': 1000}
+        ttdwr.writer.main(params, tmpdir.strpath)
+        assert server.requests[('POST', '/v3/authentication')] == 1
+        with open(str(datadir / 'out/state.json')) as f:
+            state = json.load(f)
+        assert state['auth']['#token'] in server.tokens
+        # KBC encrypts only the values of the keys starting with '#'
+        assert state['auth']['owner'] not in server.tokens
+        assert '#auth' not in state
+
+        # the next run doesn't log in
+        (datadir / 'out/state.json').rename(datadir / 'in/state.json')
+        ttdwr.writer.main(params, tmpdir.strpath)
+        assert server.requests[('POST', '/v3/authentication')] == 1
+
+        # the token expires, all the workers get a 401 but only one logs in
+        server.tokens.clear()
+        ttdwr.writer.main(params, tmpdir.strpath)
+        assert server.requests[('POST', '/v3/authentication')] == 2
+        with open(str(datadir / 'out/tables/clone_campaigns.csv')) as f:
+            assert len(list(csv.DictReader(f))) == 20
+
+        # a different user doesn't get the token
+        ttdwr.writer.main(dict(params, login='baz'), tmpdir.strpath)
+        assert server.requests[('POST', '/v3/authentication')] == 3
+
+
+def test_connections_are_reused_and_bodies_compressed(tmpdir):
+    datadir = Path(tmpdir.strpath)
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    tmpdir.mkdir('out').mkdir('tables')
+    intables.join(ttdwr.writer.FNAME_PUT_ADGROUPS).write(
+        'OrderItemNumber,AdGroupId,payload\n' + ''.join(
+            '{0},a{0},"{{""AdGroupId"": ""a{0}"", ""AdGroupName"": ""n{0}""}}"\n'.format(i)
+            for i in range(40)))
+
+    with MockTTDServer(latency=0.005) as server:
+        ttdwr.writer.main({
+            'login': 'foo',
+            '#password': 'bar',
+            'base_url': server.base_url,
+            'max_concurrency': 4,
+            'max_requests_per_second': 1000,
+            'compress_requests_over_bytes': 10,
+            'request_log': {'stdout': 'none'},
+        }, tmpdir.strpath)
+    # the gzipped payloads were understood
+    assert server.adgroups['a39'] == {"AdGroupId": "a39", "AdGroupName": "n39",
+                                      "Version": 2}
+    # but the log has them readable
+    with open(str(datadir / 'out/tables/ttd_writer_log.csv')) as f:
+        logged = [row['request'] for row in csv.DictReader(f, CsvRequestLog.header)
+                  if row['method'] == 'PUT']
+    assert len(logged) == 40
+    assert '{"AdGroupId": "a39", "AdGroupName": "n39"}' in logged
+
+    with open(str(datadir / 'out/tables/metrics.csv')) as f:
+        counters = {row['phase']: int(row['count']) for row in csv.DictReader(f)
+                    if row['endpoint'] == '127.0.0.1'}
+    # the login and the puts
+    assert counters['connection_requests'] == 41
+    # never more connections than the pool size
+    assert counters['connections_opened'] <= 8
@@ -0,0 +1,101 @@
+import csv
+import json
+from pathlib import Path
+import requests
+import ttdwr.writer
+from benchmarks.mock_ttd import MockTTDServer
+from ttdapi.exceptions import TTDApiError
+from ttdwr.clonestatus import CloneStatus, is_pending, resolve_clones
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class MockClient:
+    """r1 is done right away, r2 on the third check, r3 never"""
+    def __init__(self):
+        self.checks = {}
+
+    def request_raw(self, method, endpoint, body):
+        reference_id = endpoint.rsplit('/', 1)[-1]
+        self.checks[reference_id] = self.checks.get(reference_id, 0) + 1
+        resp = requests.Response()
+        resp.status_code = 200
+        if reference_id == 'r1' or (reference_id == 'r2'
+                                    and self.checks['r2'] >= 3):
+            resp._content = '{{"Status": "Completed", "CampaignId": "c{}"}}'.format(
+                reference_id[1:]).encode()
+        elif reference_id == 'r3':
+            resp.status_code = 404
+            resp._content = b'{"Message": "Not found"}'
+            raise TTDApiError(response=resp)
+        else:
+            resp._content = b'{"Status": "InProgress"}'
+        return resp
+
+
+def test_pending_statuses():
+    assert is_pending(CloneStatus('Pending', ''))
+    assert is_pending(CloneStatus('In Progress', ''))
+    assert is_pending(CloneStatus('', ''))
+    assert not is_pending(CloneStatus('Failed', ''))
+    assert not is_pending(CloneStatus('', 'c1'))
+
+
+def test_resolving_with_backoff_and_timeout():
+    client = MockClient()
+    clock = FakeClock()
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock.sleep(seconds)
+
+    statuses = resolve_clones(client, ['r1', 'r2', 'r3', 'r1'], max_concurrency=2,
+                              timeout=20, first_delay=2, clock=clock, sleep=sleep)
+    assert statuses == {'r1': CloneStatus('Completed', 'c1'),
+                        'r2': CloneStatus('Completed', 'c2'),
+                        'r3': CloneStatus('Pending', '')}
+    # the duplicate is checked once, the done ones aren't checked again
+    assert client.checks['r1'] == 1
+    assert client.checks['r2'] == 3
+    # the delay doubles and the last one is cut to the timeout
+    assert sleeps == [2, 4, 8, 6]
+    assert client.checks['r3'] == 5
+
+
+def test_resolving_the_clones(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    tmpdir.mkdir('out').mkdir('tables')
+    intables.join(ttdwr.writer.FNAME_CLONE_CAMPAIGNS).write(
+        'payload,my_id\n' + ''.join(
+            '"{{""CampaignId"": ""c{0}""}}",my{0}\n'.format(i) for i in range(10)))
+
+    with MockTTDServer(clone_polls=2) as server:
+        ttdwr.writer.main({
+            'login': 'foo',
+            '#password': 'bar',
+            'base_url': server.base_url,
+            'max_concurrency': 4,
+            'max_requests_per_second': 1000,
+            'resolve_clones': True,
+        }, tmpdir.strpath)
+        clones = dict(server.clones)
+
+    with open(str(Path(tmpdir.strpath) / 'out/tables/clone_campaigns.csv')) as f:
+        rows = list(csv.DictReader(f))
+    assert [row['my_id'] for row in rows] == ['my{}'.format(i) for i in range(10)]
+    assert all(row['clone_status'] == 'Completed' for row in rows)
+    assert [row['clone_campaign_id'] for row in rows] == [
+        clones[json.loads(row['response'])['ReferenceId']][1] for row in rows]
+    # pending on the first check, done on the second
+    assert sum(count for (method, path), count in server.requests.items()
+               if path.startswith('/v3/campaign/clone/status/')) == 20
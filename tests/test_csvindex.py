@@ -0,0 +1,63 @@
+import csv
+from ttdwr.csvindex import IndexedCsv, read_rows
+
+
+ROWS = [
+    {'id': '1', 'payload': '{"Name": "one"}'},
+    {'id': '2', 'payload': '{"Description": "two\nlines"}'},
+    {'id': '3', 'payload': '{"Name": "a \\"quoted\\"\r\nname"}'},
+    {'id': '4', 'payload': ''},
+]
+
+
+def _all_rows(path, table):
+    return list(read_rows(path.strpath, table.offsets, table.header,
+                          table.header))
+
+
+def _write(path, rows):
+    with open(str(path), 'w', newline='') as f:
+        wr = csv.DictWriter(f, ['id', 'payload'])
+        wr.writeheader()
+        wr.writerows(rows)
+
+
+def test_quoted_newlines_are_not_row_boundaries(tmpdir):
+    path = tmpdir.join('table.csv')
+    _write(path, ROWS)
+    with IndexedCsv(path.strpath) as table:
+        assert table.header == ['id', 'payload']
+        assert len(table) == 4
+        assert _all_rows(path, table) == ROWS
+        with open(path.strpath, newline='') as f:
+            assert _all_rows(path, table) == list(csv.DictReader(f))
+
+
+def test_chunks_and_columns(tmpdir):
+    path = tmpdir.join('table.csv')
+    _write(path, ROWS * 25)
+    with IndexedCsv(path.strpath) as table:
+        assert list(read_rows(path.strpath, table.offsets[1:4], ['id'],
+                              table.header)) == [{'id': '2'}, {'id': '3'}]
+        chunks = table.chunks(30)
+        assert chunks == [(0, 30), (30, 60), (60, 90), (90, 100)]
+        # a worker gets just the offsets of its chunk
+        start, stop = chunks[1]
+        rows = read_rows(path.strpath, table.offsets[start:stop + 1],
+                         ['payload'], table.header)
+        assert [row['payload'] for row in rows] == \
+            [row['payload'] for row in (ROWS * 25)[start:stop]]
+
+
+def test_empty_and_headless_tables(tmpdir):
+    empty = tmpdir.join('empty.csv')
+    empty.write('')
+    with IndexedCsv(empty.strpath) as table:
+        assert table.header is None
+        assert len(table) == 0
+    header_only = tmpdir.join('header.csv')
+    header_only.write('id,payload\n\n')
+    with IndexedCsv(header_only.strpath) as table:
+        assert table.header == ['id', 'payload']
+        assert len(table) == 0
+        assert _all_rows(header_only, table) == []
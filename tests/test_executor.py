@@ -0,0 +1,114 @@
+import time
+import random
+import threading
+import pytest
+from ttdwr.executor import Coalescer, RowExecutor
+
+
+def test_imap_keeps_input_order():
+    def slow_square(x):
+        time.sleep(random.random() / 100)
+        return x * x
+
+    with RowExecutor(max_concurrency=8) as executor:
+        result = list(executor.imap(slow_square, range(100)))
+    assert result == [x * x for x in range(100)]
+
+
+def test_imap_runs_inline_without_concurrency():
+    threads = set()
+
+    def remember_thread(x):
+        threads.add(threading.current_thread())
+        return x
+
+    with RowExecutor() as executor:
+        assert list(executor.imap(remember_thread, range(5))) == list(range(5))
+    assert threads == {threading.current_thread()}
+
+
+@pytest.mark.parametrize("max_concurrency", [1, 4])
+def test_imap_stops_on_first_error(max_concurrency):
+    processed = []
+
+    def fail_on_three(x):
+        if x == 3:
+            raise ValueError("boom")
+        processed.append(x)
+        return x
+
+    results = []
+    with pytest.raises(ValueError):
+        with RowExecutor(max_concurrency) as executor:
+            for res in executor.imap(fail_on_three, range(1000)):
+                results.append(res)
+    assert results == [0, 1, 2]
+    # only the rows already in flight could have been processed
+    assert len(processed) < 3 + 2 * max_concurrency
+
+
+def test_invalid_concurrency():
+    with pytest.raises(ValueError):
+        RowExecutor(0)
+
+
+def test_coalescer_calls_once_per_key():
+    calls = []
+
+    def send(payload):
+        time.sleep(random.random() / 100)
+        calls.append(payload)
+        if payload == 'bad':
+            raise ValueError(payload)
+        return payload.upper()
+
+    coalesce = Coalescer(send)
+    payloads = ['a', 'b', 'a', 'a', 'c', 'b'] * 5
+
+    with RowExecutor(max_concurrency=4) as executor:
+        result = list(executor.imap(lambda p: coalesce(p, p), payloads))
+    assert result == [p.upper() for p in payloads]
+    assert sorted(calls) == ['a', 'b', 'c']
+    assert (coalesce.calls, coalesce.saved) == (3, 27)
+
+    # the duplicates fail the same way
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            coalesce('bad', 'bad')
+    assert calls.count('bad') == 1
+
+
+def test_imap_serializes_items_with_the_same_key():
+    finished = []
+    lock = threading.Lock()
+
+    def work(item):
+        name, delay = item
+        time.sleep(delay)
+        with lock:
+            finished.append(name)
+        return name
+
+    # the first a is the slowest, the later ones mustn't overtake it
+    items = [('a1', 0.05), ('b1', 0.0), ('a2', 0.0), ('a3', 0.01), ('b2', 0.0)]
+    with RowExecutor(max_concurrency=4) as executor:
+        results = list(executor.imap(work, items, key=lambda item: item[0][0]))
+    assert results == ['a1', 'b1', 'a2', 'a3', 'b2']
+    assert [name for name in finished if name.startswith('a')] == ['a1', 'a2', 'a3']
+    assert finished.index('b1') < finished.index('a1')
+
+
+def test_imap_stops_the_chain_of_a_failed_key():
+    started = []
+
+    def work(item):
+        started.append(item)
+        if item == 0:
+            time.sleep(0.05)
+            raise ValueError("first put failed")
+        return item
+
+    with pytest.raises(ValueError):
+        with RowExecutor(max_concurrency=4) as executor:
+            list(executor.imap(work, range(8), key=lambda item: 'a1'))
+    assert started == [0]
@@ -0,0 +1,111 @@
+import csv
+import json
+from pathlib import Path
+import pytest
+import requests
+import ttdwr.writer
+from ttdwr.exceptions import UserError
+from ttdwr.flatpayload import compile_builder, parse_column, payload_header
+from ttdwr.preflight import validate_table
+
+
+HEADER = ['my_id', 'payload.CampaignName', 'payload.Budget.Amount:float',
+          'payload.Budget.CurrencyCode', 'payload.RTBAttributes.BudgetSettings.DailyBudget:auto',
+          'payload.Tags[1]', 'payload.Tags[0]', 'payload.Active:bool',
+          'payload.Ids:json', 'payload.Code']
+
+
+def test_building_nested_payloads():
+    build = compile_builder(HEADER)
+    row = dict(zip(HEADER, ['m1', 'Camp', '100', 'USD', '12.5', 'b', 'a',
+                            'true', '["x", "y"]', '007']))
+    assert build(row) == {
+        'CampaignName': 'Camp',
+        'Budget': {'Amount': 100.0, 'CurrencyCode': 'USD'},
+        'RTBAttributes': {'BudgetSettings': {'DailyBudget': 12.5}},
+        'Tags': ['a', 'b'],
+        'Active': True,
+        'Ids': ['x', 'y'],
+        'Code': '007',
+    }
+    # empty values are left out, with the objects which end up empty
+    row = dict(zip(HEADER, ['m2', 'Camp', '', '', '', '', 'a', '', '', '']))
+    assert build(row) == {'CampaignName': 'Camp', 'Tags': ['a']}
+    assert build.apply(row) == {'my_id': 'm2',
+                                'payload': '{"CampaignName":"Camp","Tags":["a"]}'}
+
+
+def test_conversions():
+    header = ['payload.AdGroupId', 'payload.Auto:auto', 'payload.Float:float',
+              'payload.Ids:json']
+    build = compile_builder(header)
+    row = dict(zip(header, ['1234567', '12', '', '']))
+    # the ids stay strings unless asked otherwise
+    assert build(row) == {'AdGroupId': '1234567', 'Auto': 12}
+    for value, expected in (('1.5', 1.5), ('true', True), ('null', None),
+                            ('007', '007'), ('1.50', '1.50'), ('12e4567', '12e4567'),
+                            ('NaN', 'NaN'), ('abc', 'abc')):
+        assert build(dict(row, **{'payload.Auto:auto': value}))['Auto'] == expected
+    for column, value in (('payload.Float:float', 'inf'),
+                          ('payload.Float:float', '1e999'),
+                          ('payload.Ids:json', '[NaN]')):
+        with pytest.raises(UserError, match=column):
+            build(dict(row, **{column: value}))
+
+
+def test_compile_errors():
+    assert parse_column('payload.A[2].B')[0] == ('A', 2, 'B')
+    assert compile_builder(['payload', 'my_id']) is None
+    for header in (['payload.A:decimal'], ['payload.A..B'], ['payload.[0]'],
+                   ['payload.A', 'payload.A.B'], ['payload.A[0]', 'payload.A.B'],
+                   ['payload', 'payload.A']):
+        with pytest.raises(UserError):
+            compile_builder(header)
+    with pytest.raises(UserError, match="payload.N:int"):
+        compile_builder(['payload.N:int'])({'payload.N:int': 'x'})
+    assert payload_header(['a', 'payload.X', 'b', 'payload.Y']) == ['a', 'payload', 'b']
+
+
+def test_putting_flattened_adgroups(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = tmpdir.mkdir('out').mkdir('tables')
+    put = intables.join(ttdwr.writer.FNAME_PUT_ADGROUPS)
+    put.write('OrderItemNumber,AdGroupId,payload.AdGroupId,payload.RTBAttributes.BudgetSettings.Budget.Amount:float\n'
+              'o1,a1,a1,10.5\n'
+              'o2,a2,a2,\n')
+    sent = []
+
+    class MockClient:
+        def request_raw(self, method, endpoint, body):
+            sent.append(json.loads(body))
+            resp = requests.Response()
+            resp._content = b'{}'
+            return resp
+
+    outpath = ttdwr.writer.put_adgroups(MockClient(), Path(put.strpath),
+                                        Path(outtables.strpath))
+    assert sent == [
+        {'AdGroupId': 'a1',
+         'RTBAttributes': {'BudgetSettings': {'Budget': {'Amount': 10.5}}}},
+        {'AdGroupId': 'a2'}]
+    with open(str(outpath)) as f:
+        rdr = csv.DictReader(f)
+        assert rdr.fieldnames == ['OrderItemNumber', 'AdGroupId', 'payload', 'response']
+        assert json.loads(next(rdr)['payload']) == sent[0]
+
+
+def test_preflight_checks_the_built_payloads(tmpdir):
+    table = tmpdir.join('create_campaigns.csv')
+    table.write('dummy_campaign_id,payload.CampaignName,payload.Budget.Amount:float\n'
+                'd1,c1,10\n'
+                'd2,,11\n'
+                'd3,c3,lots\n')
+    errors, ids = validate_table(table.strpath,
+                                 required_columns=('payload', 'dummy_campaign_id'),
+                                 required_keys=('CampaignName',),
+                                 id_column='dummy_campaign_id')
+    assert [(err.row, err.column) for err in errors] == [
+        (3, 'payload'), (4, 'payload.Budget.Amount:float')]
+    assert errors[0].error == "Missing key 'CampaignName'"
+    assert errors[1].error.startswith("Invalid value in column")
+    assert [value for _, value in ids] == ['d1', 'd2', 'd3']
@@ -0,0 +1,130 @@
+import csv
+import json
+from pathlib import Path
+import pytest
+import requests
+import ttdwr.writer
+from benchmarks.mock_ttd import MockTTDServer
+from ttdwr.journal import (Journal, NullJournal, input_fingerprint, load_state,
+                           save_state, summary)
+
+
+def test_keys_distinguish_duplicate_payloads():
+    journal = Journal()
+    rows = [{'payload': 'a'}, {'payload': 'b'}, {'payload': 'a'}]
+    keys = [key for key, row in journal.keyed('action', rows)]
+    assert len(set(keys)) == 3
+    # deterministic across runs
+    assert keys == [key for key, row in Journal().keyed('action', rows)]
+    # but different for different actions
+    assert keys[0] != next(journal.keyed('other_action', rows))[0]
+
+
+def test_state_roundtrip(tmpdir):
+    datadir = Path(tmpdir.strpath)
+    assert load_state(datadir) == {}
+    journal = Journal()
+    journal.record('key', {'CampaignId': 'c1'})
+    state = journal.to_state({'something': 'else'})
+    save_state(datadir, state)
+    (datadir / 'in').mkdir()
+    (datadir / 'out/state.json').rename(datadir / 'in/state.json')
+
+    restored = Journal.from_state(load_state(datadir))
+    assert restored.get('key') == {'CampaignId': 'c1'}
+    assert restored.skipped == 1
+
+
+def test_null_journal_remembers_nothing():
+    journal = NullJournal()
+    journal.record('key', 'value')
+    assert journal.get('key') is None
+    assert len(journal) == 0
+
+
+def test_resuming_put_adgroups(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = Path(tmpdir.mkdir('out').mkdir('tables').strpath)
+    put = intables.join(ttdwr.writer.FNAME_PUT_ADGROUPS)
+    put.write('payload,OrderItemNumber,AdGroupId\n' + ''.join(
+        '"{{""AdGroupId"": ""a{0}""}}",o{0},a{0}\n'.format(i) for i in range(6)))
+
+    class FlakyClient:
+        def __init__(self, fail_on):
+            self.fail_on = fail_on
+            self.sent = []
+
+        def request_raw(self, method, endpoint, body):
+            adgroup_id = json.loads(body)['AdGroupId']
+            if adgroup_id == self.fail_on:
+                raise RuntimeError("connection reset")
+            self.sent.append(adgroup_id)
+            resp = requests.Response()
+            resp._content = json.dumps(
+                {"AdGroupId": adgroup_id, "Version": 2}).encode()
+            return resp
+
+    journal = Journal()
+    client = FlakyClient(fail_on='a3')
+    with pytest.raises(RuntimeError):
+        ttdwr.writer.put_adgroups(client, Path(put.strpath), outtables,
+                                  journal=journal)
+    assert client.sent == ['a0', 'a1', 'a2']
+
+    client = FlakyClient(fail_on=None)
+    ttdwr.writer.put_adgroups(client, Path(put.strpath), outtables,
+                              journal=Journal.from_state(journal.to_state({})))
+    assert client.sent == ['a3', 'a4', 'a5']
+    with open(str(outtables / 'put_adgroups.csv')) as f:
+        rows = list(csv.DictReader(f))
+    assert [json.loads(row['response'])['AdGroupId'] for row in rows] == [
+        'a{}'.format(i) for i in range(6)]
+
+
+def test_journal_is_tied_to_the_input_tables(tmpdir):
+    table = tmpdir.join('put_adgroups.csv')
+    table.write('payload\n"{}"\n')
+    fingerprint = input_fingerprint([table.strpath])
+    journal = Journal(fingerprint=fingerprint)
+    journal.record('key', summary({'AdGroupId': 'a1', 'Big': 'x' * 100}, 'AdGroupId'))
+    state = journal.to_state({})
+
+    assert Journal.from_state(state, fingerprint).get('key') == {'AdGroupId': 'a1'}
+    table.write('payload\n"{}"\n"{}"\n')
+    assert Journal.from_state(state, input_fingerprint([table.strpath])).get('key') is None
+    assert Journal.clear_state(state) == {}
+
+
+def test_resume_state_is_cleared_after_a_complete_run(tmpdir):
+    datadir = Path(tmpdir.strpath)
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    tmpdir.mkdir('out').mkdir('tables')
+    intables.join(ttdwr.writer.FNAME_PUT_ADGROUPS).write(
+        'OrderItemNumber,AdGroupId,payload\n'
+        '1,a1,"{""AdGroupId"": ""a1"", ""AdGroupName"": ""n1""}"\n'
+        '2,a2,"{""AdGroupId"": ""a2"", ""AdGroupName"": ""n2""}"\n')
+
+    with MockTTDServer() as server:
+        params = {'login': 'foo', '#password': 'bar', 'resume': True,
+                  'base_url': server.base_url, 'max_requests_per_second': 1000}
+        ttdwr.writer.main(params, tmpdir.strpath)
+        with open(str(datadir / 'out/state.json')) as f:
+            assert 'journal' not in json.load(f)
+
+        # the next night, the same table is put again
+        (datadir / 'out/state.json').rename(datadir / 'in/state.json')
+        ttdwr.writer.main(params, tmpdir.strpath)
+        assert server.requests[('PUT', '/v3/adgroup')] == 4
+
+        # a failed row keeps the journal, with just the ids
+        server.adgroups.clear()
+        (datadir / 'out/state.json').rename(datadir / 'in/state.json')
+        server.routes = dict(server.routes)
+        server.routes[('PUT', '/adgroup')] = (
+            lambda srv, payload: None if payload['AdGroupId'] == 'a2'
+            else dict(payload, Version=2))
+        ttdwr.writer.main(dict(params, do_not_fail=True), tmpdir.strpath)
+        with open(str(datadir / 'out/state.json')) as f:
+            entries = json.load(f)['journal']['entries']
+        assert [json.loads(entry) for entry in entries.values()] == [
+            {'AdGroupId': 'a1', 'Version': 2}]
@@ -5,7 +5,10 @@ Test concerning
 """
 
 
+import gzip
 import re
+import threading
+import time
 import csv
 import json
 from collections import namedtuple
@@ -14,6 +17,7 @@ import requests
 import pytest
 import logging
 from ttdwr.client import KBCTTDClient
+from ttdwr.requestlog import CsvRequestLog, shrink_body
 
 
 def test_csv_quoting():
@@ -41,6 +45,8 @@ def test_logging_into_csv_and_stdout(tmpdir, caplog):
     resp.request.method = b'methodyy'
     resp.text = 'bodyyy'
     client.log_response(resp)
+    # the log is written in a background thread
+    client.flush_log()
 
     # logging to csv file
     # there should be one record
@@ -67,6 +73,7 @@ def test_every__request_is_logged(tmpdir):
     client.token = 'fake'
     url = 'https://httpbin.org/post'
     resp = client._request("POST", url, json={'foo':'bar'})
+    client.flush_log()
     log_content = log.read()
     rdr = csv.DictReader(StringIO(log.read()), fieldnames=client.csv_log_header)
     line = next(rdr)
@@ -74,3 +81,91 @@ def test_every__request_is_logged(tmpdir):
     assert line['http_status'] == '200'
     with pytest.raises(StopIteration):
         next(rdr)
+
+
+def test_concurrent_logging_writes_valid_csv(tmpdir):
+    log = tmpdir.join('sample_log.csv')
+    client = KBCTTDClient(login='foo', password='bar', path_csv_log=log.strpath)
+
+    class Resp:
+        pass
+
+    def log_many(worker):
+        for i in range(200):
+            resp = Resp()
+            resp.url = 'url_{}_{}'.format(worker, i)
+            resp.status_code = 200
+            resp.request = Resp()
+            resp.request.body = b'{"multi": "line,\n body"}'
+            resp.request.method = 'POST'
+            resp.text = '{"quoted": "\"text\""}'
+            client.log_response(resp)
+
+    threads = [threading.Thread(target=log_many, args=(w,)) for w in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    client.close_log()
+
+    with open(log.strpath, newline='') as f:
+        lines = list(csv.DictReader(f, fieldnames=client.csv_log_header))
+    assert len(lines) == 800
+    assert len({line['url'] for line in lines}) == 800
+    assert all(line['request'] == '{"multi": "line,\n body"}' for line in lines)
+    assert len({line['pk'] for line in lines}) == 800
+
+
+def test_shrinking_bodies():
+    body = '{"AdGroupName": "' + 'x' * 100 + '"}'
+    assert shrink_body(body, 'full') == body
+    truncated = shrink_body(body, 'truncate', max_bytes=10)
+    assert truncated.startswith('{"AdGroupN...')
+    assert '119 bytes total' in truncated
+    assert shrink_body('short', 'truncate', max_bytes=10) == 'short'
+    assert shrink_body(body, 'hash').startswith('md5:')
+
+
+def test_sliced_compressed_log(tmpdir, capsys):
+    log_dir = tmpdir.join('ttd_writer_log.csv')
+    log = CsvRequestLog(log_dir.strpath, name='cdc', stdout='summary',
+                        compress=True, slice_rows=4, body_mode='hash')
+    for i in range(10):
+        log.log(500 if i == 7 else 200, 'POST', 'url_{}'.format(i),
+                b'{"big": "payload"}', 'response')
+    log.close()
+
+    slices = sorted(log_dir.listdir())
+    assert [s.basename for s in slices] == [
+        'part_00001.csv.gz', 'part_00002.csv.gz', 'part_00003.csv.gz']
+    lines = []
+    for part in slices:
+        with gzip.open(part.strpath, 'rt', newline='') as f:
+            lines.extend(csv.DictReader(f, fieldnames=CsvRequestLog.header))
+    assert [line['url'] for line in lines] == ['url_{}'.format(i) for i in range(10)]
+    assert lines[0]['request'].startswith('md5:')
+    # only the error made it to stdout
+    out = capsys.readouterr().out
+    assert 'url_7' in out and 'url_6' not in out
+
+
+def test_log_is_written_in_large_chunks(tmpdir):
+    path = tmpdir.join('log.csv')
+    log = CsvRequestLog(path.strpath, name='cdc', stdout='none')
+    for i in range(10):
+        log.log(200, 'GET', 'url_{}'.format(i), None, 'response')
+    time.sleep(0.1)
+    # still in the buffer
+    assert path.read() == ''
+    log.flush()
+    assert len(path.readlines()) == 10
+    log.close()
+
+
+def test_unwritable_log_doesnt_block(tmpdir):
+    path = tmpdir.join('no_such_dir', 'log.csv')
+    log = CsvRequestLog(path.strpath, name='cdc', stdout='none')
+    log.log(200, 'GET', 'url', None, 'response')
+    log.flush()
+    assert log.write_errors >= 1
+    log.close()
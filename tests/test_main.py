@@ -1,16 +1,40 @@
+import csv
+import json
+import random
+import time
 import pytest
 import logging
-from ttdwr.writer import main, create_campaigns_and_adgroups
+import requests
+from ttdwr.writer import main, create_campaigns_and_adgroups, Shard
 from pathlib import Path
+from ttdapi.exceptions import TTDApiError
+
+
+class RawApi:
+    """`request_raw` served by `create_campaign` and `create_adgroup`"""
+    def request_raw(self, method, endpoint, body):
+        self.sent = getattr(self, 'sent', [])
+        self.sent.append((endpoint, body))
+        payload = json.loads(body)
+        if endpoint == '/campaign':
+            created = self.create_campaign(payload)
+        else:
+            created = self.create_adgroup(payload)
+        resp = requests.Response()
+        resp.status_code = 200
+        resp._content = json.dumps(created).encode()
+        return resp
+
 
 def test_creating_campaigns_and_adgroups(tmpdir, create_campaigns_adgroups_csvs):
     path_campaigns, path_adgroups = create_campaigns_adgroups_csvs
 
-    class MockClient:
+    class MockClient(RawApi):
         def __init__(self):
             self.adgroup_ids = iter(["a{}".format(i) for i in range(10)])
         def create_campaign(self, payload):
-            return {"CampaignId": "real_campaign"}
+            return {"CampaignId": "real_campaign", "Version": 1,
+                    "Budget": {"Amount": 100}}
         def create_adgroup(self, payload):
             return {
                 "CampaignId": payload["CampaignId"],
@@ -19,11 +43,147 @@ def test_creating_campaigns_and_adgroups(tmpdir, create_campaigns_adgroups_csvs)
 
 
     client = MockClient()
-    campaign, adgroups = create_campaigns_and_adgroups(
+    outtables = Path(tmpdir.mkdir('out').mkdir('tables').strpath)
+    campaign, n_adgroups = create_campaigns_and_adgroups(
         client,
         path_campaigns,
-        path_adgroups)
+        path_adgroups,
+        outdir=outtables)
     assert campaign['CampaignId']
+    with open(str(outtables / 'create_adgroups.csv')) as f:
+        adgroups = list(csv.DictReader(f))
+    assert len(adgroups) == n_adgroups
     for i, adgrp in enumerate(adgroups):
         assert adgrp['AdGroupId'] == 'a{}'.format(i)
+        assert adgrp['CampaignId'] == 'real_campaign'
+        # the input columns without the payload
+        assert adgrp['sf_OrderNumber']
+        assert 'payload' not in adgrp
+    with open(str(outtables / 'create_campaigns.csv')) as f:
+        campaigns = list(csv.DictReader(f))
+    # the whole response, not just the ids kept for resuming
+    assert json.loads(campaigns[0]['response'])['Budget'] == {"Amount": 100}
+    # the campaign payloads are sent verbatim
+    with open(str(path_campaigns)) as f:
+        payloads = [row['payload'] for row in csv.DictReader(f)]
+    assert [body for endpoint, body in client.sent
+            if endpoint == '/campaign'] == payloads
+
+
+
+def _write_campaigns_and_adgroups(intables, n_campaigns, n_adgroups):
+    camps = intables.join('create_campaigns.csv')
+    camps.write('dummy_campaign_id,payload\n' + ''.join(
+        'd{0},"{{""CampaignName"": ""c{0}""}}"\n'.format(c)
+        for c in range(n_campaigns)))
+    adgrps = intables.join('create_adgroups.csv')
+    adgrps.write('dummy_campaign_id,payload\n' + ''.join(
+        'd{0},"{{""AdGroupName"": ""c{0}_a{1}"", ""CampaignId"": null}}"\n'.format(c, a)
+        for a in range(n_adgroups)
+        for c in range(n_campaigns)))
+    return Path(camps.strpath), Path(adgrps.strpath)
+
+
+@pytest.mark.parametrize("group_on_disk", [False, True])
+def test_creating_campaigns_and_adgroups_concurrently(tmpdir, group_on_disk):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = Path(tmpdir.mkdir('out').mkdir('tables').strpath)
+    path_campaigns, path_adgroups = _write_campaigns_and_adgroups(intables, 6, 4)
+
+    class MockClient(RawApi):
+        def create_campaign(self, payload):
+            time.sleep(random.random() / 50)
+            return {"CampaignId": "real_" + payload["CampaignName"]}
+        def create_adgroup(self, payload):
+            time.sleep(random.random() / 50)
+            return {
+                "CampaignId": payload["CampaignId"],
+                "AdGroupId": payload["AdGroupName"]
+            }
+
+    campaign, n_adgroups = create_campaigns_and_adgroups(
+        MockClient(),
+        path_campaigns,
+        path_adgroups,
+        outdir=outtables,
+        max_concurrency=4,
+        group_on_disk=group_on_disk)
+
+    assert n_adgroups == 24
+    with open(str(outtables / 'create_adgroups.csv')) as f:
+        adgroups = list(csv.DictReader(f))
+    assert len(adgroups) == 24
+    for adgrp in adgroups:
+        campaign_name = adgrp['AdGroupId'].split('_')[0]
+        assert adgrp['CampaignId'] == 'real_' + campaign_name
+
+    with open(str(outtables / 'campaign_id_mapping.csv')) as f:
+        mapping = list(csv.DictReader(f))
+    assert mapping == [
+        {'dummy_campaign_id': 'd{}'.format(c), 'CampaignId': 'real_c{}'.format(c)}
+        for c in range(6)]
+
+
+def test_sharding_keeps_campaigns_with_their_adgroups(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = Path(tmpdir.mkdir('out').mkdir('tables').strpath)
+    path_campaigns, path_adgroups = _write_campaigns_and_adgroups(intables, 10, 3)
+
+    class MockClient(RawApi):
+        def create_campaign(self, payload):
+            return {"CampaignId": "real_" + payload["CampaignName"]}
+        def create_adgroup(self, payload):
+            return {
+                "CampaignId": payload["CampaignId"],
+                "AdGroupId": payload["AdGroupName"]
+            }
+
+    created = []
+    for index in range(2):
+        create_campaigns_and_adgroups(
+            MockClient(), path_campaigns, path_adgroups, outdir=outtables,
+            shard=Shard(index, 2))
+        path_slice = outtables / 'create_adgroups.csv/part_{:05d}_of_00002.csv'.format(index)
+        with open(str(path_slice)) as f:
+            adgroups = list(csv.DictReader(
+                f, fieldnames=['dummy_campaign_id', 'CampaignId', 'AdGroupId', 'response']))
+        for adgrp in adgroups:
+            campaign_name = adgrp['AdGroupId'].split('_')[0]
+            assert adgrp['CampaignId'] == 'real_' + campaign_name
+        created.extend(adgrp['AdGroupId'] for adgrp in adgroups)
+    assert len(created) == len(set(created)) == 30
+
+
+@pytest.mark.parametrize("group_on_disk", [False, True])
+def test_adgroups_of_a_failed_campaign_are_written_out(tmpdir, group_on_disk):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = Path(tmpdir.mkdir('out').mkdir('tables').strpath)
+    path_campaigns, path_adgroups = _write_campaigns_and_adgroups(intables, 3, 2)
+
+    class MockClient(RawApi):
+        def create_campaign(self, payload):
+            if payload["CampaignName"] == 'c1':
+                resp = requests.Response()
+                resp.status_code = 400
+                resp._content = b'{"Message": "Invalid budget"}'
+                raise TTDApiError(response=resp)
+            return {"CampaignId": "real_" + payload["CampaignName"]}
+        def create_adgroup(self, payload):
+            return {
+                "CampaignId": payload["CampaignId"],
+                "AdGroupId": payload["AdGroupName"]
+            }
+
+    campaign, n_adgroups = create_campaigns_and_adgroups(
+        MockClient(), path_campaigns, path_adgroups, outdir=outtables,
+        max_concurrency=2, do_not_fail=True, group_on_disk=group_on_disk)
 
+    assert n_adgroups == 4
+    with open(str(outtables / 'create_adgroups.csv')) as f:
+        adgroups = list(csv.DictReader(f))
+    assert [adgrp['dummy_campaign_id'] for adgrp in adgroups] == [
+        'd0', 'd0', 'd1', 'd1', 'd2', 'd2']
+    for adgrp in adgroups[2:4]:
+        assert adgrp['CampaignId'] == adgrp['AdGroupId'] == ''
+        assert "campaign 'd1' failed" in adgrp['response']
+        assert 'Invalid budget' in adgrp['response']
@@ -0,0 +1,57 @@
+import logging
+from ttdwr.metrics import Histogram, Metrics
+
+
+def test_percentiles_are_within_five_percent():
+    hist = Histogram()
+    for ms in range(1, 1001):
+        hist.add(ms / 1000)
+    assert hist.count == 1000
+    assert abs(hist.percentile(50) - 0.5) <= 0.5 * 0.05
+    assert abs(hist.percentile(99) - 0.99) <= 0.99 * 0.05
+    assert hist.percentile(100) == hist.max == 1.0
+
+
+def test_timings_are_kept_per_endpoint_and_status():
+    now = [0.0]
+    metrics = Metrics(clock=lambda: now[0])
+    for status in (200, 200, 429):
+        with metrics.timer('http', 'adgroup', status):
+            now[0] += 0.1
+    metrics.retry('adgroup')
+
+    rows = {(row['phase'], row['endpoint'], row['status']): row
+            for row in metrics.snapshot()}
+    assert rows[('http', 'adgroup', '200')]['count'] == 2
+    assert rows[('http', 'adgroup', '200')]['p50_ms'] >= 95
+    assert rows[('http', 'adgroup', '429')]['count'] == 1
+    assert rows[('retry', 'adgroup', '')]['count'] == 1
+    assert set(rows[('http', 'adgroup', '429')]) == set(Metrics.columns)
+
+
+def test_timing_an_iterable():
+    now = [0.0]
+    metrics = Metrics(clock=lambda: now[0])
+
+    def rows():
+        for i in range(3):
+            now[0] += 0.01
+            yield i
+
+    assert list(metrics.timed('csv_parse', rows())) == [0, 1, 2]
+    row, = metrics.snapshot()
+    assert row['count'] == 3
+    assert row['total_s'] == 0.03
+
+
+def test_progress_is_logged_now_and_then(caplog):
+    now = [0.0]
+    metrics = Metrics(progress_interval=10, clock=lambda: now[0])
+    with caplog.at_level(logging.INFO, logger='ttdwr.metrics'):
+        for _ in range(100):
+            now[0] += 0.5
+            metrics.row_done('put_adgroups')
+    assert metrics.rows['put_adgroups'] == 100
+    progress = [rec.getMessage() for rec in caplog.records]
+    assert len(progress) == 5
+    assert progress[0] == "put_adgroups: 20 rows done, 2.0 rows/s"
@@ -0,0 +1,69 @@
+import csv
+import json
+import multiprocessing
+import os
+import random
+from pathlib import Path
+import pytest
+import ttdwr.writer
+from benchmarks.mock_ttd import MockTTDServer
+from benchmarks.bench_writer import (ACTIONS, _result_of_child,
+                                     _run_case_in_child, run_case)
+
+
+def test_writer_against_mock_api(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    tmpdir.mkdir('out').mkdir('tables')
+    intables.join(ttdwr.writer.FNAME_CLONE_CAMPAIGNS).write(
+        'payload,my_id\n' + ''.join(
+            '"{{""CampaignId"": ""c{0}""}}",my{0}\n'.format(i) for i in range(30)))
+
+    # the same requests get throttled every time
+    random.seed(3)
+    with MockTTDServer(throttle_rate=0.1, retry_after=0) as server:
+        ttdwr.writer.main({
+            'login': 'foo',
+            '#password': 'bar',
+            'base_url': server.base_url,
+            'max_concurrency': 4,
+            'max_requests_per_second': 1000,
+        }, tmpdir.strpath)
+
+    with open(str(Path(tmpdir.strpath) / 'out/tables/clone_campaigns.csv')) as f:
+        rows = list(csv.DictReader(f))
+    assert [row['my_id'] for row in rows] == ['my{}'.format(i) for i in range(30)]
+    assert all(json.loads(row['response'])['ReferenceId'] for row in rows)
+    # the throttled requests were retried
+    assert server.requests[('POST', '/v3/campaign/clone')] > 30
+
+    with open(str(Path(tmpdir.strpath) / 'out/tables/metrics.csv')) as f:
+        metrics = {(row['phase'], row['endpoint'], row['status']): row
+                   for row in csv.DictReader(f)}
+    assert int(metrics[('http', 'campaign/clone', '200')]['count']) == 30
+    assert int(metrics[('retry', 'campaign/clone', '')]['count']) == \
+        server.requests[('POST', '/v3/campaign/clone')] - 30
+    assert int(metrics[('output_write', '', '')]['count']) == 30
+
+
+@pytest.mark.parametrize('action', ACTIONS)
+def test_benchmark_smoke(action):
+    with MockTTDServer() as server:
+        result = run_case(action, 20, server.base_url, {'max_concurrency': 2})
+    assert result['rows'] == 20
+    assert result['requests'] >= 20
+    assert result['p99_ms'] >= result['p50_ms']
+
+
+def test_failed_benchmark_case_doesnt_hang():
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    child = ctx.Process(target=_run_case_in_child,
+                        args=(results, 'no_such_action', 1, 'http://127.0.0.1:1/', {}))
+    child.start()
+    with pytest.raises(RuntimeError, match="Don't know what action"):
+        _result_of_child(results, child, poll_seconds=0.1)
+
+    child = ctx.Process(target=os._exit, args=(3,))
+    child.start()
+    with pytest.raises(RuntimeError, match='exit code 3'):
+        _result_of_child(ctx.Queue(), child, poll_seconds=0.1)
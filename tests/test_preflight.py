@@ -0,0 +1,63 @@
+import csv
+from pathlib import Path
+import pytest
+import ttdwr.writer
+from ttdwr.exceptions import UserError
+from ttdwr.preflight import validate_table
+
+
+def test_preflight_reports_all_problems_at_once(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = Path(tmpdir.strpath) / 'out/tables'
+    intables.join(ttdwr.writer.FNAME_CAMPAIGNS).write(
+        'dummy_campaign_id,payload\n'
+        'd1,"{""CampaignName"": ""c1""}"\n'
+        'd1,"{""CampaignName"": ""c1 again""}"\n'
+        'd2,"{""NoName"": true}"\n')
+    intables.join(ttdwr.writer.FNAME_ADGROUPS).write(
+        'dummy_campaign_id,payload\n'
+        'd1,"{""AdGroupName"": ""a1""}"\n'
+        'd3,"{""AdGroupName"": ""a2""}"\n'
+        'd2,"{not json"\n')
+
+    with pytest.raises(UserError):
+        ttdwr.writer.decide_action(tmpdir.strpath, {'preflight': True})
+
+    with open(str(outtables / 'preflight_errors.csv')) as f:
+        errors = [(row['table'], row['row'], row['error'].split(':')[0])
+                  for row in csv.DictReader(f)]
+    assert errors == [
+        ('create_adgroups.csv', '3', "'d3' not found in create_campaigns.csv"),
+        ('create_adgroups.csv', '4', 'Invalid json'),
+        ('create_campaigns.csv', '2', "Duplicate value 'd1'"),
+        ('create_campaigns.csv', '3', "Duplicate value 'd1'"),
+        ('create_campaigns.csv', '4', "Missing key 'CampaignName'"),
+    ]
+
+
+def test_preflight_passes(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    intables.join(ttdwr.writer.FNAME_PUT_ADGROUPS).write(
+        'payload,OrderItemNumber,AdGroupId\n'
+        '"{""AdGroupId"": ""a1""}",o1,a1\n')
+    plan = ttdwr.writer.decide_action(tmpdir.strpath, {'preflight': True})
+    assert [action.func for action in plan.actions] == [ttdwr.writer.put_adgroups]
+
+
+def test_preflight_missing_columns(tmpdir):
+    put = tmpdir.join('put_adgroups.csv')
+    put.write('payload,AdGroupId\n"{}",a1\n')
+    errors, _ = validate_table(put.strpath,
+                               required_columns=('payload', 'OrderItemNumber'))
+    assert [(err.column, err.error) for err in errors] == [
+        ('OrderItemNumber', 'Missing column')]
+
+
+def test_preflight_in_parallel(tmpdir):
+    table = tmpdir.join('clone_campaigns.csv')
+    table.write('payload\n' + ''.join(
+        '"{{""CampaignId"": ""c{0}""}}"\n'.format(i) if i % 1000 else '"[]"\n'
+        for i in range(10000)))
+    errors, _ = validate_table(table.strpath, required_keys=('CampaignId',),
+                               workers=2, chunk_size=500)
+    assert [err.row for err in errors] == [i + 2 for i in range(0, 10000, 1000)]
@@ -0,0 +1,29 @@
+import pstats
+from pathlib import Path
+import ttdwr.writer
+from benchmarks.mock_ttd import MockTTDServer
+
+
+def test_profiling_a_sample_of_rows(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    tmpdir.mkdir('out').mkdir('tables')
+    intables.join(ttdwr.writer.FNAME_CLONE_CAMPAIGNS).write(
+        'payload,my_id\n' + ''.join(
+            '"{{""CampaignId"": ""c{0}""}}",my{0}\n'.format(i) for i in range(30)))
+
+    with MockTTDServer() as server:
+        ttdwr.writer.main({
+            'login': 'foo',
+            '#password': 'bar',
+            'base_url': server.base_url,
+            'max_concurrency': 4,
+            'profile': {'sample_rows': 5, 'top': 10}
+        }, tmpdir.strpath)
+
+    assert server.requests[('POST', '/v3/campaign/clone')] == 5
+    outfiles = Path(tmpdir.strpath) / 'out/files'
+    assert 'Ordered by: cumulative time' in (
+        outfiles / 'ttd_writer_profile.txt').read_text()
+    stats = pstats.Stats(str(outfiles / 'ttd_writer.prof'))
+    # the requests are made in the worker threads
+    assert 'request_raw' in {func for _, _, func in stats.stats}
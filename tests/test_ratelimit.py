@@ -0,0 +1,99 @@
+import threading
+import requests
+import pytest
+from ttdwr.ratelimit import AdaptiveRateLimiter, parse_retry_after
+from ttdwr.client import KBCTTDClient
+from ttdapi.client import TTDClient
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_enforces_rate():
+    clock = FakeClock()
+    limiter = AdaptiveRateLimiter(max_rate=5, burst=1, clock=clock, sleep=clock.sleep)
+    for _ in range(11):
+        limiter.acquire()
+    # first one is free (the bucket is full), the other 10 take 1/5s each
+    assert clock.now == pytest.approx(2.0)
+
+
+def test_throttling_backs_off_and_recovers():
+    clock = FakeClock()
+    limiter = AdaptiveRateLimiter(max_rate=10, additive_increase=1,
+                                  clock=clock, sleep=clock.sleep)
+    limiter.on_throttle(retry_after=3)
+    assert limiter.rate == 5
+    waited = limiter.acquire()
+    assert waited >= 3
+    for _ in range(10):
+        limiter.on_success()
+    assert limiter.rate == 10
+
+
+def test_limiter_is_thread_safe():
+    # the clock stands still so every token handed out is accounted for
+    limiter = AdaptiveRateLimiter(max_rate=100, burst=1, clock=lambda: 0.0,
+                                  sleep=lambda seconds: None)
+    threads = [threading.Thread(target=lambda: [limiter.acquire() for _ in range(25)])
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert limiter._tokens == pytest.approx(-99)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("7") == 7
+    assert parse_retry_after(None, default=5) == 5
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("garbage", default=1) == 1
+
+
+def test_client_retries_throttled_requests(monkeypatch):
+    calls = []
+
+    def fake_request(self, method, url, *args, **kwargs):
+        calls.append(url)
+        resp = requests.Response()
+        if len(calls) < 3:
+            resp.status_code = 429
+            resp.headers['Retry-After'] = '0'
+            raise requests.HTTPError(response=resp)
+        resp.status_code = 200
+        return resp
+
+    monkeypatch.setattr(TTDClient, '_request', fake_request)
+    client = KBCTTDClient(login='foo', password='bar', path_csv_log=None,
+                          max_requests_per_second=1000)
+    # prevent fetching a token
+    client.token = 'fake'
+    resp = client._request('POST', '/campaign')
+    assert resp.status_code == 200
+    assert len(calls) == 3
+    assert client.rate_limiter.rate < 1000
+
+
+def test_client_gives_up_after_max_throttled_retries(monkeypatch):
+    def fake_request(self, method, url, *args, **kwargs):
+        resp = requests.Response()
+        resp.status_code = 429
+        raise requests.HTTPError(response=resp)
+
+    monkeypatch.setattr(TTDClient, '_request', fake_request)
+    client = KBCTTDClient(login='foo', password='bar', path_csv_log=None,
+                          max_throttled_retries=2)
+    # prevent fetching a token
+    client.token = 'fake'
+    client.rate_limiter._sleep = lambda seconds: None
+    with pytest.raises(requests.HTTPError):
+        client._request('PUT', '/adgroup')
@@ -0,0 +1,110 @@
+import csv
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from ttdapi.client import TTDClient
+from ttdapi.exceptions import TTDApiError
+from ttdwr.client import KBCTTDClient
+from ttdwr.requestlog import CsvRequestLog
+from ttdwr.retry import RetryBudget, backoff_delay, is_retryable
+
+
+def _http_error(status):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.url = 'https://api/v3/adgroup'
+    resp.request = requests.Request('PUT', resp.url).prepare()
+    return TTDApiError(response=resp)
+
+
+def _refused():
+    reason = NewConnectionError(None, 'Connection refused')
+    return requests.ConnectionError(MaxRetryError(None, '/', reason))
+
+
+def test_classification():
+    assert is_retryable('PUT', _http_error(503))
+    assert is_retryable('GET', requests.ReadTimeout())
+    assert is_retryable('GET', requests.ConnectionError('Connection reset by peer'))
+    assert not is_retryable('PUT', _http_error(400))
+    # the campaign might have been created already
+    assert not is_retryable('POST', _http_error(504))
+    assert not is_retryable('POST', requests.ReadTimeout())
+    # but not if the request never left
+    assert is_retryable('POST', _refused())
+    assert is_retryable('POST', requests.ConnectTimeout())
+
+
+def test_backoff_is_jittered_and_capped():
+    assert backoff_delay(0, rand=lambda: 1) == 0.5
+    assert backoff_delay(3, rand=lambda: 0.5) == 2
+    assert backoff_delay(20, rand=lambda: 1) == 30
+    assert backoff_delay(20, rand=lambda: 0) == 0
+
+
+def test_budget():
+    budget = RetryBudget(2)
+    assert budget.spend() and budget.spend()
+    assert not budget.spend()
+    assert budget.remaining == 0
+
+
+def _client(monkeypatch, failures, **kwargs):
+    calls = []
+
+    def fake_request(self, method, url, *args, **kw):
+        calls.append(url)
+        if failures:
+            raise failures.pop(0)
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = url
+        resp.request = requests.Request(method, 'https://api' + url).prepare()
+        return resp
+
+    monkeypatch.setattr(TTDClient, '_request', fake_request)
+    client = KBCTTDClient(login='foo', password='bar', **kwargs)
+    # prevent fetching a token
+    client.token = 'fake'
+    client.sleeps = []
+    client._sleep = client.sleeps.append
+    return client, calls
+
+
+def test_transient_failures_are_retried_and_logged(monkeypatch, tmpdir):
+    log = tmpdir.join('log.csv')
+    failures = [_http_error(503), requests.ConnectionError('reset')]
+    client, calls = _client(monkeypatch, failures, path_csv_log=log.strpath)
+    resp = client._request('PUT', '/adgroup', data='{}')
+    assert resp.status_code == 200
+    assert len(calls) == 3
+    assert len(client.sleeps) == 2 and client.sleeps[1] <= 1
+    client.close_log()
+    with open(log.strpath, newline='') as f:
+        rows = list(csv.DictReader(f, fieldnames=CsvRequestLog.header))
+    assert [(row['http_status'], row['retries']) for row in rows] == [
+        ('503', '0'), ('error', '1'), ('200', '2')]
+
+
+def test_posts_are_not_repeated_when_they_might_have_been_processed(monkeypatch):
+    client, calls = _client(monkeypatch, [_refused(), _http_error(502)],
+                            path_csv_log=None)
+    with pytest.raises(TTDApiError):
+        client._request('POST', '/campaign', data='{}')
+    # refused is retried, the bad gateway is not
+    assert len(calls) == 2
+
+
+def test_attempts_and_budget_are_capped(monkeypatch):
+    client, calls = _client(monkeypatch, [_http_error(504)] * 10,
+                            path_csv_log=None, max_retries=3, retry_budget=5)
+    with pytest.raises(TTDApiError):
+        client._request('GET', '/adgroup/a1')
+    assert len(calls) == 4
+    # only two retries are left for the whole job
+    with pytest.raises(TTDApiError):
+        client._request('GET', '/adgroup/a2')
+    assert len(calls) == 7
+    with pytest.raises(TTDApiError):
+        client._request('GET', '/adgroup/a3')
+    assert len(calls) == 8
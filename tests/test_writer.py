@@ -1,21 +1,37 @@
+import csv
+import json
+import logging
+import random
+import time
+import pytest
+import requests
 import ttdwr.writer
+from ttdwr import jsonutil
+from ttdwr.adgroupstate import AdgroupStateCache
+from ttdwr.grouping import AdgroupIndex
+from ttdwr.plan import ExecutionPlan
+from ttdwr.requestlog import CsvRequestLog
+from functools import partial
+from ttdapi.exceptions import TTDApiError
 from pathlib import Path
 
 def test_deciding_action_creating_campaigns(tmpdir):
     intables = tmpdir.mkdir('in').mkdir('tables')
     camp = intables.join(ttdwr.writer.FNAME_CAMPAIGNS)
     camp.write("foo")
-    action = ttdwr.writer.decide_action(Path(tmpdir.strpath), {})
+    plan = ttdwr.writer.decide_action(Path(tmpdir.strpath), {})
 
-    # it's a partial
+    # it's a plan of partials
+    action, = plan.actions
     assert action.func == ttdwr.writer.create_campaigns
 
 def test_deciding_action_creating_adgroups(tmpdir):
     intables = tmpdir.mkdir('in').mkdir('tables')
     adg = intables.join(ttdwr.writer.FNAME_ADGROUPS)
     adg.write("foo")
-    action = ttdwr.writer.decide_action(Path(tmpdir.strpath), {})
-    # it's a partial
+    plan = ttdwr.writer.decide_action(Path(tmpdir.strpath), {})
+    # it's a plan of partials
+    action, = plan.actions
     assert action.func == ttdwr.writer.create_adgroups
 
 def test_deciding_actions_adgroups_and_campaigns(tmpdir):
@@ -25,11 +41,40 @@ def test_deciding_actions_adgroups_and_campaigns(tmpdir):
     camp = intables.join(ttdwr.writer.FNAME_CAMPAIGNS)
     camp.write("foo")
 
-    action = ttdwr.writer.decide_action(tmpdir.strpath, {})
+    plan = ttdwr.writer.decide_action(tmpdir.strpath, {})
 
-    # it's a partial
+    # it's a plan of partials
+    action, = plan.actions
     assert action.func == ttdwr.writer.create_campaigns_and_adgroups
 
+
+def test_deciding_actions_for_all_tables(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    for fname in (ttdwr.writer.FNAME_CAMPAIGNS, ttdwr.writer.FNAME_CLONE_CAMPAIGNS,
+                  ttdwr.writer.FNAME_PUT_ADGROUPS):
+        intables.join(fname).write("foo")
+
+    plan = ttdwr.writer.decide_action(tmpdir.strpath, {})
+
+    assert [[action.func for action in stage] for stage in plan.stages] == [
+        [ttdwr.writer.create_campaigns, ttdwr.writer.clone_campaigns],
+        [ttdwr.writer.put_adgroups]
+    ]
+
+
+def test_running_plan_stages_in_order():
+    calls = []
+
+    def action(name, client, journal):
+        time.sleep(random.random() / 100)
+        calls.append(name)
+
+    plan = ExecutionPlan([[partial(action, 'a'), partial(action, 'b')],
+                          [partial(action, 'c')]])
+    plan(client=None, journal=None)
+    assert sorted(calls[:2]) == ['a', 'b']
+    assert calls[2] == 'c'
+
 def test_grouping_related_adgroups():
     raw_data = [
         {
@@ -75,3 +120,268 @@ def test_grouping_related_adgroups():
 
     mapping = ttdwr.writer.group_adgroups_to_campaigns(raw_data)
     assert mapping == expected
+
+
+def test_grouping_related_adgroups_on_disk(tmpdir):
+    raw_data = [
+        {"dummy_campaign_id": "1", "payload": "a"},
+        {"dummy_campaign_id": "2", "payload": "b"},
+        {"dummy_campaign_id": "1", "payload": "c"},
+    ]
+    with AdgroupIndex(iter(raw_data), tmpdir=tmpdir.strpath) as index:
+        assert index["1"] == [raw_data[0], raw_data[2]]
+        assert index.get("2") == [raw_data[1]]
+        assert index.get("3", []) == []
+        assert "2" in index and "3" not in index
+    # the database is cleaned up
+    assert tmpdir.listdir() == []
+
+def test_cloning_campaigns_concurrently_keeps_order(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = tmpdir.mkdir('out').mkdir('tables')
+    clone = intables.join(ttdwr.writer.FNAME_CLONE_CAMPAIGNS)
+    clone.write('payload,my_id\n' + ''.join(
+        '"{{""CampaignId"": ""c{0}""}}",my{0}\n'.format(i) for i in range(50)))
+
+    class MockClient:
+        def request_raw(self, method, endpoint, body):
+            time.sleep(random.random() / 100)
+            resp = requests.Response()
+            resp._content = json.dumps(
+                {"ReferenceId": "ref_" + json.loads(body)["CampaignId"]}).encode()
+            return resp
+
+    outpath = ttdwr.writer.clone_campaigns(
+        MockClient(), Path(clone.strpath), Path(outtables.strpath),
+        max_concurrency=8)
+    with open(str(outpath)) as f:
+        rows = list(csv.DictReader(f))
+    assert [row['my_id'] for row in rows] == ['my{}'.format(i) for i in range(50)]
+    assert json.loads(rows[7]['response']) == {"ReferenceId": "ref_c7"}
+
+
+def test_payloads_are_sent_verbatim(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = tmpdir.mkdir('out').mkdir('tables')
+    put = intables.join(ttdwr.writer.FNAME_PUT_ADGROUPS)
+    payload = '{"AdGroupId":"a1",  "Description": NaN, "RTBAttributes": {"X": 1.50}}'
+    put.write('payload,OrderItemNumber,AdGroupId\n"{}",o1,a1\n'.format(
+        payload.replace('"', '""')))
+    sent = []
+    response_text = '{"AdGroupId": "a1",\n "Version": 3}'
+
+    class MockClient:
+        def request_raw(self, method, endpoint, body):
+            sent.append((method, endpoint, body))
+            resp = requests.Response()
+            resp._content = response_text.encode()
+            return resp
+
+    outpath = ttdwr.writer.put_adgroups(MockClient(), Path(put.strpath),
+                                        Path(outtables.strpath))
+    assert sent == [('PUT', '/adgroup', payload)]
+    with open(str(outpath)) as f:
+        assert next(csv.DictReader(f))['response'] == response_text
+
+
+def test_parsing_payloads_with_nan():
+    parsed = jsonutil.loads('{"Description": NaN, "Amount": 1.5}')
+    assert parsed['Amount'] == 1.5
+    assert parsed['Description'] != parsed['Description']
+
+
+def test_sharded_cloning_covers_every_row_once(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    clone = intables.join(ttdwr.writer.FNAME_CLONE_CAMPAIGNS)
+    clone.write('payload,my_id\n' + ''.join(
+        '"{{""CampaignId"": ""c{0}""}}",my{0}\n'.format(i) for i in range(50)))
+
+    class MockClient:
+        def request_raw(self, method, endpoint, body):
+            resp = requests.Response()
+            resp._content = b'{"ReferenceId": "ref"}'
+            return resp
+
+    seen = []
+    for index in range(3):
+        # every container has its own out dir
+        outtables = Path(tmpdir.mkdir('out{}'.format(index)).strpath)
+        outpath = ttdwr.writer.clone_campaigns(
+            MockClient(), Path(clone.strpath), outtables,
+            shard=ttdwr.writer.Shard(index, 3))
+        # a sliced table loaded incrementally
+        with open(str(outpath) + '.manifest') as f:
+            manifest = json.load(f)
+        assert manifest == {"columns": ['payload', 'my_id', 'response'],
+                            "incremental": True}
+        slice_, = outpath.iterdir()
+        assert slice_.name == 'part_{:05d}_of_00003.csv'.format(index)
+        with open(str(slice_)) as f:
+            rows = list(csv.DictReader(f, fieldnames=manifest['columns']))
+        assert rows
+        seen.extend(row['my_id'] for row in rows)
+    assert sorted(seen) == sorted('my{}'.format(i) for i in range(50))
+
+
+def test_shard_index_must_be_lower_than_count():
+    params = {"login": "l", "#password": "p", "base_url": "u",
+              "shard_index": 2, "shard_count": 2}
+    with pytest.raises(ttdwr.exceptions.TTDConfigError):
+        ttdwr.writer.validate_config(params)
+    params['shard_index'] = 1
+    assert ttdwr.writer.validate_config(params)['shard_count'] == 2
+
+
+def test_sharded_request_log_is_a_slice_of_an_incremental_table(tmpdir):
+    outdir = Path(tmpdir.strpath)
+    table = outdir / ttdwr.writer.FNAME_REQUEST_LOG
+    path, options = ttdwr.writer._request_log_setup(
+        {'gzip': True}, outdir, ttdwr.writer.Shard(1, 3))
+    assert path == table / 'part_00001_of_00003.csv.gz'
+    with open(str(table) + '.manifest') as f:
+        assert json.load(f)['incremental'] is True
+
+    path, options = ttdwr.writer._request_log_setup(
+        {'slice_rows': 2, 'stdout': 'none'}, outdir, ttdwr.writer.Shard(2, 3))
+    log = CsvRequestLog(str(path), name='cdc', **options)
+    for i in range(3):
+        log.log(200, 'GET', 'url_{}'.format(i), None, 'response')
+    log.close()
+    assert sorted(part.name for part in table.iterdir()) == [
+        'part_00002_of_00003_00001.csv', 'part_00002_of_00003_00002.csv']
+
+
+def test_putting_duplicate_payloads_once(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = tmpdir.mkdir('out').mkdir('tables')
+    put = intables.join(ttdwr.writer.FNAME_PUT_ADGROUPS)
+    put.write('OrderItemNumber,AdGroupId,payload\n' + ''.join(
+        '{0},a{1},"{{""AdGroupId"": ""a{1}""}}"\n'.format(i, i % 3)
+        for i in range(12)))
+
+    class MockClient:
+        def __init__(self):
+            self.sent = []
+        def request_raw(self, method, endpoint, body):
+            self.sent.append(body)
+            resp = requests.Response()
+            resp._content = json.dumps(
+                {"AdGroupId": json.loads(body)["AdGroupId"], "Version": 2}).encode()
+            return resp
+
+    client = MockClient()
+    outpath = ttdwr.writer.put_adgroups(
+        client, Path(put.strpath), Path(outtables.strpath),
+        max_concurrency=4, deduplicate=True)
+    assert len(client.sent) == 3
+    with open(str(outpath)) as f:
+        rows = list(csv.DictReader(f))
+    assert [row['OrderItemNumber'] for row in rows] == [str(i) for i in range(12)]
+    for row in rows:
+        assert json.loads(row['response'])['AdGroupId'] == row['AdGroupId']
+
+
+def test_created_adgroups_are_written_out(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = Path(tmpdir.mkdir('out').mkdir('tables').strpath)
+    adg = intables.join(ttdwr.writer.FNAME_ADGROUPS)
+    adg.write('order_item,payload\n' + ''.join(
+        'o{0},"{{""AdGroupName"": ""a{0}""}}"\n'.format(i) for i in range(20)))
+
+    class MockClient:
+        def request_raw(self, method, endpoint, body):
+            name = json.loads(body)["AdGroupName"]
+            resp = requests.Response()
+            if name == 'a13':
+                resp.status_code = 400
+                resp._content = b'{"Message": "Invalid"}'
+                raise TTDApiError(response=resp)
+            resp.status_code = 200
+            resp._content = json.dumps({"AdGroupId": "id_" + name}).encode()
+            return resp
+
+    ttdwr.writer.create_adgroups(MockClient(), Path(adg.strpath),
+                                 max_concurrency=4, do_not_fail=True,
+                                 outdir=outtables)
+    with open(str(outtables / 'create_adgroups.csv')) as f:
+        rows = list(csv.DictReader(f))
+    assert list(rows[0]) == ['order_item', 'AdGroupId', 'response']
+    assert [row['order_item'] for row in rows] == ['o{}'.format(i) for i in range(20)]
+    assert rows[2]['AdGroupId'] == 'id_a2'
+    assert rows[13]['AdGroupId'] == ''
+    assert json.loads(rows[13]['response']) == {"Message": "Invalid"}
+
+
+def test_concurrent_puts_of_one_adgroup_keep_their_order(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = tmpdir.mkdir('out').mkdir('tables')
+    put = intables.join(ttdwr.writer.FNAME_PUT_ADGROUPS)
+    put.write('payload,OrderItemNumber,AdGroupId\n' + ''.join(
+        '"{{""AdGroupId"": ""{0}"", ""AdGroupName"": ""n{1}""}}",o{1},{0}\n'.format(
+            'a1' if i % 3 else 'a2', i) for i in range(12)))
+    current = {}
+
+    class MockClient:
+        def request_raw(self, method, endpoint, body):
+            time.sleep(random.random() / 100)
+            adgroup = json.loads(body)
+            current[adgroup['AdGroupId']] = adgroup['AdGroupName']
+            resp = requests.Response()
+            resp._content = body.encode()
+            return resp
+
+    ttdwr.writer.put_adgroups(MockClient(), Path(put.strpath),
+                              Path(outtables.strpath), max_concurrency=4)
+    assert current == {'a1': 'n11', 'a2': 'n9'}
+
+
+def test_deduplicating_puts_keeps_the_last_payload(tmpdir, caplog):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = tmpdir.mkdir('out').mkdir('tables')
+    put = intables.join(ttdwr.writer.FNAME_PUT_ADGROUPS)
+    caplog.set_level(logging.INFO)
+    names = ['X', 'X', 'Y', 'X']
+    put.write('OrderItemNumber,AdGroupId,payload\n' + ''.join(
+        '{0},a1,"{{""AdGroupId"": ""a1"", ""AdGroupName"": ""{1}""}}"\n'.format(i, name)
+        for i, name in enumerate(names)))
+    sent = []
+
+    class MockClient:
+        def request_raw(self, method, endpoint, body):
+            sent.append(json.loads(body)['AdGroupName'])
+            resp = requests.Response()
+            resp._content = body.encode()
+            return resp
+
+    ttdwr.writer.put_adgroups(MockClient(), Path(put.strpath),
+                              Path(outtables.strpath), max_concurrency=4,
+                              deduplicate=True)
+    # only the immediate repeat is skipped
+    assert sent == ['X', 'Y', 'X']
+    assert 'sent 3 distinct payloads, saved 1 duplicate calls' in caplog.text
+
+
+def test_putting_changes_of_a_payload_without_adgroup_id(tmpdir):
+    intables = tmpdir.mkdir('in').mkdir('tables')
+    outtables = tmpdir.mkdir('out').mkdir('tables')
+    put = intables.join(ttdwr.writer.FNAME_PUT_ADGROUPS)
+    put.write('OrderItemNumber,AdGroupId,payload\n'
+              'o1,a1,"{""AdGroupName"": ""new"", ""IsEnabled"": true}"\n')
+    sent = []
+
+    class MockClient:
+        def request_raw(self, method, endpoint, body):
+            resp = requests.Response()
+            if method == 'GET':
+                resp._content = b'{"AdGroupId": "a1", "AdGroupName": "old", "IsEnabled": true}'
+            else:
+                sent.append(json.loads(body))
+                resp._content = b'{"AdGroupId": "a1", "Version": 2}'
+            return resp
+
+    outpath = ttdwr.writer.put_adgroups(
+        MockClient(), Path(put.strpath), Path(outtables.strpath),
+        adgroup_cache=AdgroupStateCache())
+    assert sent == [{"AdGroupId": "a1", "AdGroupName": "new"}]
+    with open(str(outpath)) as f:
+        assert next(csv.DictReader(f))['update_status'] == 'updated'
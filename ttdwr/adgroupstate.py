@@ -0,0 +1,100 @@
+"""
+Skip the adgroup updates which wouldn't change anything
+
+The current adgroups are fetched from the api and the desired ones are
+checked to be their subset: the nested objects are walked down to the
+leaves (lists and scalars), only the leaves which differ are sent, nested
+under their parents. Once an adgroup is known to match a payload (it was
+up to date or the payload was put), a digest of the payload is cached in
+the KBC state for `ttl` seconds. The next run within the ttl doesn't fetch
+the adgroup again if its payload is the same. A digest per adgroup keeps
+the state small however big the adgroups are.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY = 'adgroup_cache'
+
+
+def payload_digest(payload):
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf8')).hexdigest()[:16]
+
+
+def changed_fields(desired, current):
+    """The part of the `desired` adgroup which differs from the `current` one
+
+    The unchanged leaves are left out, the nested objects keep only what
+    changed in them. An empty object is a leaf too.
+    """
+    changes = {}
+    for key, value in desired.items():
+        current_value = current.get(key)
+        if isinstance(value, dict) and value and isinstance(current_value, dict):
+            nested = changed_fields(value, current_value)
+            if nested:
+                changes[key] = nested
+        elif key not in current or current_value != value:
+            changes[key] = value
+    return changes
+
+
+class AdgroupStateCache:
+    """A thread-safe {AdGroupId: payload digest} mapping with expiring entries"""
+    def __init__(self, entries=None, ttl=0, clock=time.time):
+        """
+        Args:
+            entries: {AdGroupId: [timestamp, payload digest]}
+            ttl: seconds an entry is valid, 0 disables caching between runs
+        """
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        now = clock()
+        self._entries = {
+            adgroup_id: entry
+            for adgroup_id, entry in (entries or {}).items()
+            if now - entry[0] < ttl
+        }
+        if self._entries:
+            logger.info("Loaded the cached state of %s adgroups",
+                        len(self._entries))
+
+    @classmethod
+    def from_state(cls, state, ttl=0, **kwargs):
+        return cls(state.get(STATE_KEY), ttl=ttl, **kwargs)
+
+    def to_state(self, state):
+        now = self._clock()
+        with self._lock:
+            state[STATE_KEY] = {
+                adgroup_id: entry
+                for adgroup_id, entry in self._entries.items()
+                if now - entry[0] < self.ttl
+            }
+        return state
+
+    def get(self, adgroup_id):
+        """Digest of the payload the adgroup matches, None if unknown or expired"""
+        with self._lock:
+            entry = self._entries.get(adgroup_id)
+        if entry is None:
+            return None
+        # what we fetch during this run is valid for the whole run
+        if self.ttl and self._clock() - entry[0] >= self.ttl:
+            return None
+        return entry[1]
+
+    def set(self, adgroup_id, payload):
+        """The adgroup matches the `payload` (up to date or put)"""
+        digest = payload_digest(payload)
+        with self._lock:
+            self._entries[adgroup_id] = [self._clock(), digest]
+
+    def __len__(self):
+        return len(self._entries)
@@ -2,64 +2,243 @@
 A wrapper around base client that logs every request to csv & stdout/err
 
 """
+import gzip
+import hashlib
 import logging
-from urllib.parse import urljoin
-from hashlib import md5
-import sys
+import threading
 import time
+from urllib.parse import urljoin, urlparse
 from io import StringIO
 import requests
+from requests.adapters import HTTPAdapter
 import csv
 
 from ttdwr.exceptions import TTDConfigError
+from ttdwr.metrics import (CONNECTION_REQUESTS, CONNECTIONS_OPENED, HTTP,
+                           RATE_LIMIT_WAIT, Metrics)
+from ttdwr.requestlog import CsvRequestLog
+from ttdwr.ratelimit import AdaptiveRateLimiter, parse_retry_after
+from ttdwr.retry import RetryBudget, backoff_delay, is_retryable, is_transient
 from ttdapi.client import TTDClient
-from ttdapi.exceptions import TTDClientError
+from ttdapi.exceptions import TTDApiError, TTDClientError
 
 logger = logging.getLogger(__name__)
 
+# KBC encrypts the state values under keys starting with '#'
+# KBC encrypts only the values whose own key starts with '#'
+STATE_KEY = 'auth'
+# log in again when the token is about to expire
+TOKEN_EXPIRY_MARGIN = 60
+
 
 class KBCTTDClient(TTDClient):
     """
     Client tailored for Keboola Connection
 
     Has helper methods for logging requests directly into csv
+    and keeps the request rate within what the api allows
+
+    The auth token is shared by all threads, when it expires only one of
+    them logs in again while the others wait. The token can be saved to
+    and restored from the KBC state to skip logging in on the next run.
     """
     def __init__(self, login, password, path_csv_log,
                  token_expires_in=90,
-                 base_url="https://apisb.thetradedesk.com/v3/"):
+                 base_url="https://apisb.thetradedesk.com/v3/",
+                 max_requests_per_second=10,
+                 max_throttled_retries=20,
+                 csv_log_options=None,
+                 metrics=None,
+                 pool_size=10,
+                 compress_min_bytes=None,
+                 max_retries=4,
+                 retry_budget=100,
+                 timeout=None):
         """
         Args:
             path_log: "/data/out/tables/tdd_writer_log.csv" will be a valid csv with all api calls logged
+                None disables the csv logging
+            max_requests_per_second: the rate limit shared by all threads using this client
+            max_throttled_retries: how many times a request answered with HTTP 429 is retried
+            csv_log_options: kwargs for `CsvRequestLog` (body_mode, compress, slice_rows...)
+            metrics: `Metrics` collecting the request timings
+            pool_size: how many connections to the api are kept open, should
+                be at least the number of threads making requests
+            compress_min_bytes: gzip the request bodies of `request_raw`
+                from this size on, None never compresses
+            max_retries: how many times a request failing with a transient
+                error (see `ttdwr.retry`) is retried
+            retry_budget: how many such retries are allowed in total
+            timeout: seconds to wait for the api to connect or respond,
+                None waits forever
         """
         super().__init__(login, password, token_expires_in=token_expires_in, base_url=base_url)
         self.path_csv_log = path_csv_log
-        self.cdc_logger = self.init_cdc_logging(path_csv_log)
-        # don't know how to hook this up to a context manager (we already have one)
+        if path_csv_log is not None:
+            self.cdc_logger = self.init_cdc_logging(path_csv_log,
+                                                    **(csv_log_options or {}))
+        else:
+            self.cdc_logger = None
+        self.rate_limiter = AdaptiveRateLimiter(max_rate=max_requests_per_second)
+        self.max_throttled_retries = max_throttled_retries
+        self.max_retries = max_retries
+        self.retry_budget = RetryBudget(retry_budget)
+        self.timeout = timeout
+        self._sleep = time.sleep
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._credentials = (login, password)
+        self._token_lock = threading.Lock()
+        # None means the token doesn't expire (e.g. when set by hand)
+        self.token_expires_at = None
+        self.compress_min_bytes = compress_min_bytes
+        self._adapter = self._configure_session(pool_size)
+
+    def _configure_session(self, pool_size):
+        """Keep up to `pool_size` connections alive for the concurrent requests
+
+        A thread which finds all the connections in use waits for one
+        instead of opening (and throwing away) an extra one.
+        """
+        session = getattr(self, 'session', None)
+        if session is None:
+            session = self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size,
+                              pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Connection'] = 'keep-alive'
+        return adapter
+
+    def pool_stats(self):
+        """{host: (connections opened, requests sent)}"""
+        stats = {}
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            opened, sent = stats.get(pool.host, (0, 0))
+            stats[pool.host] = (opened + pool.num_connections,
+                                sent + pool.num_requests)
+        return stats
+
+    def _record_pool_stats(self):
+        for host, (opened, sent) in self.pool_stats().items():
+            self.metrics.count(CONNECTIONS_OPENED, opened, host)
+            self.metrics.count(CONNECTION_REQUESTS, sent, host)
+            logger.info("%s connections to %s served %s requests",
+                        opened, host, sent)
+
+    def __enter__(self):
+        # log in only when needed, the token might have been restored
+        self.ensure_token()
+        return self
+
+    def _token_valid(self):
+        return self.token is not None and (
+            self.token_expires_at is None
+            or time.time() < self.token_expires_at - TOKEN_EXPIRY_MARGIN)
+
+    def ensure_token(self):
+        """Log in unless we already have a valid token, returns the token"""
+        with self._token_lock:
+            if not self._token_valid():
+                self._login()
+            return self.token
+
+    def _login(self):
+        login, password = self._credentials
+        logger.info("Logging in as %s", login)
+        resp = self.session.post(urljoin(self.base_url, 'authentication'), json={
+            'Login': login,
+            'Password': password,
+            'TokenExpirationInMinutes': self.token_expires_in,
+        })
+        resp.raise_for_status()
+        self.token = resp.json()['Token']
+        self.token_expires_at = time.time() + self.token_expires_in * 60
+
+    def invalidate_token(self, token):
+        """The api rejected `token`, the next `ensure_token` logs in again
+
+        Threads which already got a new token don't throw it away.
+        """
+        with self._token_lock:
+            if self.token == token:
+                self.token = None
+
+    def start_login(self):
+        """Log in in the background, while the input tables are being read"""
+        def _login_quietly():
+            try:
+                self.ensure_token()
+            except Exception:
+                # the first request will try again and raise
+                logger.debug("Logging in in the background failed", exc_info=True)
+        thread = threading.Thread(target=_login_quietly, daemon=True)
+        thread.start()
+        return thread
+
+    def _state_owner(self):
+        login, _ = self._credentials
+        return hashlib.sha1('{}\0{}'.format(login, self.base_url)
+                            .encode('utf8')).hexdigest()
+
+    def token_from_state(self, state):
+        """Reuse the token of a previous run if it's still valid
+
+        Returns:
+            True if the token was restored
+        """
+        saved = state.get(STATE_KEY) or {}
+        if saved.get('owner') != self._state_owner():
+            return False
+        with self._token_lock:
+            self.token = saved.get('#token')
+            self.token_expires_at = saved.get('expires_at', 0)
+            if not self._token_valid():
+                self.token = None
+                return False
+        logger.info("Reusing the auth token of a previous run")
+        return True
+
+    def token_to_state(self, state):
+        # the earlier runs kept the token unencrypted in '#auth'
+        state.pop('#auth', None)
+        with self._token_lock:
+            if self.token is not None and self.token_expires_at is not None:
+                state[STATE_KEY] = {
+                    'owner': self._state_owner(),
+                    '#token': self.token,
+                    'expires_at': self.token_expires_at,
+                }
+        return state
 
-    def init_cdc_logging(self, log_path):
+    def init_cdc_logging(self, log_path, **options):
         """
         We want to log every response to a csv and stdout/err
+
+        The writing happens in a background thread, see `CsvRequestLog`
         """
-        cdc_logger = logging.getLogger(__name__ + '_cdc')
-        cdc_logger.propagate = False
-        # all requests are logged in csv
-        self.csv_log_header = ["type","timestamp", "pk", "http_status", "method", "url",
-                               "request", "response"]
-        csv_formatter = logging.Formatter('%(name)s,%(asctime)s,%(pk)s,%(http_status)s,'
-                                          '%(method)s,%(url)s,%(request_body)s,%(message)s',
-                                          datefmt='%Y-%m-%dT%H:%M:%S')
-
-        csv_handler = logging.FileHandler(log_path, 'w')
-        csv_handler.setFormatter(csv_formatter)
-
-        # all requests are logged to stdout as well (kbc logs)
-        stdout_handler = logging.StreamHandler(stream=sys.stdout)
-        stdout_handler.setFormatter(csv_formatter)
-
-        cdc_logger.addHandler(stdout_handler)
-        cdc_logger.addHandler(csv_handler)
-        cdc_logger.setLevel(logging.INFO)
-        return cdc_logger
+        self.csv_log_header = CsvRequestLog.header
+        return CsvRequestLog(log_path, name=__name__ + '_cdc', **options)
+
+    def flush_log(self):
+        if self.cdc_logger is not None:
+            self.cdc_logger.flush()
+
+    def close_log(self):
+        if self.cdc_logger is not None:
+            self.cdc_logger.close()
+
+    def __exit__(self, *exc):
+        # closing the session closes the pools too
+        self._record_pool_stats()
+        try:
+            return super().__exit__(*exc)
+        finally:
+            self.close_log()
 
     @staticmethod
     def _csv_quote(text):
@@ -68,36 +247,154 @@ class KBCTTDClient(TTDClient):
         wr.writerow([text])
         return buff.getvalue().strip()
 
-    def log_response(self, resp):
-        """csv-escape given text and write to the csv log
+    def log_response(self, resp, retries=0, body=None):
+        """Hand the request and response over to the csv log
 
+        Args:
+            retries: how many times the request was repeated before
+            body: the request body to log instead of the one sent
+                (which might be gzipped)
         """
-        try:
-            req_body = resp.request.body.decode('utf8')
-        except AttributeError:
-            req_body = ''
-        self.cdc_logger.info(self._csv_quote(resp.text),
-                             extra={
-                                 'http_status': resp.status_code,
-                                 'pk': self._make_pk_from_response(resp),
-                                 'method': resp.request.method,
-                                 'url': resp.url,
-                                 'request_body': self._csv_quote(req_body)
-                             })
+        if self.cdc_logger is None:
+            return
+        self.cdc_logger.log(resp.status_code, resp.request.method, resp.url,
+                            body if body is not None else resp.request.body,
+                            resp.text, retries)
+
+    def log_failure(self, method, url, body, err, retries=0):
+        """Log a request which got no response at all"""
+        if self.cdc_logger is None:
+            return
+        self.cdc_logger.log('error', method, url, body, str(err), retries)
+
+    def request_raw(self, method, endpoint, body):
+        """Send an already serialized json `body` as it is
+
+        Saves us parsing the payload from the input csv only to serialize
+        it again.
+
+        Returns:
+            the `requests.Response`
+        """
+        if isinstance(body, str):
+            body = body.encode('utf8')
+        headers = {'Content-Type': 'application/json'}
+        if (body and self.compress_min_bytes is not None
+                and len(body) >= self.compress_min_bytes):
+            # the log gets the readable body
+            return self._request(method, endpoint, log_body=body,
+                                 data=gzip.compress(body, compresslevel=5),
+                                 headers=dict(headers, **{'Content-Encoding': 'gzip'}))
+        return self._request(method, endpoint, data=body, headers=headers)
+
+    def _endpoint(self, url):
+        """'/v3/campaign/clone' or the full url -> 'campaign/clone'
+
+        The ids are replaced, '/v3/adgroup/abc123' -> 'adgroup/{id}'
+        """
+        base_url = self.base_url or ''
+        path = urlparse(urljoin(base_url, url.lstrip('/'))).path
+        base_path = urlparse(base_url).path
+        if base_path and path.startswith(base_path):
+            path = path[len(base_path):]
+        # the ttd ids always contain a digit, the resource names never do
+        return '/'.join('{id}' if any(c.isdigit() for c in segment) else segment
+                        for segment in path.strip('/').split('/'))
+
+    def _observe_http(self, endpoint, start, resp):
+        status = resp.status_code if resp is not None else 'error'
+        self.metrics.observe(HTTP, time.perf_counter() - start, endpoint, status)
 
     @staticmethod
-    def _make_pk_from_response(resp):
-        return md5(resp.request.body or b'' + str(time.time()).encode('ascii')).hexdigest()
+    def _is_throttled(err):
+        resp = getattr(err, 'response', None)
+        return resp is not None and resp.status_code == 429
+
+    @staticmethod
+    def _is_unauthorized(err):
+        resp = getattr(err, 'response', None)
+        return resp is not None and resp.status_code == 401
+
+    def _retry_later(self, method, url, endpoint, err, retries):
+        """Wait before repeating the request, False if it shouldn't be"""
+        if not is_retryable(method, err):
+            if is_transient(err):
+                logger.warning("%s %s failed (%s), not retrying as it might "
+                               "have been processed", method, url, err)
+            return False
+        if retries >= self.max_retries:
+            logger.warning("%s %s failed %s times, giving up",
+                           method, url, retries + 1)
+            return False
+        if not self.retry_budget.spend():
+            return False
+        self.metrics.retry(endpoint)
+        delay = backoff_delay(retries)
+        resp = getattr(err, 'response', None)
+        if resp is not None:
+            delay = max(delay, parse_retry_after(
+                resp.headers.get('Retry-After'), default=0))
+        logger.warning("%s %s failed (%s), retrying in %.1fs (attempt %s)",
+                       method, url, err, delay, retries + 1)
+        self._sleep(delay)
+        return True
 
     def _request(self, method, url, *args, **kwargs):
-        try:
-            resp = super()._request(method, url, *args, **kwargs)
-        except (requests.HTTPError, TTDClientError)  as err:
-            # I think this will ultimately double log the errors, but
-            # it quite makes sense. As the root logger doesn't know about
-            # cdc logger at all
-            self.log_response(err.response)
-            raise
-        else:
-            self.log_response(resp)
-            return resp
+        throttled = 0
+        # the transient failures repeated so far
+        retries = 0
+        relogged = False
+        endpoint = self._endpoint(url)
+        log_body = kwargs.pop('log_body', None)
+        if log_body is None:
+            log_body = kwargs.get('data')
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+        while True:
+            attempt = throttled + retries + relogged
+            token = self.ensure_token()
+            kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                     **{'TTD-Auth': token})
+            self.metrics.observe(RATE_LIMIT_WAIT, self.rate_limiter.acquire(),
+                                 endpoint)
+            start = time.perf_counter()
+            try:
+                resp = super()._request(method, url, *args, **kwargs)
+            except (requests.HTTPError, TTDApiError, TTDClientError)  as err:
+                self._observe_http(endpoint, start, err.response)
+                # I think this will ultimately double log the errors, but
+                # it quite makes sense. As the root logger doesn't know about
+                # cdc logger at all
+                self.log_response(err.response, attempt, log_body)
+                if self._is_unauthorized(err) and not relogged:
+                    # the token expired sooner than we thought
+                    logger.info("The auth token was rejected, logging in again")
+                    relogged = True
+                    self.invalidate_token(token)
+                    continue
+                if not self._is_throttled(err):
+                    if not self._retry_later(method, url, endpoint, err, retries):
+                        raise
+                    retries += 1
+                    continue
+                if throttled >= self.max_throttled_retries:
+                    raise
+                # 429 means the request wasn't processed, safe to repeat even a POST
+                throttled += 1
+                self.metrics.retry(endpoint)
+                retry_after = parse_retry_after(
+                    err.response.headers.get('Retry-After'))
+                logger.info("Too many requests for %s %s, retrying (attempt %s)",
+                            method, url, throttled)
+                self.rate_limiter.on_throttle(retry_after)
+            except requests.RequestException as err:
+                self._observe_http(endpoint, start, None)
+                self.log_failure(method, url, log_body, err, attempt)
+                if not self._retry_later(method, url, endpoint, err, retries):
+                    raise
+                retries += 1
+            else:
+                self._observe_http(endpoint, start, resp)
+                self.rate_limiter.on_success()
+                self.log_response(resp, attempt, log_body)
+                return resp
@@ -0,0 +1,86 @@
+"""
+Wait for the cloned campaigns to be created
+
+`POST /campaign/clone` only queues the clone and returns its ReferenceId.
+The status of every clone is polled concurrently, the clones still pending
+are polled again after an exponentially growing delay until all are done
+or the overall timeout runs out. The status endpoint takes a single
+ReferenceId, so a round makes a request per pending clone.
+"""
+import logging
+import time
+from collections import OrderedDict, namedtuple
+from functools import partial
+from urllib.parse import quote
+
+from ttdwr import jsonutil
+from ttdwr.executor import RowExecutor
+from ttdapi.exceptions import TTDApiError
+
+logger = logging.getLogger(__name__)
+
+STATUS_ENDPOINT = '/campaign/clone/status/{}'
+PENDING = 'Pending'
+# compared lowercased and without spaces
+PENDING_STATUSES = frozenset(['pending', 'queued', 'notstarted', 'inprogress',
+                              'running', 'processing'])
+
+CloneStatus = namedtuple('CloneStatus', ['status', 'campaign_id'])
+
+
+def is_pending(clone):
+    if clone.campaign_id:
+        return False
+    status = (clone.status or '').replace(' ', '').replace('_', '').lower()
+    return not status or status in PENDING_STATUSES
+
+
+def fetch_status(client, reference_id):
+    try:
+        resp = client.request_raw(
+            'GET', STATUS_ENDPOINT.format(quote(reference_id, safe='')), None)
+    except TTDApiError as err:
+        if err.response is not None and err.response.status_code == 404:
+            # the clone might not be visible yet
+            return CloneStatus(PENDING, '')
+        logger.warning("Couldn't get the status of the clone %s: %s",
+                       reference_id, err)
+        return CloneStatus('Error', '')
+    body = jsonutil.loads(resp.text)
+    return CloneStatus(body.get('Status') or '', body.get('CampaignId') or '')
+
+
+def resolve_clones(client, reference_ids, max_concurrency=1, timeout=600,
+                   first_delay=1.0, max_delay=30.0, clock=time.monotonic,
+                   sleep=time.sleep):
+    """Poll the status of the clones until none is pending
+
+    Args:
+        timeout: seconds after which the clones still pending are left so
+
+    Returns:
+        {ReferenceId: CloneStatus}
+    """
+    deadline = clock() + timeout
+    statuses = {}
+    # distinct, in order
+    pending = list(OrderedDict.fromkeys(reference_ids))
+    delay = first_delay
+    logger.info("Waiting for %s clones to be created", len(pending))
+    with RowExecutor(max_concurrency) as executor:
+        while pending:
+            fetched = executor.imap(partial(fetch_status, client), pending)
+            statuses.update(zip(pending, fetched))
+            pending = [ref for ref in pending if is_pending(statuses[ref])]
+            if not pending:
+                break
+            remaining = deadline - clock()
+            if remaining <= 0:
+                logger.warning("%s clones are still pending after %ss, "
+                               "giving up on them", len(pending), timeout)
+                break
+            logger.info("%s clones are still pending, checking again in %.0fs",
+                        len(pending), min(delay, remaining))
+            sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
+    return statuses
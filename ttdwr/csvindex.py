@@ -0,0 +1,127 @@
+"""
+Random access to the rows of a (large) csv
+
+The file is memory mapped and scanned once for the byte offsets where the
+rows start. A newline ends a row only if there's an even number of quotes
+since the row start, so the newlines within the quoted json payloads are
+handled. A range of rows can then be parsed without reading what precedes
+it, the preflight worker processes get just a slice of the offsets.
+"""
+import csv
+import mmap
+from array import array
+
+
+def _open_mmap(path):
+    with open(str(path), 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file can't be mapped
+            return b''
+
+
+def scan_offsets(data, start=0):
+    """Offsets where the records of `data` start, plus the end of the data"""
+    offsets = array('Q')
+    size = len(data)
+    row_start = pos = start
+    quotes = 0
+    while pos < size:
+        newline = data.find(b'\n', pos)
+        if newline == -1:
+            newline = size
+        quotes += data[pos:newline].count(b'"')
+        pos = newline + 1
+        if quotes % 2:
+            # the newline is quoted
+            continue
+        if data[row_start:newline].strip(b'\r'):
+            offsets.append(row_start)
+        row_start = pos
+        quotes = 0
+    if row_start < size and data[row_start:size].strip(b'\r\n'):
+        # an unterminated quote at the end, let the csv parser complain
+        offsets.append(row_start)
+    offsets.append(size)
+    return offsets
+
+
+def parse_records(data, offsets, columns, header):
+    """Parse the records starting at `offsets` (the last one is the end)
+
+    Yields:
+        {column: value} for the `columns` only
+    """
+    positions = [header.index(col) for col in columns]
+    for start, end in zip(offsets, offsets[1:]):
+        text = data[start:end].decode('utf8').rstrip('\r\n')
+        values = next(csv.reader([text]), [])
+        yield {col: values[pos] if pos < len(values) else None
+               for col, pos in zip(columns, positions)}
+
+
+class IndexedCsv:
+    """The header and the row offsets of a csv
+
+    `len(table)` is the number of rows (without the header), the rows are
+    read by `read_rows`.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self._data = _open_mmap(self.path)
+        header_offsets = scan_offsets(self._data[:self._header_end()])
+        if len(header_offsets) > 1:
+            start, end = header_offsets[0], header_offsets[1]
+            self.header = next(csv.reader(
+                [self._data[start:end].decode('utf8').rstrip('\r\n')]))
+        else:
+            self.header = None
+        self.offsets = scan_offsets(self._data, self._header_end())
+
+    def _header_end(self):
+        """The header is the first record, its quotes might span lines"""
+        size = len(self._data)
+        pos = 0
+        quotes = 0
+        while pos < size:
+            newline = self._data.find(b'\n', pos)
+            if newline == -1:
+                return size
+            quotes += self._data[pos:newline].count(b'"')
+            pos = newline + 1
+            if not quotes % 2:
+                return pos
+        return size
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def chunks(self, size):
+        """(start, stop) row ranges of at most `size` rows"""
+        return [(start, min(start + size, len(self)))
+                for start in range(0, len(self), size)]
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_rows(path, offsets, columns, header):
+    """Parse the rows at the `offsets` (a slice of `IndexedCsv.offsets`)
+
+    Yields:
+        {column: value} for the `columns` only
+    """
+    data = _open_mmap(path)
+    try:
+        yield from parse_records(data, offsets, columns, header)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
@@ -0,0 +1,152 @@
+"""
+Run the per-row work of the writer actions concurrently
+
+The results are always handed back in the same order as the input rows so the
+output tables keep matching the input tables row by row.
+"""
+import collections
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class RowExecutor:
+    """A bounded thread pool with an ordered `imap`
+
+    With `max_concurrency=1` no threads are started at all and every
+    job is executed right away in the calling thread, which is exactly how
+    the writer behaved before.
+    """
+    def __init__(self, max_concurrency=1):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be >= 1, got {}".format(
+                max_concurrency))
+        self.max_concurrency = max_concurrency
+        self._pool = None
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    def __enter__(self):
+        if self.max_concurrency > 1:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._pool is not None:
+            if exc_type is not None:
+                # don't start anything new, there might be jobs queued by
+                # other jobs (see `create_campaigns_and_adgroups`)
+                with self._pending_lock:
+                    pending = list(self._pending)
+                for fut in pending:
+                    fut.cancel()
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        if self._pool is None:
+            fut = Future()
+            try:
+                fut.set_result(fn(*args, **kwargs))
+            except Exception as err:
+                fut.set_exception(err)
+            return fut
+        fut = self._pool.submit(fn, *args, **kwargs)
+        with self._pending_lock:
+            self._pending.add(fut)
+        fut.add_done_callback(self._forget)
+        return fut
+
+    def _forget(self, fut):
+        with self._pending_lock:
+            self._pending.discard(fut)
+
+    def imap(self, fn, iterable, key=None):
+        """Like `map(fn, iterable)` but up to `max_concurrency` calls run at once
+
+        At most 2 * max_concurrency rows are held in memory at any time.
+        The first exception stops the submission of new rows, cancels those
+        which haven't started yet and is re-raised once the running ones finish.
+
+        Items for which `key(item)` is the same are processed one after
+        another, in their order.
+        """
+        window_size = self.max_concurrency * 2 if self._pool is not None else 1
+        window = collections.deque()
+        # key -> the future of the last item with the key still in the window
+        last = {}
+
+        def _pop():
+            item_key, fut = window.popleft()
+            if item_key is not None and last.get(item_key) is fut:
+                del last[item_key]
+            return fut.result()
+
+        try:
+            for item in iterable:
+                item_key = key(item) if key is not None else None
+                previous = last.get(item_key) if item_key is not None else None
+                if previous is None:
+                    fut = self.submit(fn, item)
+                else:
+                    fut = self.submit(_after, previous, fn, item)
+                if item_key is not None:
+                    last[item_key] = fut
+                window.append((item_key, fut))
+                if len(window) >= window_size:
+                    yield _pop()
+            while window:
+                yield _pop()
+        finally:
+            if window:
+                logger.debug("Cancelling %s pending jobs", len(window))
+            for _, fut in window:
+                fut.cancel()
+            for _, fut in window:
+                if not fut.cancelled():
+                    # wait for the jobs which are already running
+                    fut.exception()
+
+
+def _after(previous, fn, item):
+    """`fn(item)` once the `previous` job succeeded
+
+    If the previous job failed or was cancelled, so does this one and the
+    rest of the chain. The previous job was submitted earlier so the pool
+    started it already, waiting for it can't deadlock.
+    """
+    previous.result()
+    return fn(item)
+
+
+class Coalescer:
+    """Call `fn` once per distinct key
+
+    Later (or concurrent) calls with a key which was seen already get the
+    result - or the exception - of the first call instead of calling `fn`
+    again. The results are kept until the coalescer is dropped.
+    """
+    def __init__(self, fn):
+        self._fn = fn
+        self._lock = threading.Lock()
+        self._futures = {}
+        self.calls = 0
+        self.saved = 0
+
+    def __call__(self, key, *args, **kwargs):
+        with self._lock:
+            fut = self._futures.get(key)
+            first = fut is None
+            if first:
+                fut = self._futures[key] = Future()
+                self.calls += 1
+            else:
+                self.saved += 1
+        if first:
+            try:
+                fut.set_result(self._fn(*args, **kwargs))
+            except Exception as err:
+                fut.set_exception(err)
+        return fut.result()
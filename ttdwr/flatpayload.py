@@ -0,0 +1,223 @@
+"""
+Build the payloads from flattened columns
+
+Instead of a `payload` column with a json string, an input table can have
+a column per payload field, named by its path prefixed with `payload.`:
+
+    payload.CampaignName,payload.Budget.Amount:float,payload.Tags[0]
+
+`.` separates the keys of nested objects, `[n]` indexes lists. The value
+is converted according to the optional type after `:`
+
+ - `str` (default) the value as it is, the ids are strings even if they
+   look like numbers
+ - `int`, `float` (finite only), `bool` (true/false/1/0)
+ - `auto` `true`, `false`, `null` and the numbers which read back exactly
+   the same (`12`, `1.5` but not `007`, `1.50` or `1e5`) as such, anything
+   else as a string
+ - `json` the value is json itself (e.g. a list of ids)
+
+Empty values are left out of the payload. The header is compiled once into
+a `PayloadBuilder`, which then only walks a prepared tree for every row.
+"""
+import json
+import math
+import re
+
+from ttdwr.exceptions import UserError
+
+PREFIX = 'payload.'
+
+_SEGMENT = re.compile(r'([^.\[\]]+)|\[(\d+)\]')
+_MISSING = object()
+
+
+_LITERALS = {'true': True, 'false': False, 'null': None}
+
+
+def _float(value):
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError("'{}' is not a finite number".format(value))
+    return number
+
+
+def _reject_constant(name):
+    raise ValueError("{} is not valid json".format(name))
+
+
+def _json(value):
+    return json.loads(value, parse_constant=_reject_constant)
+
+
+def _auto(value):
+    if value in _LITERALS:
+        return _LITERALS[value]
+    for convert in (int, _float):
+        try:
+            number = convert(value)
+        except ValueError:
+            continue
+        # only what reads back the same, '007' stays a string
+        if repr(number) == value:
+            return number
+    return value
+
+
+def _bool(value):
+    lowered = value.lower()
+    if lowered in ('true', '1'):
+        return True
+    if lowered in ('false', '0'):
+        return False
+    raise ValueError("'{}' is not a boolean".format(value))
+
+
+COERCIONS = {
+    'auto': _auto,
+    'str': str,
+    'int': int,
+    'float': _float,
+    'bool': _bool,
+    'json': _json,
+}
+
+
+class PayloadBuildError(UserError):
+    def __init__(self, column, err):
+        super().__init__("Invalid value in column '{}': {}".format(column, err))
+        self.column = column
+
+
+def is_flattened(header):
+    return any(col.startswith(PREFIX) for col in header or [])
+
+
+def parse_column(column):
+    """'payload.Budget.Amount:float' -> (('Budget', 'Amount'), float)
+
+    List indexes are ints in the path.
+    """
+    spec, _, type_name = column[len(PREFIX):].partition(':')
+    coerce = COERCIONS.get(type_name or 'str')
+    if coerce is None:
+        raise UserError("Column '{}': unknown type '{}', use one of {}".format(
+            column, type_name, ', '.join(sorted(COERCIONS))))
+    path = []
+    pos = 0
+    for match in _SEGMENT.finditer(spec):
+        separator = spec[pos:match.start()]
+        if separator not in ('', '.') or (separator == '.' and not path):
+            break
+        key, index = match.groups()
+        path.append(int(index) if index is not None else key)
+        pos = match.end()
+    if pos != len(spec) or not path or not isinstance(path[0], str):
+        raise UserError("Column '{}': can't parse the path '{}'".format(
+            column, spec))
+    return tuple(path), coerce
+
+
+def _compile(tree):
+    """A function row -> value (or _MISSING) for a node of the path tree"""
+    if not isinstance(tree, dict):
+        column, coerce = tree
+
+        def leaf(row):
+            value = row[column]
+            if not value:
+                return _MISSING
+            try:
+                return coerce(value)
+            except ValueError as err:
+                raise PayloadBuildError(column, err)
+        return leaf
+
+    children = [(key, _compile(child)) for key, child in tree.items()]
+    if all(isinstance(key, int) for key, _ in children):
+        children.sort(key=lambda child: child[0])
+
+        def build_list(row):
+            values = [build(row) for _, build in children]
+            values = [value for value in values if value is not _MISSING]
+            return values or _MISSING
+        return build_list
+
+    def build_object(row):
+        obj = {}
+        for key, build in children:
+            value = build(row)
+            if value is not _MISSING:
+                obj[key] = value
+        return obj or _MISSING
+    return build_object
+
+
+class PayloadBuilder:
+    """Turns the flattened columns of a row into the payload"""
+    def __init__(self, header):
+        self.columns = [col for col in header if col.startswith(PREFIX)]
+        tree = {}
+        for column in self.columns:
+            path, coerce = parse_column(column)
+            node = tree
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+                if not isinstance(node, dict):
+                    raise UserError("Column '{}' conflicts with another "
+                                    "column".format(column))
+            if path[-1] in node:
+                raise UserError("Column '{}' conflicts with another "
+                                "column".format(column))
+            node[path[-1]] = (column, coerce)
+        for node in _nodes(tree):
+            keys = list(node)
+            if any(isinstance(key, int) for key in keys) and \
+                    not all(isinstance(key, int) for key in keys):
+                raise UserError("The payload columns mix list indexes and "
+                                "keys of the same field")
+        self._build = _compile(tree)
+
+    def __call__(self, row):
+        """The payload dict"""
+        payload = self._build(row)
+        return {} if payload is _MISSING else payload
+
+    def apply(self, row):
+        """Replace the flattened columns of the `row` with a `payload` one"""
+        payload = self(row)
+        for column in self.columns:
+            del row[column]
+        row['payload'] = json.dumps(payload, separators=(',', ':'),
+                                    allow_nan=False)
+        return row
+
+
+def _nodes(tree):
+    yield tree
+    for child in tree.values():
+        if isinstance(child, dict):
+            yield from _nodes(child)
+
+
+def compile_builder(header):
+    """A `PayloadBuilder` for the header, None if the payload isn't flattened"""
+    if not is_flattened(header):
+        return None
+    if 'payload' in header:
+        raise UserError("The table has both the 'payload' column and "
+                        "flattened payload columns")
+    return PayloadBuilder(header)
+
+
+def payload_header(header):
+    """The header as seen by the actions, the flattened columns become 'payload'"""
+    if not is_flattened(header):
+        return header
+    out = []
+    for col in header:
+        if not col.startswith(PREFIX):
+            out.append(col)
+        elif 'payload' not in out:
+            out.append('payload')
+    return out
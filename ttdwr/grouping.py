@@ -0,0 +1,85 @@
+"""
+Group adgroups to their campaigns without holding them all in memory
+
+The adgroups are streamed into a temporary sqlite database indexed by
+`dummy_campaign_id`, the rows of a campaign are read back only once the
+campaign is being processed.
+"""
+import itertools
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class AdgroupIndex:
+    """A read-only {"<dummy_campaign_id>": [adgroup rows]} kept on disk
+
+    Use as a context manager, the database is deleted on exit.
+    """
+    def __init__(self, iterable_of_adgroups, tmpdir=None, batch_size=1000):
+        self._tmpdir = tempfile.mkdtemp(prefix='ttdwr_adgroups_', dir=tmpdir)
+        self._conn = sqlite3.connect(
+            os.path.join(self._tmpdir, 'adgroups.sqlite'),
+            check_same_thread=False)
+        # the campaigns are processed in worker threads
+        self._lock = threading.Lock()
+        self._conn.execute('PRAGMA journal_mode=OFF')
+        self._conn.execute('PRAGMA synchronous=OFF')
+        self._conn.execute(
+            'CREATE TABLE adgroups (dummy_campaign_id TEXT, seq INTEGER, row TEXT)')
+        self._load(iterable_of_adgroups, batch_size)
+
+    def _load(self, iterable_of_adgroups, batch_size):
+        rows = (
+            (adgroup['dummy_campaign_id'], seq, json.dumps(adgroup))
+            for seq, adgroup
+            in enumerate(iterable_of_adgroups)
+        )
+        total = 0
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            self._conn.executemany('INSERT INTO adgroups VALUES (?, ?, ?)', batch)
+            total += len(batch)
+        self._conn.execute(
+            'CREATE INDEX ix_campaign ON adgroups (dummy_campaign_id, seq)')
+        self._conn.commit()
+        logger.info("Indexed %s adgroups on disk", total)
+
+    def get(self, dummy_campaign_id, default=None):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT row FROM adgroups WHERE dummy_campaign_id = ? ORDER BY seq',
+                (dummy_campaign_id,)).fetchall()
+        if not rows:
+            return default
+        return [json.loads(row) for row, in rows]
+
+    def __getitem__(self, dummy_campaign_id):
+        adgroups = self.get(dummy_campaign_id)
+        if adgroups is None:
+            raise KeyError(dummy_campaign_id)
+        return adgroups
+
+    def __contains__(self, dummy_campaign_id):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT 1 FROM adgroups WHERE dummy_campaign_id = ? LIMIT 1',
+                (dummy_campaign_id,)).fetchone() is not None
+
+    def close(self):
+        self._conn.close()
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,137 @@
+"""
+Remember which rows were already sent to the api so a rerun can skip them
+
+The journal lives in the KBC state file (`in/state.json` -> `out/state.json`).
+A row is identified by a hash of the action name, its payload and the number
+of identical payloads seen before it in the table, so intentional duplicates
+are still sent as many times as they appear.
+
+The journal is only useful for rerunning the same input tables, it's tied
+to their fingerprint and dropped once a run processes all the rows. Only
+the ids from the responses are kept to keep the state small.
+"""
+import collections
+import hashlib
+import json
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY = 'journal'
+
+
+def load_state(datadir):
+    path = Path(datadir) / 'in/state.json'
+    if not path.exists():
+        return {}
+    with open(str(path)) as f:
+        return json.load(f)
+
+
+def input_fingerprint(paths):
+    """A hash of the names and contents of the input tables"""
+    digest = hashlib.sha1()
+    for path in sorted(Path(p) for p in paths):
+        digest.update(path.name.encode('utf8') + b'\0')
+        with open(str(path), 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def summary(response, *keys):
+    """Just the `keys` of the response, what's worth remembering"""
+    return {key: response[key] for key in keys if key in response}
+
+
+def save_state(datadir, state):
+    path = Path(datadir) / 'out/state.json'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(path), 'w') as f:
+        json.dump(state, f)
+    return path
+
+
+class Journal:
+    """A thread-safe {row key: stored output} mapping"""
+    def __init__(self, entries=None, fingerprint=None):
+        self._entries = dict(entries or {})
+        self._lock = threading.Lock()
+        self.fingerprint = fingerprint
+        self.skipped = 0
+        self.failed = 0
+        if self._entries:
+            logger.info("Resuming, %s rows were processed by previous runs",
+                        len(self._entries))
+
+    @classmethod
+    def from_state(cls, state, fingerprint=None):
+        """The journal of a previous run over the same input tables"""
+        saved = state.get(STATE_KEY) or {}
+        if saved.get('fingerprint') != fingerprint:
+            if saved:
+                logger.info("The input tables changed since the last run, "
+                            "not resuming")
+            return cls(fingerprint=fingerprint)
+        return cls(saved.get('entries'), fingerprint=fingerprint)
+
+    def to_state(self, state):
+        with self._lock:
+            state[STATE_KEY] = {'fingerprint': self.fingerprint,
+                                'entries': dict(self._entries)}
+        return state
+
+    @staticmethod
+    def clear_state(state):
+        state.pop(STATE_KEY, None)
+        return state
+
+    @staticmethod
+    def make_key(action, *parts):
+        digest = hashlib.sha1(action.encode('utf8'))
+        for part in parts:
+            digest.update(b'\0')
+            digest.update(str(part).encode('utf8'))
+        return digest.hexdigest()
+
+    def keyed(self, action, rows, column='payload'):
+        """Yield (key, row) for every row in `rows`"""
+        seen = collections.Counter()
+        for row in rows:
+            content_hash = self.make_key(action, row[column])
+            seen[content_hash] += 1
+            yield self.make_key(content_hash, seen[content_hash]), row
+
+    def get(self, key):
+        with self._lock:
+            output = self._entries.get(key)
+            if output is not None:
+                self.skipped += 1
+            return output
+
+    def record(self, key, output):
+        with self._lock:
+            self._entries[key] = output
+
+    def record_failure(self):
+        """A row failed (with `do_not_fail`), a rerun should resume"""
+        with self._lock:
+            self.failed += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class NullJournal(Journal):
+    """Used when resuming is turned off, remembers nothing"""
+    def keyed(self, action, rows, column='payload'):
+        for row in rows:
+            yield None, row
+
+    def get(self, key):
+        return None
+
+    def record(self, key, output):
+        pass
@@ -0,0 +1,21 @@
+"""
+json parsing with an optional fast backend
+
+orjson is used when it's installed. It refuses NaN which our upstream
+transformations happily produce, such documents fall back to the stdlib.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(text):
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(text)
@@ -0,0 +1,182 @@
+"""
+Where does the time go
+
+The phases of processing a row (parsing the csv, decoding the payload,
+waiting for the rate limiter, the http round trip, writing the output) are
+timed with a monotonic clock and aggregated per endpoint and status code.
+The timings go into log scaled histograms, so the memory stays the same
+however many rows there are. At the end of the job they are written to the
+metrics.csv output table.
+"""
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+FNAME_METRICS = 'metrics.csv'
+
+CSV_PARSE = 'csv_parse'
+PAYLOAD_DECODE = 'payload_decode'
+RATE_LIMIT_WAIT = 'rate_limit_wait'
+HTTP = 'http'
+OUTPUT_WRITE = 'output_write'
+RETRY = 'retry'
+CONNECTIONS_OPENED = 'connections_opened'
+CONNECTION_REQUESTS = 'connection_requests'
+
+
+class Histogram:
+    """Counts of durations in buckets growing by 5 %
+
+    The percentiles are therefore off by 5 % at most.
+    """
+    smallest = 1e-6
+    growth = 1.05
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if seconds <= self.smallest:
+            bucket = 0
+        else:
+            bucket = int(math.log(seconds / self.smallest, self.growth)) + 1
+        self.buckets[bucket] += 1
+
+    def percentile(self, pct):
+        """The upper bound of the bucket holding the `pct` percentile"""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * pct / 100)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.smallest * self.growth ** bucket, self.max)
+        return self.max
+
+
+class Metrics:
+    """Timings and counters shared by the client and the actions (thread safe)"""
+    columns = ['phase', 'endpoint', 'status', 'count', 'total_s',
+               'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+
+    def __init__(self, progress_interval=10.0, clock=time.perf_counter):
+        """
+        Args:
+            progress_interval: seconds between the rows/s lines in the job log
+        """
+        self.progress_interval = progress_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = Counter()
+        self.rows = Counter()
+        self.started = clock()
+        self._last_progress = self.started
+
+    def observe(self, phase, seconds, endpoint='', status=''):
+        key = (phase, endpoint, str(status))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram()
+            hist.add(seconds)
+
+    @contextmanager
+    def timer(self, phase, endpoint='', status=''):
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.observe(phase, self._clock() - start, endpoint, status)
+
+    def timed(self, phase, iterable):
+        """Yield from `iterable`, timing how long each item took to produce"""
+        iterator = iter(iterable)
+        while True:
+            start = self._clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(phase, self._clock() - start)
+            yield item
+
+    def count(self, phase, value=1, endpoint=''):
+        """Add to a counter, reported as a row with just the count"""
+        with self._lock:
+            self._counters[(phase, endpoint)] += value
+
+    def retry(self, endpoint):
+        self.count(RETRY, endpoint=endpoint)
+
+    def row_done(self, action):
+        """Count a finished row, now and then log the progress"""
+        now = self._clock()
+        with self._lock:
+            self.rows[action] += 1
+            if now - self._last_progress < self.progress_interval:
+                return
+            self._last_progress = now
+            rows = dict(self.rows)
+        elapsed = now - self.started
+        for name, count in sorted(rows.items()):
+            logger.info("%s: %s rows done, %.1f rows/s",
+                        name, count, count / elapsed)
+
+    def snapshot(self):
+        """The rows of the metrics table
+
+        The requests repeated after HTTP 429 are counted in 'retry' rows,
+        the counters have just the count.
+        """
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        rows = []
+        for (phase, endpoint, status), hist in histograms:
+            rows.append({
+                'phase': phase,
+                'endpoint': endpoint,
+                'status': status,
+                'count': hist.count,
+                'total_s': round(hist.total, 6),
+                'mean_ms': round(hist.total / hist.count * 1000, 3),
+                'p50_ms': round(hist.percentile(50) * 1000, 3),
+                'p95_ms': round(hist.percentile(95) * 1000, 3),
+                'p99_ms': round(hist.percentile(99) * 1000, 3),
+                'max_ms': round(hist.max * 1000, 3),
+            })
+        for (phase, endpoint), count in counters:
+            row = dict.fromkeys(self.columns, '')
+            row.update(phase=phase, endpoint=endpoint, count=count)
+            rows.append(row)
+        return rows
+
+    def write(self, writer):
+        """Write the table into a csv.DictWriter with `columns`"""
+        for row in self.snapshot():
+            writer.writerow(row)
+
+    def log_summary(self):
+        elapsed = self._clock() - self.started
+        for name, count in sorted(self.rows.items()):
+            logger.info("%s: %s rows in %.1f s, %.1f rows/s",
+                        name, count, elapsed, count / elapsed if elapsed else 0)
+        for row in self.snapshot():
+            if row['phase'] in (HTTP, RATE_LIMIT_WAIT):
+                logger.info("%s %s %s: %s calls, p50 %s ms, p99 %s ms",
+                            row['phase'], row['endpoint'], row['status'],
+                            row['count'], row['p50_ms'], row['p99_ms'])
+
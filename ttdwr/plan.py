@@ -0,0 +1,50 @@
+"""
+Run all the actions the input tables ask for within one job
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def _name(action):
+    return getattr(action, 'func', action).__name__
+
+
+class ExecutionPlan:
+    """Actions grouped into stages
+
+    The stages run one after another, the actions within a stage don't
+    depend on each other and run concurrently, sharing the client (and
+    therefore its rate limit).
+    """
+    def __init__(self, stages):
+        self.stages = [list(stage) for stage in stages if stage]
+
+    @property
+    def actions(self):
+        return [action for stage in self.stages for action in stage]
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __repr__(self):
+        return 'ExecutionPlan({})'.format(
+            ' -> '.join('[' + ', '.join(_name(a) for a in stage) + ']'
+                        for stage in self.stages))
+
+    def __call__(self, **kwargs):
+        """Run the plan, `kwargs` (client, journal) are passed to every action"""
+        logger.info("Running %r", self)
+        for stage in self.stages:
+            if len(stage) == 1:
+                stage[0](**kwargs)
+                continue
+            with ThreadPoolExecutor(max_workers=len(stage)) as pool:
+                futures = [pool.submit(action, **kwargs) for action in stage]
+            # every action has finished by now, report the first failure
+            for action, fut in zip(stage, futures):
+                err = fut.exception()
+                if err is not None:
+                    logger.error("Action %s failed", _name(action))
+                    raise err
@@ -0,0 +1,186 @@
+"""
+Validate the input tables before making any api call
+
+Every payload is parsed and checked for the keys the action needs, the
+parsing is spread over a process pool. All problems are collected into
+one output table so they can be fixed in one go.
+"""
+import csv
+import logging
+import os
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from ttdwr import jsonutil
+from ttdwr.csvindex import IndexedCsv, read_rows
+from ttdwr.exceptions import UserError
+from ttdwr.flatpayload import PayloadBuildError, compile_builder, payload_header
+
+logger = logging.getLogger(__name__)
+
+PreflightError = namedtuple('PreflightError', ['table', 'row', 'column', 'error'])
+
+FNAME_PREFLIGHT_ERRORS = 'preflight_errors.csv'
+
+
+def check_payloads(table, rows, required_keys=()):
+    """Parse the payloads of a chunk of rows
+
+    Args:
+        rows: list of (row number, payload)
+
+    Returns:
+        list of PreflightError
+    """
+    errors = []
+    for rownum, payload in rows:
+        try:
+            parsed = jsonutil.loads(payload)
+        except ValueError as err:
+            errors.append(PreflightError(table, rownum, 'payload',
+                                         'Invalid json: {}'.format(err)))
+            continue
+        errors.extend(check_payload(table, rownum, parsed, required_keys))
+    return errors
+
+
+def check_payload(table, rownum, payload, required_keys=()):
+    """Check a parsed payload"""
+    if not isinstance(payload, dict):
+        return [PreflightError(table, rownum, 'payload',
+                               'The payload must be a json object')]
+    return [PreflightError(table, rownum, 'payload',
+                           "Missing key '{}'".format(key))
+            for key in required_keys if key not in payload]
+
+
+def check_rows(path_csv, offsets, header, first_rownum, required_columns=('payload',),
+               required_keys=(), id_column=None):
+    """Check a chunk of rows, read by the byte `offsets` from the csv index
+
+    The payloads of a table with flattened payload columns are built and
+    checked as they would be sent.
+
+    Returns:
+        (list of PreflightError, list of (row number, id_column value))
+    """
+    table = Path(path_csv).name
+    errors = []
+    ids = []
+    payloads = []
+    columns = list(required_columns)
+    if id_column is not None and id_column not in columns:
+        columns.append(id_column)
+    if 'payload' in header and 'payload' not in columns:
+        columns.append('payload')
+    builder = compile_builder(header)
+    if builder is not None:
+        columns = [col for col in columns if col != 'payload'] + builder.columns
+    rows = read_rows(path_csv, offsets, columns, header)
+    for rownum, row in enumerate(rows, start=first_rownum):
+        if builder is not None:
+            try:
+                # an empty payload is reported as an empty value below
+                row['payload'] = builder(row)
+            except PayloadBuildError as err:
+                errors.append(PreflightError(table, rownum, err.column, str(err)))
+            else:
+                errors.extend(check_payload(table, rownum, row['payload'],
+                                            required_keys))
+        for col in required_columns:
+            if col in row and not row[col]:
+                errors.append(PreflightError(table, rownum, col, 'Empty value'))
+        if id_column is not None:
+            ids.append((rownum, row[id_column]))
+        if builder is None and 'payload' in row:
+            payloads.append((rownum, row['payload']))
+    errors.extend(check_payloads(table, payloads, required_keys))
+    return errors, ids
+
+
+def validate_table(path_csv, required_columns=('payload',), required_keys=(),
+                   id_column=None, workers=None, chunk_size=1000):
+    """Check a single input table
+
+    The table is indexed first, the worker processes get just the byte
+    offsets of their chunk of rows and read them from the file themselves.
+
+    Args:
+        required_columns: columns which must be present (and non empty)
+        required_keys: keys which must be present in the payload
+        id_column: values of this column are collected and returned
+        workers: number of processes parsing the payloads, default is cpu count
+
+    Returns:
+        (list of PreflightError, list of (row number, id_column value))
+    """
+    table = Path(path_csv).name
+    errors = []
+    ids = []
+    with IndexedCsv(path_csv) as index:
+        missing = [col for col in required_columns
+                   if col not in (payload_header(index.header) or [])]
+        if missing:
+            return [PreflightError(table, 0, col, 'Missing column')
+                    for col in missing], ids
+        try:
+            compile_builder(index.header)
+        except UserError as err:
+            return [PreflightError(table, 1, 'payload', str(err))], ids
+
+        def _check(pool, start, stop):
+            # header is row 1, so that the numbers match a spreadsheet
+            args = (str(path_csv), index.offsets[start:stop + 1], index.header,
+                    start + 2, required_columns, required_keys, id_column)
+            if pool is None:
+                return check_rows(*args)
+            return pool.submit(check_rows, *args)
+
+        def _collect(result):
+            errors.extend(result[0])
+            ids.extend(result[1])
+
+        chunks = index.chunks(chunk_size)
+        if len(chunks) < 2:
+            # not worth starting the processes
+            for start, stop in chunks:
+                _collect(_check(None, start, stop))
+        else:
+            workers = workers or os.cpu_count()
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+                for start, stop in chunks:
+                    pending.append(_check(pool, start, stop))
+                    # don't keep all the results around
+                    if len(pending) >= workers * 2:
+                        _collect(pending.popleft().result())
+                while pending:
+                    _collect(pending.popleft().result())
+    return errors, ids
+
+
+def check_unique(table, ids, column):
+    counts = Counter(value for _, value in ids)
+    return [PreflightError(table, rownum, column,
+                           "Duplicate value '{}'".format(value))
+            for rownum, value in ids
+            if counts[value] > 1]
+
+
+def check_references(table, ids, column, known_ids, other_table):
+    known_ids = set(known_ids)
+    return [PreflightError(table, rownum, column,
+                           "'{}' not found in {}".format(value, other_table))
+            for rownum, value in ids
+            if value not in known_ids]
+
+
+def write_errors(outdir, errors):
+    outpath = Path(outdir) / FNAME_PREFLIGHT_ERRORS
+    outpath.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(outpath), 'w') as f:
+        wr = csv.writer(f)
+        wr.writerow(PreflightError._fields)
+        wr.writerows(sorted(errors, key=lambda err: (err.table, err.row)))
+    return outpath
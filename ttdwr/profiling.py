@@ -0,0 +1,70 @@
+"""
+Profile a production run
+
+cProfile only sees the thread it was enabled in, so every thread started
+while profiling gets a profiler of its own and all of them are merged at
+the end. The merged profile (for snakeviz & co.) and a summary of the
+hottest functions go to out/files.
+"""
+import cProfile
+import logging
+import pstats
+import sys
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+FNAME_PROFILE = 'ttd_writer.prof'
+FNAME_PROFILE_SUMMARY = 'ttd_writer_profile.txt'
+
+
+@contextmanager
+def profiled(outdir, top=30):
+    """Profile the block and all the threads it starts
+
+    Args:
+        outdir: where to write the profile and the summary
+        top: how many functions the summary lists
+    """
+    profiles = []
+    lock = threading.Lock()
+
+    def _profile_thread(*_):
+        # called on the first event in a new thread, replaces itself
+        # with a profiler of the thread
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # python >= 3.12 allows a single profiler at a time
+            sys.setprofile(None)
+            return
+        with lock:
+            profiles.append(prof)
+
+    main_profile = cProfile.Profile()
+    threading.setprofile(_profile_thread)
+    main_profile.enable()
+    try:
+        yield
+    finally:
+        main_profile.disable()
+        threading.setprofile(None)
+        write_profile(outdir, [main_profile] + profiles, top)
+
+
+def write_profile(outdir, profiles, top=30):
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    stats = pstats.Stats(profiles[0])
+    for prof in profiles[1:]:
+        stats.add(prof)
+    stats.dump_stats(str(outdir / FNAME_PROFILE))
+    with open(str(outdir / FNAME_PROFILE_SUMMARY), 'w') as f:
+        stats.stream = f
+        f.write("Profiled {} threads\n\n".format(len(profiles)))
+        stats.sort_stats('cumulative').print_stats(top)
+        stats.sort_stats('tottime').print_stats(top)
+    logger.info("The profile is in %s", outdir / FNAME_PROFILE_SUMMARY)
@@ -0,0 +1,105 @@
+"""
+Client side rate limiting
+
+A token bucket shared by all threads using the same client. The refill rate
+adapts to the api feedback (AIMD) - it's cut down on every HTTP 429 and slowly
+grows back towards the configured maximum while the requests succeed.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, max_rate=10.0, min_rate=1.0, burst=None,
+                 additive_increase=0.1, multiplicative_decrease=0.5,
+                 clock=time.monotonic, sleep=time.sleep):
+        """
+        Args:
+            max_rate: requests per second we never exceed
+            min_rate: requests per second we never go below when throttled
+            burst: how many tokens can be saved up, defaults to max_rate
+            additive_increase: requests per second added after each success
+            multiplicative_decrease: the rate is multiplied by this on a 429
+        """
+        if max_rate <= 0 or min_rate <= 0:
+            raise ValueError("Rates must be positive")
+        self.max_rate = float(max_rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.burst = float(burst or max(max_rate, 1))
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.rate = self.max_rate
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        # may point to the future when we are told to back off
+        self._last = clock()
+
+    def _refill(self, now):
+        if now > self._last:
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+    def acquire(self):
+        """Block until a request can be made
+
+        Returns:
+            seconds spent waiting
+        """
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            self._tokens -= 1
+            wait = max(self._last - now, 0)
+            if self._tokens < 0:
+                wait += -self._tokens / self.rate
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.additive_increase)
+
+    def on_throttle(self, retry_after=None):
+        """Slow down after HTTP 429
+
+        Args:
+            retry_after: seconds to stay completely quiet (the Retry-After header)
+        """
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            self.rate = max(self.min_rate,
+                            self.rate * self.multiplicative_decrease)
+            self._tokens = min(self._tokens, 0)
+            if retry_after:
+                self._last = max(self._last, now + retry_after)
+            rate = self.rate
+        logger.info("Throttled by the api, slowing down to %.2f requests/s", rate)
+
+
+def parse_retry_after(value, default=None):
+    """Retry-After is either a number of seconds or an HTTP date"""
+    if not value:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when is None:
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0)
@@ -0,0 +1,265 @@
+"""
+The csv log of all api calls, written from a background thread
+
+The thread making the request only puts a tuple into a queue, the quoting,
+hashing and the (buffered) writes happen in the writer thread in batches.
+
+The size of the log can be kept at bay by
+ - truncating or hashing the request and response bodies (`body_mode`)
+ - gzipping the output (`compress`)
+ - splitting it to slices of `slice_rows` rows (KBC sliced table)
+ - printing only the errors and a progress line to stdout (`stdout='summary'`)
+"""
+import atexit
+import csv
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from hashlib import md5
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+BODY_MODES = ('full', 'truncate', 'hash')
+STDOUT_MODES = ('full', 'summary', 'none')
+
+
+def write_manifest(path_table, columns, **options):
+    """The log has no header row, KBC needs to know the columns
+
+    Args:
+        options: other manifest keys, e.g. incremental=True
+    """
+    path_manifest = str(path_table) + '.manifest'
+    with open(path_manifest, 'w') as f:
+        json.dump(dict(options, columns=columns), f)
+    return path_manifest
+
+
+def shrink_body(body, mode='full', max_bytes=1024):
+    """Apply `body_mode` to a request or response body (str)"""
+    if mode == 'full' or not body:
+        return body
+    raw = body.encode('utf8')
+    if mode == 'hash':
+        return 'md5:{} ({} bytes)'.format(md5(raw).hexdigest(), len(raw))
+    if len(raw) <= max_bytes:
+        return body
+    return '{}...[truncated, {} bytes total]'.format(
+        raw[:max_bytes].decode('utf8', errors='ignore'), len(raw))
+
+
+class CsvRequestLog:
+    header = ["type", "timestamp", "pk", "http_status", "method", "url",
+              "request", "response", "retries"]
+
+    def __init__(self, path, name, stdout='full', body_mode='full',
+                 max_body_bytes=1024, compress=False, slice_rows=None,
+                 slice_prefix='part_', progress_every=1000, batch_size=500,
+                 buffer_size=1024 * 1024):
+        """
+        Args:
+            path: where to write the csv (without header), a directory
+                if `slice_rows` is set
+            name: the value of the `type` column
+            stdout: 'full' copies every line to stdout (kbc logs), 'summary'
+                prints only errors and a progress line every `progress_every`
+                requests, 'none' prints nothing
+            body_mode: 'full', 'truncate' (to `max_body_bytes`) or 'hash'
+            compress: gzip the output file(s)
+            slice_rows: start a new file after this many rows
+            slice_prefix: the slices are named `<slice_prefix>00001.csv`...
+        """
+        if body_mode not in BODY_MODES:
+            raise ValueError("body_mode must be one of {}".format(BODY_MODES))
+        if stdout not in STDOUT_MODES:
+            raise ValueError("stdout must be one of {}".format(STDOUT_MODES))
+        self.path = str(path)
+        self.name = name
+        self.stdout = stdout
+        self.body_mode = body_mode
+        self.max_body_bytes = max_body_bytes
+        self.compress = compress
+        self.slice_rows = slice_rows
+        self.slice_prefix = slice_prefix
+        self.progress_every = progress_every
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.logged = 0
+        self.errors = 0
+        self.write_errors = 0
+        self._queue = queue.Queue()
+        self._seq = itertools.count()
+        self._closed = False
+        self._file = None
+        self._slices = 0
+        self._rows_in_slice = 0
+        if slice_rows:
+            os.makedirs(self.path, exist_ok=True)
+        self._thread = threading.Thread(target=self._run,
+                                        name='csv-request-log', daemon=True)
+        self._thread.start()
+        # the thread is a daemon, make sure nothing is lost on exit
+        atexit.register(self.close)
+
+    def log(self, status, method, url, request_body, response_text, retries=0):
+        """
+        Args:
+            status: the http status, 'error' if there was no response
+            retries: how many times the request was repeated before
+        """
+        self._queue.put((time.time(), next(self._seq), status, method, url,
+                         request_body, response_text, retries))
+
+    def flush(self):
+        """Block until everything logged so far is written"""
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        while not done.wait(timeout=1):
+            if not self._thread.is_alive():
+                # nobody is going to write it
+                return
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _format(self, record):
+        (timestamp, seq, status, method, url, request_body, response_text,
+         retries) = record
+        if isinstance(request_body, str):
+            request_body = request_body.encode('utf8')
+        request_body = request_body or b''
+        pk = md5(request_body +
+                 '{!r}-{}'.format(timestamp, seq).encode('ascii')).hexdigest()
+        return (
+            self.name,
+            time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(timestamp)),
+            pk,
+            status,
+            method,
+            url,
+            shrink_body(request_body.decode('utf8', errors='replace'),
+                        self.body_mode, self.max_body_bytes),
+            shrink_body(response_text, self.body_mode, self.max_body_bytes),
+            retries
+        )
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not _STOP \
+                and not isinstance(batch[-1], threading.Event):
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _open(self, path):
+        if self.compress:
+            raw = gzip.open(path, 'wb', compresslevel=6)
+            return io.TextIOWrapper(io.BufferedWriter(raw, self.buffer_size),
+                                    encoding='utf8', newline='')
+        return open(path, 'w', newline='', buffering=self.buffer_size)
+
+    def _writer(self):
+        """The csv writer for the current file (slice)"""
+        if self._file is not None and self.slice_rows \
+                and self._rows_in_slice >= self.slice_rows:
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            if self.slice_rows:
+                self._slices += 1
+                path = os.path.join(self.path, '{}{:05d}.csv{}'.format(
+                    self.slice_prefix, self._slices,
+                    '.gz' if self.compress else ''))
+            else:
+                path = self.path
+            self._file = self._open(path)
+            self._csv = csv.writer(self._file)
+            self._rows_in_slice = 0
+        return self._csv
+
+    def _write(self, rows):
+        if not self.slice_rows:
+            self._writer().writerows(rows)
+            return
+        while rows:
+            wr = self._writer()
+            chunk = rows[:self.slice_rows - self._rows_in_slice]
+            wr.writerows(chunk)
+            self._rows_in_slice += len(chunk)
+            rows = rows[len(chunk):]
+
+    @staticmethod
+    def _is_error(status):
+        try:
+            return int(status) >= 400
+        except (TypeError, ValueError):
+            return True
+
+    def _echo(self, rows):
+        if self.stdout == 'full':
+            csv.writer(sys.stdout).writerows(rows)
+        for row in rows:
+            self.logged += 1
+            if self._is_error(row[3]):
+                self.errors += 1
+                if self.stdout == 'summary':
+                    csv.writer(sys.stdout).writerow(row)
+            if self.stdout == 'summary' and self.logged % self.progress_every == 0:
+                logger.info("%s requests made so far, %s of them failed",
+                            self.logged, self.errors)
+
+    def _failed(self, what):
+        """Log the first failure only, the following ones are likely the same"""
+        self.write_errors += 1
+        if self.write_errors == 1:
+            logger.exception("Couldn't %s the request log, the following "
+                             "errors aren't reported", what)
+
+    def _run(self):
+        try:
+            try:
+                # there is always a file, even if nothing gets logged
+                self._writer()
+            except Exception:
+                self._failed('open')
+            while True:
+                batch = self._next_batch()
+                control = batch[-1]
+                if control is _STOP or isinstance(control, threading.Event):
+                    batch.pop()
+                try:
+                    rows = [self._format(record) for record in batch]
+                    self._write(rows)
+                    self._echo(rows)
+                except Exception:
+                    self._failed('write')
+                if control is _STOP:
+                    return
+                # only when asked to, the writes stay large
+                if isinstance(control, threading.Event):
+                    try:
+                        if self._file is not None:
+                            self._file.flush()
+                    except Exception:
+                        self._failed('flush')
+                    control.set()
+        finally:
+            if self._file is not None:
+                self._file.close()
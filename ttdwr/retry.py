@@ -0,0 +1,83 @@
+"""
+Which failed requests are worth repeating and when
+
+Gateway errors (HTTP 502/503/504), connection resets and read timeouts are
+transient, but repeating a request is safe only if it's idempotent. A POST
+(creating or cloning a campaign) which failed that way might have been
+processed anyway, so it is repeated only if it surely never reached the api
+(the connection couldn't be opened). HTTP 429 is handled by the rate
+limiter, see `KBCTTDClient._request`.
+
+The retries are spaced by exponential backoff with full jitter, so the
+threads which failed at once don't come back at once either. All the
+retries of a run draw from one `RetryBudget`, during an outage the job
+fails after the budget is spent instead of retrying every single row.
+"""
+import logging
+import random
+import threading
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = frozenset([502, 503, 504])
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+def never_sent(err):
+    """The connection failed before the request could be sent"""
+    if isinstance(err, requests.ConnectTimeout):
+        return True
+    if isinstance(err, requests.ConnectionError) and err.args:
+        return isinstance(getattr(err.args[0], 'reason', None), NewConnectionError)
+    return False
+
+
+def is_transient(err):
+    """Might the same request succeed a bit later?"""
+    resp = getattr(err, 'response', None)
+    if resp is not None:
+        return resp.status_code in RETRYABLE_STATUSES
+    return isinstance(err, (requests.ConnectionError, requests.Timeout,
+                            requests.exceptions.ChunkedEncodingError))
+
+
+def is_retryable(method, err):
+    """Is it both safe and worth repeating the request?"""
+    if never_sent(err):
+        return True
+    return method.upper() in IDEMPOTENT_METHODS and is_transient(err)
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0, rand=random.random):
+    """Seconds to wait before the retry number `attempt` (from 0)
+
+    Uniformly random up to `base * 2**attempt`, which is capped at `cap`.
+    """
+    return rand() * min(cap, base * 2 ** attempt)
+
+
+class RetryBudget:
+    """Thread-safe count of the retries left for the whole run"""
+    def __init__(self, total):
+        self.total = total
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    def spend(self):
+        """Take one retry, False if there are none left"""
+        with self._lock:
+            if self.spent >= self.total:
+                return False
+            self.spent += 1
+            exhausted = self.spent == self.total
+        if exhausted:
+            logger.warning("All the %s retries were used up, any other failed "
+                           "request fails the job", self.total)
+        return True
+
+    @property
+    def remaining(self):
+        return self.total - self.spent
@@ -3,19 +3,42 @@ KBC Related stuff
 
 """
 import csv
-import time
+import hashlib
 import itertools
 import json
 import logging
 import os
 import sys
+import threading
+import zlib
+from collections import Counter, namedtuple
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
 from functools import partial
 from pathlib import Path
+from urllib.parse import quote
 from typing import Dict, Tuple, List
 import voluptuous as vp
 
 import ttdwr
-from ttdapi.client import TTDClient
+from ttdwr import jsonutil
+from ttdwr.adgroupstate import (AdgroupStateCache, changed_fields,
+                                payload_digest)
+from ttdwr.client import KBCTTDClient
+from ttdwr.clonestatus import resolve_clones
+from ttdwr.executor import Coalescer, RowExecutor
+from ttdwr.flatpayload import compile_builder, payload_header
+from ttdwr.grouping import AdgroupIndex
+from ttdwr.journal import (Journal, NullJournal, input_fingerprint, load_state,
+                           save_state, summary)
+from ttdwr.metrics import (CSV_PARSE, FNAME_METRICS, OUTPUT_WRITE,
+                           PAYLOAD_DECODE, Metrics)
+from ttdwr.plan import ExecutionPlan
+from ttdwr.preflight import (check_references, check_unique, validate_table,
+                             write_errors)
+from ttdwr.profiling import profiled
+from ttdwr.requestlog import (BODY_MODES, STDOUT_MODES, CsvRequestLog,
+                              write_manifest)
 from ttdapi.exceptions import TTDApiError
 
 logger = logging.getLogger(__name__)
@@ -26,24 +49,123 @@ FNAME_UPDATE_ADGROUPS = 'update_adgroups.csv'
 FNAME_UPDATE_CAMPAIGNS = 'update_campaigns.csv'
 FNAME_CLONE_CAMPAIGNS = 'clone_campaigns.csv'
 FNAME_PUT_ADGROUPS = 'put_adgroups.csv'
+FNAME_CAMPAIGN_ID_MAPPING = 'campaign_id_mapping.csv'
+# the output tables are written row by row as the rows are processed
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+FNAME_REQUEST_LOG = 'ttd_writer_log.csv'
 
 def main(params, datadir):
     _datadir = Path(datadir)
-    intables = _datadir / 'in/tables'
     if params.get('debug'):
         logging.basicConfig(level=logging.DEBUG, stream=sys.stdout)
     else:
         logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
-    client = TTDClient(
+    profile = params.get('profile')
+    if profile is None:
+        return _run(params, _datadir)
+    logger.info("Profiling the job")
+    with profiled(_datadir / 'out/files', top=profile.get('top', 30)):
+        return _run(params, _datadir)
+
+
+def _run(params, _datadir):
+    outtables = _datadir / 'out/tables'
+    path_csv_log, csv_log_options = _request_log_setup(
+        params.get('request_log'), outtables, shard_from_params(params))
+    metrics = Metrics()
+    client = KBCTTDClient(
         login=params['login'],
         password=params['#password'],
-        base_url=params.get("base_url", "https://api.thetradedesk.com/v3/")
+        path_csv_log=path_csv_log,
+        base_url=params.get("base_url", "https://api.thetradedesk.com/v3/"),
+        max_requests_per_second=params.get("max_requests_per_second", 10),
+        csv_log_options=csv_log_options,
+        metrics=metrics,
+        # two actions can run at once
+        pool_size=params.get('http_pool_size',
+                             2 * params.get('max_concurrency', 1)),
+        compress_min_bytes=params.get('compress_requests_over_bytes'),
+        max_retries=params.get('max_retries', 4),
+        retry_budget=params.get('retry_budget', 100),
+        timeout=params.get('request_timeout_seconds')
     )
+    state = load_state(_datadir)
+    if not client.token_from_state(state):
+        # log in while the input tables are read and checked
+        client.start_login()
+
+    adgroup_cache = None
+    if params.get('skip_unchanged_adgroups'):
+        adgroup_cache = AdgroupStateCache.from_state(
+            state, ttl=params.get('adgroup_cache_ttl_hours', 0) * 3600)
+    final_action = decide_action(_datadir, params, adgroup_cache)
+    if params.get('resume'):
+        intables = _datadir / 'in/tables'
+        journal = Journal.from_state(state, input_fingerprint(
+            path for path in intables.glob('*.csv') if path.is_file()))
+    else:
+        journal = NullJournal()
+    completed = False
+    try:
+        with client:
+            final_action(client=client, journal=journal, metrics=metrics)
+        completed = True
+    finally:
+        metrics.log_summary()
+        outtables.mkdir(parents=True, exist_ok=True)
+        with output_table(outtables, FNAME_METRICS, Metrics.columns,
+                          shard_from_params(params)) as wr:
+            metrics.write(wr)
+        if params.get('resume'):
+            if completed and not journal.failed:
+                # every row made it, the next run starts afresh
+                logger.info("All rows were processed, %s of them skipped as "
+                            "processed by previous runs", journal.skipped)
+                Journal.clear_state(state)
+            else:
+                logger.info("Saving %s processed rows to the state, %s rows "
+                            "were skipped as already processed",
+                            len(journal), journal.skipped)
+                journal.to_state(state)
+        if adgroup_cache is not None:
+            adgroup_cache.to_state(state)
+        save_state(_datadir, client.token_to_state(state))
+
 
-    final_action = decide_action(_datadir, params)
-    with client:
-        final_action(client=client)
+def _request_log_setup(log_params, outdir, shard=None):
+    """Translate the `request_log` config into `KBCTTDClient` arguments
+
+    When sharding, the log is a sliced table loaded incrementally like the
+    other outputs (see `output_table`), every shard writes its own slices.
+
+    Returns:
+        (path_csv_log, csv_log_options), the path is None if the log is disabled
+    """
+    if log_params is None:
+        return None, None
+    options = {
+        'body_mode': log_params.get('body_mode', 'full'),
+        'max_body_bytes': log_params.get('max_body_bytes', 1024),
+        'compress': log_params.get('gzip', False),
+        'slice_rows': log_params.get('slice_rows'),
+        'stdout': log_params.get('stdout', 'full'),
+        'progress_every': log_params.get('progress_every', 1000)
+    }
+    suffix = '.gz' if options['compress'] and not options['slice_rows'] else ''
+    if shard is None:
+        path = Path(outdir) / (FNAME_REQUEST_LOG + suffix)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_manifest(path, CsvRequestLog.header)
+        return path, options
+    table = Path(outdir) / FNAME_REQUEST_LOG
+    table.mkdir(parents=True, exist_ok=True)
+    write_manifest(table, CsvRequestLog.header, incremental=True)
+    part = 'part_{:05d}_of_{:05d}'.format(shard.index, shard.count)
+    if options['slice_rows']:
+        options['slice_prefix'] = part + '_'
+        return table, options
+    return table / (part + '.csv' + suffix), options
 
 
 def validate_config(params):
@@ -52,82 +174,402 @@ def validate_config(params):
         "#password": str,
         vp.Optional("debug"): bool,
         "base_url": str,
-        vp.Optional("do_not_fail"): bool
+        vp.Optional("do_not_fail"): bool,
+        vp.Optional("max_concurrency"): vp.All(int, vp.Range(min=1)),
+        vp.Optional("max_requests_per_second"): vp.All(
+            vp.Coerce(float), vp.Range(min=0, min_included=False)),
+        vp.Optional("http_pool_size"): vp.All(int, vp.Range(min=1)),
+        vp.Optional("compress_requests_over_bytes"): vp.All(int, vp.Range(min=0)),
+        vp.Optional("max_retries"): vp.All(int, vp.Range(min=0)),
+        vp.Optional("retry_budget"): vp.All(int, vp.Range(min=0)),
+        vp.Optional("request_timeout_seconds"): vp.All(
+            vp.Coerce(float), vp.Range(min=0, min_included=False)),
+        vp.Optional("group_adgroups_on_disk"): bool,
+        vp.Optional("resume"): bool,
+        vp.Optional("deduplicate_payloads"): bool,
+        vp.Optional("skip_unchanged_adgroups"): bool,
+        vp.Optional("adgroup_cache_ttl_hours"): vp.All(
+            vp.Coerce(float), vp.Range(min=0)),
+        vp.Optional("resolve_clones"): bool,
+        vp.Optional("resolve_clones_timeout_seconds"): vp.All(
+            vp.Coerce(float), vp.Range(min=0)),
+        vp.Optional("preflight"): bool,
+        vp.Optional("preflight_workers"): vp.All(int, vp.Range(min=1)),
+        vp.Optional("request_log"): {
+            vp.Optional("body_mode"): vp.Any(*BODY_MODES),
+            vp.Optional("max_body_bytes"): vp.All(int, vp.Range(min=0)),
+            vp.Optional("gzip"): bool,
+            vp.Optional("slice_rows"): vp.All(int, vp.Range(min=1)),
+            vp.Optional("stdout"): vp.Any(*STDOUT_MODES),
+            vp.Optional("progress_every"): vp.All(int, vp.Range(min=1))
+        },
+        vp.Optional("shard_index"): vp.All(int, vp.Range(min=0)),
+        vp.Optional("shard_count"): vp.All(int, vp.Range(min=1)),
+        vp.Optional("profile"): {
+            vp.Optional("top"): vp.All(int, vp.Range(min=1)),
+            vp.Optional("sample_rows"): vp.All(int, vp.Range(min=1))
+        },
     })
-    return schema(params)
+    params = schema(params)
+    if params.get('shard_index', 0) >= params.get('shard_count', 1):
+        raise ttdwr.exceptions.TTDConfigError(
+            "shard_index must be lower than shard_count (it starts at 0)")
+    return params
+
 
+def decide_action(datadir: Path, params: dict,
+                  adgroup_cache=None) -> ExecutionPlan:
+    """Build the plan of actions for all the input tables found
 
-def decide_action(datadir: Path, params: dict):
+    Creating campaigns/adgroups and cloning campaigns run concurrently,
+    putting adgroups runs once they are done so that it never races with
+    a create.
+
+    Args:
+        adgroup_cache: `AdgroupStateCache`, turns on skipping the unchanged
+            adgroups when putting them
+    """
     datadir = Path(datadir)
     intables = datadir / 'in/tables'
     outtables = datadir / 'out/tables'
     tables = set(os.listdir(str(intables)))
+    max_concurrency = params.get('max_concurrency', 1)
+    do_not_fail = params.get('do_not_fail', False)
+    deduplicate = params.get('deduplicate_payloads', False)
+    resolve_timeout = (params.get('resolve_clones_timeout_seconds', 600)
+                       if params.get('resolve_clones') else None)
+    shard = shard_from_params(params)
+    if shard is not None:
+        logger.info("Processing shard %s of %s", shard.index + 1, shard.count)
+    limit = params.get('profile', {}).get('sample_rows')
+    if limit is not None:
+        logger.warning("Processing only the first %s rows of every table", limit)
+    first_stage = []
+    second_stage = []
     if FNAME_ADGROUPS in tables and FNAME_CAMPAIGNS in tables:
         logger.info("Found both '%s' and '%s'. "
                     "Will create campaigns and their adgroups afterwards",
                     FNAME_ADGROUPS,
                     FNAME_CAMPAIGNS)
-        return partial(
+        first_stage.append(partial(
             create_campaigns_and_adgroups,
             path_csv_campaigns=intables / FNAME_CAMPAIGNS,
-            path_csv_adgroups=intables / FNAME_ADGROUPS)
+            path_csv_adgroups=intables / FNAME_ADGROUPS,
+            outdir=outtables,
+            max_concurrency=max_concurrency,
+            do_not_fail=do_not_fail,
+            group_on_disk=params.get('group_adgroups_on_disk', False),
+            shard=shard,
+            limit=limit))
 
     elif FNAME_ADGROUPS in tables:
         logger.info("Found only '%s' Will create only adgroups",
                     FNAME_ADGROUPS)
-        return partial(create_adgroups,
-                       path_to_csv=intables / FNAME_ADGROUPS)
+        first_stage.append(partial(create_adgroups,
+                                   path_to_csv=intables / FNAME_ADGROUPS,
+                                   outdir=outtables,
+                                   max_concurrency=max_concurrency,
+                                   do_not_fail=do_not_fail,
+                                   shard=shard,
+                                   limit=limit))
 
     elif FNAME_CAMPAIGNS in tables:
         logger.info("Found only '%s' Will create only campaigns",
                     FNAME_CAMPAIGNS)
-        return partial(create_campaigns,
-                       path_to_csv=intables / FNAME_CAMPAIGNS)
+        first_stage.append(partial(create_campaigns,
+                                   path_to_csv=intables / FNAME_CAMPAIGNS,
+                                   outdir=outtables,
+                                   max_concurrency=max_concurrency,
+                                   do_not_fail=do_not_fail,
+                                   shard=shard,
+                                   limit=limit))
 
-    elif FNAME_CLONE_CAMPAIGNS in tables:
+    if FNAME_CLONE_CAMPAIGNS in tables:
         logger.info("Found %s, cloning campaigns", FNAME_CLONE_CAMPAIGNS)
-        return partial(clone_campaigns,
-                       path_to_csv=intables / FNAME_CLONE_CAMPAIGNS,
-                       outdir=outtables,
-                       do_not_fail=params.get('do_not_fail', False))
-    elif FNAME_PUT_ADGROUPS in tables:
+        first_stage.append(partial(clone_campaigns,
+                                   path_to_csv=intables / FNAME_CLONE_CAMPAIGNS,
+                                   outdir=outtables,
+                                   do_not_fail=do_not_fail,
+                                   max_concurrency=max_concurrency,
+                                   shard=shard,
+                                   limit=limit,
+                                   deduplicate=deduplicate,
+                                   resolve_timeout=resolve_timeout))
+    if FNAME_PUT_ADGROUPS in tables:
         logger.info("Found %s, putting adgroups", FNAME_PUT_ADGROUPS)
-        return partial(put_adgroups,
-                       path_to_csv=intables / FNAME_PUT_ADGROUPS,
-                       outdir=outtables)
-    else:
+        second_stage.append(partial(put_adgroups,
+                                    path_to_csv=intables / FNAME_PUT_ADGROUPS,
+                                    outdir=outtables,
+                                    do_not_fail=do_not_fail,
+                                    max_concurrency=max_concurrency,
+                                    shard=shard,
+                                    limit=limit,
+                                    deduplicate=deduplicate,
+                                    adgroup_cache=adgroup_cache))
+
+    plan = ExecutionPlan([first_stage, second_stage])
+    if not plan.actions:
         raise ttdwr.exceptions.TTDInternalError(
             "Don't know what action to perform. Found tables '{}'".format(
                 tables))
 
-def load_csv_data(path_to_csv):
+    if params.get('preflight'):
+        errors = []
+        for action in plan.actions:
+            errors.extend(preflight(action, workers=params.get('preflight_workers')))
+        if errors:
+            outpath = write_errors(outtables, errors)
+            for err in errors[:20]:
+                logger.error("%s row %s column '%s': %s", *err)
+            raise ttdwr.exceptions.UserError(
+                "Found {} problems in the input tables, see '{}'".format(
+                    len(errors), outpath))
+        logger.info("Preflight check of the input tables passed")
+    return plan
+
+
+def preflight(action, workers=None):
+    """Check the input tables of `action` before touching the api
+
+    Returns:
+        list of PreflightError
+    """
+    kwargs = action.keywords
+    if action.func is create_campaigns_and_adgroups:
+        campaign_errors, campaign_ids = validate_table(
+            kwargs['path_csv_campaigns'],
+            required_columns=('payload', 'dummy_campaign_id'),
+            required_keys=('CampaignName',),
+            id_column='dummy_campaign_id',
+            workers=workers)
+        adgroup_errors, adgroup_campaign_ids = validate_table(
+            kwargs['path_csv_adgroups'],
+            required_columns=('payload', 'dummy_campaign_id'),
+            required_keys=('AdGroupName',),
+            id_column='dummy_campaign_id',
+            workers=workers)
+        return (
+            campaign_errors
+            + adgroup_errors
+            + check_unique(FNAME_CAMPAIGNS, campaign_ids, 'dummy_campaign_id')
+            + check_references(FNAME_ADGROUPS, adgroup_campaign_ids,
+                               'dummy_campaign_id',
+                               (value for _, value in campaign_ids),
+                               FNAME_CAMPAIGNS))
+    required_columns, required_keys = {
+        create_adgroups: (('payload',), ('AdGroupName',)),
+        create_campaigns: (('payload',), ('CampaignName',)),
+        clone_campaigns: (('payload',), ()),
+        put_adgroups: (('payload', 'OrderItemNumber', 'AdGroupId'),
+                       ('AdGroupId',)),
+    }[action.func]
+    errors, _ = validate_table(kwargs['path_to_csv'],
+                               required_columns=required_columns,
+                               required_keys=required_keys,
+                               workers=workers)
+    return errors
+
+
+Shard = namedtuple('Shard', ['index', 'count'])
+
+
+def in_shard(value, shard):
+    """Deterministically assign `value` to one of `shard.count` partitions"""
+    if shard is None:
+        return True
+    return zlib.crc32(value.encode('utf8')) % shard.count == shard.index
+
+
+def shard_from_params(params):
+    if params.get('shard_count', 1) > 1:
+        return Shard(params.get('shard_index', 0), params['shard_count'])
+    return None
+
+
+def load_csv_data(path_to_csv, shard=None, shard_key='payload', limit=None):
+    """Read the rows of the csv
+
+    Flattened payload columns (see `ttdwr.flatpayload`) are replaced with
+    the `payload` column built from them.
+
+    Args:
+        shard: only rows whose `shard_key` column hashes to this `Shard`
+            are returned, None means all rows
+        limit: return at most this many rows
+    """
     with open(path_to_csv) as f:
-        rdr = csv.DictReader(f)
-        yield from rdr
+        rows = csv.DictReader(f)
+        builder = compile_builder(rows.fieldnames)
+        if builder is not None:
+            rows = map(builder.apply, rows)
+        if shard is not None:
+            rows = (row for row in rows if in_shard(row[shard_key], shard))
+        yield from itertools.islice(rows, limit)
+
 
-def create_adgroups(client, path_to_csv):
-    for adgrp in load_csv_data(path_to_csv):
-        payload = json.loads(adgrp['payload'])
-        logger.info("Creating adgroup %s", payload['AdGroupName'])
+@contextmanager
+def output_table(outdir, fname, columns, shard=None):
+    """A DictWriter for an output table
+
+    When sharding, every shard writes its own slice of a sliced table
+    loaded incrementally, so that KBC merges the results of all shards.
+    """
+    outpath = Path(outdir) / fname
+    if shard is None:
+        with open(str(outpath), 'w', buffering=OUTPUT_BUFFER_SIZE) as outf:
+            wr = csv.DictWriter(outf, fieldnames=columns)
+            wr.writeheader()
+            yield wr
+        return
+    outpath.mkdir(parents=True, exist_ok=True)
+    write_manifest(outpath, columns, incremental=True)
+    path_slice = outpath / 'part_{:05d}_of_{:05d}.csv'.format(shard.index,
+                                                              shard.count)
+    with open(str(path_slice), 'w', buffering=OUTPUT_BUFFER_SIZE) as outf:
+        yield csv.DictWriter(outf, fieldnames=columns)
+
+def _output_columns(path_to_csv, *columns):
+    """The input columns except the payload, followed by `columns`"""
+    extra = [col for col in _peek_at_header(str(path_to_csv)) if col != 'payload']
+    return extra + [col for col in columns if col not in extra]
+
+
+def _error_text(err):
+    resp = getattr(err, 'response', None)
+    return resp.text if resp is not None else str(err)
+
+
+def _output_row(row, **values):
+    out = {col: value for col, value in row.items() if col != 'payload'}
+    out.update(values)
+    return out
+
+
+def _done(result):
+    """A future which already has the `result`"""
+    fut = Future()
+    fut.set_result(result)
+    return fut
+
+
+def create_adgroups(client, path_to_csv, max_concurrency=1, do_not_fail=False,
+                    journal=None, shard=None, metrics=None, limit=None,
+                    outdir=None):
+    """Create the adgroups
+
+    If `outdir` is given, the input rows (without the payload) are written to
+    `outdir/create_adgroups.csv` with the new `AdGroupId` and the response
+    as soon as they are created.
+    """
+    if journal is None:
+        journal = NullJournal()
+    if metrics is None:
+        metrics = Metrics()
+
+    def _create_adgroup(keyed_row):
+        key, adgrp = keyed_row
+        done = journal.get(key)
+        if done is not None:
+            logger.info("Adgroup '%s' was created as AdGroupId= '%s' "
+                        "in a previous run, skipping",
+                        done.get('AdGroupName'), done['AdGroupId'])
+            return _output_row(adgrp, AdGroupId=done['AdGroupId'],
+                               response=json.dumps(done))
+        # the payload is sent as it is, no need to parse it
         try:
-            new_adgrp = client.create_adgroup(payload)
+            resp = client.request_raw('POST', '/adgroup', adgrp['payload'])
+        except TTDApiError as err:
+            logger.info("payload was\n:%s", adgrp['payload'])
+            if do_not_fail:
+                logger.info("Adgroup returned error '%s'. Logging and "
+                            "continuing, since do_not_fail=True", err)
+                journal.record_failure()
+                return _output_row(adgrp, AdGroupId='',
+                                   response=_error_text(err))
+            raise
         except:
-            logger.info("payload was\n:%s", json.dumps(payload))
+            logger.info("payload was\n:%s", adgrp['payload'])
             raise
+        new_adgrp = jsonutil.loads(resp.text)
         logger.info("Success: Created '%s' as AdGroupId= '%s'",
-                    payload['AdGroupName'], new_adgrp['AdGroupId'])
+                    new_adgrp.get('AdGroupName'), new_adgrp['AdGroupId'])
+        journal.record(key, summary(new_adgrp, 'AdGroupId', 'AdGroupName'))
+        return _output_row(adgrp, AdGroupId=new_adgrp['AdGroupId'],
+                           response=resp.text)
 
-def create_campaigns(client, path_to_csv):
-    for campaign in load_csv_data(path_to_csv):
-        payload = json.loads(campaign['payload'])
-        logger.info("Creating Campaign %s", payload['CampaignName'])
+    rows = journal.keyed('create_adgroups', metrics.timed(
+        CSV_PARSE, load_csv_data(path_to_csv, shard, limit=limit)))
+    with ExitStack() as stack:
+        executor = stack.enter_context(RowExecutor(max_concurrency))
+        if outdir is not None:
+            wr = stack.enter_context(output_table(
+                outdir, FNAME_ADGROUPS,
+                _output_columns(path_to_csv, 'AdGroupId', 'response'), shard))
+        for created in executor.imap(_create_adgroup, rows):
+            if outdir is not None:
+                with metrics.timer(OUTPUT_WRITE):
+                    wr.writerow(created)
+            metrics.row_done('create_adgroups')
+
+
+def create_campaigns(client, path_to_csv, max_concurrency=1, do_not_fail=False,
+                     journal=None, shard=None, metrics=None, limit=None,
+                     outdir=None):
+    """Create the campaigns
+
+    If `outdir` is given, the input rows (without the payload) are written to
+    `outdir/create_campaigns.csv` with the new `CampaignId` and the response
+    as soon as they are created.
+    """
+    if journal is None:
+        journal = NullJournal()
+    if metrics is None:
+        metrics = Metrics()
+
+    def _create_campaign(keyed_row):
+        key, campaign = keyed_row
+        done = journal.get(key)
+        if done is not None:
+            logger.info("Campaign '%s' was created as CampaignId= '%s' "
+                        "in a previous run, skipping",
+                        done.get('CampaignName'), done['CampaignId'])
+            return _output_row(campaign, CampaignId=done['CampaignId'],
+                               response=json.dumps(done))
+        # the payload is sent as it is, no need to parse it
         try:
-            new_campaign = client.create_campaign(payload)
+            resp = client.request_raw('POST', '/campaign', campaign['payload'])
+        except TTDApiError as err:
+            logger.info("payload was\n:%s", campaign['payload'])
+            if do_not_fail:
+                logger.info("Campaign returned error '%s'. Logging and "
+                            "continuing, since do_not_fail=True", err)
+                journal.record_failure()
+                return _output_row(campaign, CampaignId='',
+                                   response=_error_text(err))
+            raise
         except:
-            logger.info("payload was\n:%s", json.dumps(payload))
+            logger.info("payload was\n:%s", campaign['payload'])
             raise
-        logger.info("Success: Created '%s' as AdGroupId= '%s'",
-                    payload['CampaignName'], new_campaign['CampaignId'])
+        new_campaign = jsonutil.loads(resp.text)
+        logger.info("Success: Created '%s' as CampaignId= '%s'",
+                    new_campaign.get('CampaignName'), new_campaign['CampaignId'])
+        journal.record(key, summary(new_campaign, 'CampaignId', 'CampaignName'))
+        return _output_row(campaign, CampaignId=new_campaign['CampaignId'],
+                           response=resp.text)
+
+    rows = journal.keyed('create_campaigns', metrics.timed(
+        CSV_PARSE, load_csv_data(path_to_csv, shard, limit=limit)))
+    with ExitStack() as stack:
+        executor = stack.enter_context(RowExecutor(max_concurrency))
+        if outdir is not None:
+            wr = stack.enter_context(output_table(
+                outdir, FNAME_CAMPAIGNS,
+                _output_columns(path_to_csv, 'CampaignId', 'response'), shard))
+        for created in executor.imap(_create_campaign, rows):
+            if outdir is not None:
+                with metrics.timer(OUTPUT_WRITE):
+                    wr.writerow(created)
+            metrics.row_done('create_campaigns')
 
 
 def stream_to_csv(outpath, stream, columns=None):
@@ -138,75 +580,290 @@ def stream_to_csv(outpath, stream, columns=None):
 
 def _peek_at_header(path_csv):
     with open(path_csv) as f:
-        return csv.DictReader(f).fieldnames
+        return payload_header(csv.DictReader(f).fieldnames)
 
 
-def clone_campaigns(client, path_to_csv, outdir, do_not_fail=False):
+def _digest(payload):
+    return hashlib.sha1(payload.encode('utf8')).digest()
+
+
+class _RepeatedPuts:
+    """Wrap `send(payload)` of the puts, skip the put of the payload which
+    was put to the same adgroup right before
+
+    Only the consecutive repeats of one adgroup can be skipped, putting X, Y
+    and X again must end with X. The puts of one adgroup never run at once
+    (see `put_adgroups`), so "right before" is well defined. Counts the
+    `calls` and the `saved` ones like `Coalescer` does.
+    """
+    def __init__(self, send):
+        self._send = send
+        self._lock = threading.Lock()
+        # AdGroupId -> (digest of the last payload, its result)
+        self._last = {}
+        self.calls = 0
+        self.saved = 0
+
+    def __call__(self, adgroup_id, payload):
+        digest = _digest(payload)
+        with self._lock:
+            last = self._last.get(adgroup_id)
+            if last is not None and last[0] == digest:
+                self.saved += 1
+                return last[1]
+        result = self._send(payload)
+        _, ok = result
+        with self._lock:
+            self.calls += 1
+            if ok:
+                self._last[adgroup_id] = (digest, result)
+            else:
+                # the adgroup is in an unknown state, put the next one anyway
+                self._last.pop(adgroup_id, None)
+        return result
+
+
+def _log_saved_calls(action, deduplicated):
+    """`deduplicated` is a `Coalescer` or `_RepeatedPuts`"""
+    logger.info("%s: sent %s distinct payloads, saved %s duplicate calls",
+                action, deduplicated.calls, deduplicated.saved)
+
+
+def clone_campaigns(client, path_to_csv, outdir, do_not_fail=False,
+                    max_concurrency=1, journal=None, shard=None, metrics=None,
+                    limit=None, deduplicate=False, resolve_timeout=None):
+    """Clone the campaigns, the responses are written next to the input rows
+
+    With `deduplicate` every distinct payload is sent just once and its
+    response is used for all the rows with the same payload.
+
+    With `resolve_timeout` (seconds) the writer waits for the clones to be
+    created, the `clone_status` and `clone_campaign_id` output columns
+    tell how they ended up. The rows are written out after that then.
+    """
     outpath = Path(outdir) / 'clone_campaigns.csv'
     header = _peek_at_header(path_to_csv)
+    columns = header + ['response']
+    if resolve_timeout is not None:
+        columns += ['clone_status', 'clone_campaign_id']
+    if journal is None:
+        journal = NullJournal()
+    if metrics is None:
+        metrics = Metrics()
 
-    with open(outpath, 'w') as outf:
-        wr = csv.DictWriter(outf, fieldnames=header + ['response'])
-        wr.writeheader()
-        for campaign in load_csv_data(path_to_csv):
-            # a helper variable to prettify logging output
-            _log_row = {
-                k: v
-                for k, v
-                in campaign.items()
-                if k != 'payload'
-            }
-            try:
-                resp = client.post('/campaign/clone',
-                                   json=json.loads(campaign['payload']))
-            except TTDApiError as err:
-                # A failover mechanism that enables the extractor
-                # to finish (and output csvs with previously created )
-                if do_not_fail:
-                    logger.info(
-                        ("row %s returned error '%s'. Logging and continuing,"
-                         " since do_not_fail=True"),
-                        _log_row,
-                        err
+    def _send(payload):
+        """Returns (response text, whether the api accepted it)"""
+        try:
+            return client.request_raw('POST', '/campaign/clone', payload).text, True
+        except TTDApiError as err:
+            # A failover mechanism that enables the extractor
+            # to finish (and output csvs with previously created )
+            if do_not_fail:
+                return err.response.text, False
+            raise
+
+    if deduplicate:
+        coalescer = Coalescer(_send)
+
+        def send(payload):
+            return coalescer(_digest(payload), payload)
+    else:
+        send = _send
+
+    def _clone_campaign(keyed_row):
+        key, campaign = keyed_row
+        # a helper variable to prettify logging output
+        _log_row = {
+            k: v
+            for k, v
+            in campaign.items()
+            if k != 'payload'
+        }
+        done = journal.get(key)
+        if done is not None:
+            logger.info("row %s was cloned in a previous run, skipping", _log_row)
+            campaign['response'] = done
+            return campaign
+        response_text, ok = send(campaign['payload'])
+        if not ok:
+            logger.info(
+                ("row %s returned error '%s'. Logging and continuing,"
+                 " since do_not_fail=True"),
+                _log_row,
+                response_text
+            )
+            journal.record_failure()
+        else:
+            reference_id = jsonutil.loads(response_text)['ReferenceId']
+            logger.info(
+                "row %s created with reference_id %s",
+                _log_row,
+                reference_id
                     )
-                    resp = err.response.json()
-                else:
-                    raise
-            else:
-                logger.info(
-                    "row %s created with reference_id %s",
-                    _log_row,
-                    resp['ReferenceId']
-                        )
-            campaign['response'] = json.dumps(resp)
-            wr.writerow(campaign)
+            journal.record(key, json.dumps({'ReferenceId': reference_id}))
+        campaign['response'] = response_text
+        return campaign
+
+    def _reference_id(campaign):
+        try:
+            return jsonutil.loads(campaign['response']).get('ReferenceId')
+        except (ValueError, AttributeError):
+            # the error of a failed clone
+            return None
+
+    def _resolve(cloned):
+        reference_ids = [_reference_id(campaign) for campaign in cloned]
+        statuses = resolve_clones(client, filter(None, reference_ids),
+                                  max_concurrency, resolve_timeout)
+        for campaign, reference_id in zip(cloned, reference_ids):
+            status = statuses.get(reference_id)
+            campaign['clone_status'] = status.status if status else ''
+            campaign['clone_campaign_id'] = status.campaign_id if status else ''
+
+    cloned = []
+    rows = journal.keyed('clone_campaigns', metrics.timed(
+        CSV_PARSE, load_csv_data(path_to_csv, shard, limit=limit)))
+    with output_table(outdir, outpath.name, columns, shard) as wr:
+        try:
+            with RowExecutor(max_concurrency) as executor:
+                for campaign in executor.imap(_clone_campaign, rows):
+                    metrics.row_done('clone_campaigns')
+                    if resolve_timeout is None:
+                        with metrics.timer(OUTPUT_WRITE):
+                            wr.writerow(campaign)
+                    else:
+                        cloned.append(campaign)
+            if cloned:
+                _resolve(cloned)
+        finally:
+            # even when the job fails, the reference ids are not lost
+            for campaign in cloned:
+                with metrics.timer(OUTPUT_WRITE):
+                    wr.writerow(campaign)
+    if deduplicate:
+        _log_saved_calls('clone_campaigns', coalescer)
     return outpath
 
 
-def put_adgroups(client, path_to_csv, outdir):
-    outpath = outdir / 'put_adgroups.csv'
+def put_adgroups(client, path_to_csv, outdir, do_not_fail=False,
+                 max_concurrency=1, journal=None, shard=None, metrics=None,
+                 limit=None, deduplicate=False, adgroup_cache=None):
+    """Put the adgroups, the responses are written next to the input rows
+
+    With `deduplicate` a payload which was just put to the same adgroup
+    isn't put again, the row gets the response of the previous put.
+
+    With `adgroup_cache` (`AdgroupStateCache`) the current adgroups are
+    fetched (unless cached) and only the (nested) fields which differ are
+    put. The `update_status` output column is 'updated', 'unchanged' or
+    'failed'.
+    """
+    outpath = Path(outdir) / 'put_adgroups.csv'
     header = _peek_at_header(path_to_csv)
-    with open(outpath, 'w') as outf:
-        wr = csv.DictWriter(outf, fieldnames=header + ['response'])
-        wr.writeheader()
-
-        for adgroup in load_csv_data(path_to_csv):
-            logger.info("Putting OrderItemNumber %s AdGroupId %s",
-                        adgroup['OrderItemNumber'], adgroup['AdGroupId'])
-            while True:
-                try:
-                    resp = client.put(
-                        '/adgroup',
-                        json=json.loads(adgroup['payload']))
-                    adgroup['response'] = json.dumps(resp)
-                    break
-                except TTDApiError as err:
-                    if err.response.status_code == 429:
-                        logger.info("Sleeping for 5s because too many requests")
-                        time.sleep(5)
-                    else:
-                        raise
-            wr.writerow(adgroup)
+    columns = header + ['response']
+    if adgroup_cache is not None:
+        columns.append('update_status')
+    if journal is None:
+        journal = NullJournal()
+    if metrics is None:
+        metrics = Metrics()
+
+    def _send(payload):
+        """Returns (response text, whether the api accepted it)"""
+        try:
+            return client.request_raw('PUT', '/adgroup', payload).text, True
+        except TTDApiError as err:
+            # HTTP 429 is retried by the client already
+            if do_not_fail:
+                return err.response.text, False
+            raise
+
+    if deduplicate:
+        send = repeated_puts = _RepeatedPuts(_send)
+    else:
+        def send(adgroup_id, payload):
+            return _send(payload)
+
+    def _current_state(adgroup_id):
+        try:
+            resp = client.request_raw(
+                'GET', '/adgroup/{}'.format(quote(adgroup_id, safe='')), None)
+        except TTDApiError as err:
+            # let the PUT tell what's wrong
+            logger.info("Couldn't fetch AdGroupId %s (%s), putting the whole "
+                        "payload", adgroup_id, err)
+            return {}
+        return jsonutil.loads(resp.text)
+
+    def _put_adgroup(keyed_row):
+        key, adgroup = keyed_row
+        done = journal.get(key)
+        if done is not None:
+            logger.info("AdGroupId %s was put in a previous run, skipping",
+                        adgroup['AdGroupId'])
+            adgroup['response'] = done
+            if adgroup_cache is not None:
+                adgroup['update_status'] = 'updated'
+            return adgroup
+        payload = adgroup['payload']
+        if adgroup_cache is not None:
+            with metrics.timer(PAYLOAD_DECODE):
+                desired = jsonutil.loads(payload)
+            if adgroup_cache.get(adgroup['AdGroupId']) == payload_digest(desired):
+                changes = {}
+            else:
+                changes = changed_fields(desired,
+                                         _current_state(adgroup['AdGroupId']))
+                changes.pop('AdGroupId', None)
+            if not changes:
+                logger.info("AdGroupId %s is up to date, skipping",
+                            adgroup['AdGroupId'])
+                adgroup_cache.set(adgroup['AdGroupId'], desired)
+                adgroup['response'] = ''
+                adgroup['update_status'] = 'unchanged'
+                return adgroup
+            payload = json.dumps(dict(changes, AdGroupId=adgroup['AdGroupId']))
+        logger.info("Putting OrderItemNumber %s AdGroupId %s",
+                    adgroup['OrderItemNumber'], adgroup['AdGroupId'])
+        response_text, ok = send(adgroup['AdGroupId'], payload)
+        if adgroup_cache is not None:
+            adgroup['update_status'] = 'updated' if ok else 'failed'
+            if ok:
+                adgroup_cache.set(adgroup['AdGroupId'], desired)
+        if not ok:
+            logger.info(
+                ("AdGroupId %s returned error '%s'. Logging and "
+                 "continuing, since do_not_fail=True"),
+                adgroup['AdGroupId'],
+                response_text
+            )
+            journal.record_failure()
+        else:
+            journal.record(key, json.dumps(summary(
+                jsonutil.loads(response_text), 'AdGroupId', 'Version')))
+        adgroup['response'] = response_text
+        return adgroup
+
+    updates = Counter()
+    # updates of the same adgroup stay in the same shard (and order)
+    rows = journal.keyed('put_adgroups', metrics.timed(
+        CSV_PARSE, load_csv_data(path_to_csv, shard, shard_key='AdGroupId',
+                                 limit=limit)))
+    with output_table(outdir, outpath.name, columns, shard) as wr, \
+            RowExecutor(max_concurrency) as executor:
+        # the puts of one adgroup must not overtake each other
+        for adgroup in executor.imap(_put_adgroup, rows,
+                                     key=lambda keyed_row: keyed_row[1]['AdGroupId']):
+            with metrics.timer(OUTPUT_WRITE):
+                wr.writerow(adgroup)
+            metrics.row_done('put_adgroups')
+            if adgroup_cache is not None:
+                updates[adgroup['update_status']] += 1
+    if deduplicate:
+        _log_saved_calls('put_adgroups', repeated_puts)
+    if adgroup_cache is not None:
+        logger.info("put_adgroups: %s updated, %s unchanged, %s failed",
+                    updates['updated'], updates['unchanged'], updates['failed'])
     return outpath
 
 
@@ -230,30 +887,182 @@ def group_adgroups_to_campaigns(iterable_of_adgroups):
 def create_campaigns_and_adgroups(
         client,
         path_csv_campaigns,
-        path_csv_adgroups)-> Tuple[dict, List[dict]]:
-    campaigns = load_csv_data(path_csv_campaigns)
-    # for now load into memory, there shouldn't be too many of them
-    adgroups = group_adgroups_to_campaigns(load_csv_data(path_csv_adgroups))
-    created_adgroups = []
-    for campaign in campaigns:
-        campaign_payload = json.loads(campaign['payload'])
+        path_csv_adgroups,
+        outdir=None,
+        max_concurrency=1,
+        do_not_fail=False,
+        group_on_disk=False,
+        journal=None,
+        shard=None,
+        metrics=None,
+        limit=None)-> Tuple[dict, int]:
+    """Create the campaigns and the adgroups belonging to them
+
+    As soon as a campaign is created its adgroups are queued for creation,
+    while the following campaigns are being created by the other workers.
+
+    If `outdir` is given, the `dummy_campaign_id` -> `CampaignId` mapping
+    is written to `outdir/campaign_id_mapping.csv` and the input rows
+    (without the payload) with the new ids and the responses are written
+    to `outdir/create_campaigns.csv` and `outdir/create_adgroups.csv` as
+    they are created.
+
+    Returns:
+        (the last created campaign, the number of created adgroups)
+
+    With `group_on_disk` the adgroups are kept in an on-disk index instead
+    of memory and are read only when their campaign is created.
+
+    When sharding, the rows are partitioned by `dummy_campaign_id` so the
+    campaigns and their adgroups end up in the same shard.
+
+    `limit` applies to the campaigns, all their adgroups are created.
+
+    With `do_not_fail` the adgroups of a campaign which failed are written
+    out too, with no ids and the campaign error in the response.
+    """
+    if journal is None:
+        journal = NullJournal()
+    if metrics is None:
+        metrics = Metrics()
+    campaigns = journal.keyed('create_campaigns_and_adgroups.campaign',
+                              metrics.timed(CSV_PARSE, load_csv_data(
+                                  path_csv_campaigns, shard,
+                                  shard_key='dummy_campaign_id', limit=limit)))
+
+    def _create_adgroup(key, adgroup, real_campaign_id):
+        # the only payload we have to touch
+        with metrics.timer(PAYLOAD_DECODE):
+            adgroup_payload = jsonutil.loads(adgroup['payload'])
+        adgroup_payload['CampaignId'] = real_campaign_id
+        done = journal.get(key)
+        if done is not None:
+            logger.info("Adgroup '%s' was created as '%s' in a previous run, "
+                        "skipping", adgroup_payload['AdGroupName'],
+                        done['AdGroupId'])
+            return _output_row(adgroup, CampaignId=real_campaign_id,
+                               AdGroupId=done['AdGroupId'],
+                               response=json.dumps(done))
+        logger.info("Creating Adgroup '%s' for campaign %s",
+                    adgroup_payload['AdGroupName'],
+                    real_campaign_id)
+        try:
+            resp = client.request_raw('POST', '/adgroup',
+                                      json.dumps(adgroup_payload))
+        except TTDApiError as err:
+            logger.info("Error, Payload was\n%s", json.dumps(adgroup_payload))
+            if do_not_fail:
+                logger.info("Adgroup '%s' returned error '%s'. Logging and "
+                            "continuing, since do_not_fail=True",
+                            adgroup_payload['AdGroupName'], err)
+                journal.record_failure()
+                return _output_row(adgroup, CampaignId=real_campaign_id,
+                                   AdGroupId='', response=_error_text(err))
+            raise
+        except:
+            logger.info("Error, Payload was\n%s", json.dumps(adgroup_payload))
+            raise
+        new_adgroup = jsonutil.loads(resp.text)
+        logger.info("Success: '%s' has ttd adgroup id '%s'", adgroup_payload['AdGroupName'], new_adgroup['AdGroupId'])
+        journal.record(key, summary(new_adgroup, 'AdGroupId', 'AdGroupName'))
+        return _output_row(adgroup, CampaignId=real_campaign_id,
+                           AdGroupId=new_adgroup['AdGroupId'],
+                           response=resp.text)
+
+    def _create_campaign(keyed_row):
+        key, campaign = keyed_row
         placeholder_campaign_id = campaign['dummy_campaign_id']
-        logger.info("Creating campaign '%s'", campaign_payload['CampaignName'])
-        new_campaign = client.create_campaign(campaign_payload)
-        real_campaign_id = new_campaign['CampaignId']
-        logger.info("Success. The CampaignId is '%s'", real_campaign_id)
-        related_adgroups = adgroups[placeholder_campaign_id]
-        for adgroup in related_adgroups:
-            adgroup_payload = json.loads(adgroup['payload'])
-            adgroup_payload['CampaignId'] = real_campaign_id
-            logger.info("Creating Adgroup '%s' for campaign %s",
-                        adgroup_payload['AdGroupName'],
-                        real_campaign_id)
+        new_campaign = journal.get(key)
+        if new_campaign is not None:
+            logger.info("Campaign '%s' was created as '%s' in a previous run",
+                        new_campaign.get('CampaignName'),
+                        new_campaign['CampaignId'])
+            # only the ids were kept
+            response = json.dumps(new_campaign)
+        else:
+            logger.info("Creating campaign '%s'", placeholder_campaign_id)
+            # the payload is sent as it is, no need to parse it
             try:
-                new_adgroup = client.create_adgroup(adgroup_payload)
-            except:
-                logger.info("Error, Payload was\n%s", json.dumps(adgroup_payload))
+                resp = client.request_raw('POST', '/campaign', campaign['payload'])
+            except TTDApiError as err:
+                logger.info("payload was\n:%s", campaign['payload'])
+                if do_not_fail:
+                    logger.info("Campaign '%s' returned error '%s'. Its adgroups "
+                                "won't be created. Continuing, since do_not_fail=True",
+                                placeholder_campaign_id, err)
+                    journal.record_failure()
+                    # the adgroups are still listed in the output
+                    skipped = "Not created, the campaign '{}' failed: {}".format(
+                        placeholder_campaign_id, _error_text(err))
+                    return (_output_row(campaign, CampaignId='',
+                                        response=_error_text(err)),
+                            None,
+                            [_done(_output_row(adgroup, CampaignId='',
+                                               AdGroupId='', response=skipped))
+                             for adgroup in adgroups.get(placeholder_campaign_id, [])])
                 raise
-            logger.info("Success: '%s' has ttd adgroup id '%s'", adgroup_payload['AdGroupName'], new_adgroup['AdGroupId'])
-            created_adgroups.append(new_adgroup)
-    return new_campaign, created_adgroups
+            new_campaign = jsonutil.loads(resp.text)
+            response = resp.text
+            journal.record(key, summary(new_campaign, 'CampaignId', 'CampaignName'))
+        real_campaign_id = new_campaign['CampaignId']
+        logger.info("Success. The CampaignId is '%s'", real_campaign_id)
+        # release the adgroups to the workers right away, the campaign
+        # worker can move on to the next campaign in the meantime
+        related_adgroups = journal.keyed(
+            'create_campaigns_and_adgroups.adgroup.{}'.format(real_campaign_id),
+            adgroups.get(placeholder_campaign_id, []))
+        adgroup_jobs = [
+            executor.submit(_create_adgroup, adgroup_key, adgroup, real_campaign_id)
+            for adgroup_key, adgroup
+            in related_adgroups
+        ]
+        created = _output_row(campaign, CampaignId=real_campaign_id,
+                              response=response)
+        return created, new_campaign, adgroup_jobs
+
+    n_created_adgroups = 0
+    new_campaign = None
+    with ExitStack() as stack:
+        if group_on_disk:
+            adgroups = stack.enter_context(
+                AdgroupIndex(metrics.timed(CSV_PARSE, load_csv_data(
+                    path_csv_adgroups, shard, shard_key='dummy_campaign_id'))))
+        else:
+            adgroups = group_adgroups_to_campaigns(
+                metrics.timed(CSV_PARSE, load_csv_data(
+                    path_csv_adgroups, shard, shard_key='dummy_campaign_id')))
+        executor = stack.enter_context(RowExecutor(max_concurrency))
+        if outdir is not None:
+            mapping_wr = stack.enter_context(output_table(
+                outdir, FNAME_CAMPAIGN_ID_MAPPING,
+                ['dummy_campaign_id', 'CampaignId'], shard))
+            campaigns_wr = stack.enter_context(output_table(
+                outdir, FNAME_CAMPAIGNS,
+                _output_columns(path_csv_campaigns, 'CampaignId', 'response'),
+                shard))
+            adgroups_wr = stack.enter_context(output_table(
+                outdir, FNAME_ADGROUPS,
+                _output_columns(path_csv_adgroups, 'CampaignId', 'AdGroupId',
+                                'response'),
+                shard))
+        for created_campaign, created, adgroup_jobs in executor.imap(
+                _create_campaign, campaigns):
+            if created is not None:
+                new_campaign = created
+            if outdir is not None:
+                with metrics.timer(OUTPUT_WRITE):
+                    mapping_wr.writerow({
+                        'dummy_campaign_id': created_campaign['dummy_campaign_id'],
+                        'CampaignId': created_campaign['CampaignId']
+                    })
+                    campaigns_wr.writerow(created_campaign)
+            metrics.row_done('create_campaigns_and_adgroups.campaign')
+            for job in adgroup_jobs:
+                created_adgroup = job.result()
+                if created_adgroup['AdGroupId']:
+                    n_created_adgroups += 1
+                if outdir is not None:
+                    with metrics.timer(OUTPUT_WRITE):
+                        adgroups_wr.writerow(created_adgroup)
+                metrics.row_done('create_campaigns_and_adgroups.adgroup')
+    return new_campaign, n_created_adgroups